@@ -5,14 +5,11 @@ import io
 from io import BytesIO
 import sys
 import asyncio
-import gc
 import re
-import os
+import time
 from datetime import datetime
-import random
 import warnings
 import urllib.parse
-import torch
 import discord
 from discord import app_commands
 from discord.ui import Button, View
@@ -24,7 +21,26 @@ from loguru import logger
 from modules.settings import SETTINGS
 from modules.mtg_generator import MTGCardGenerator
 from modules.chat_generator import ChatGenerator
-
+from modules.card_data import load_card_data
+from modules.card_archive import CARD_ARCHIVE
+from modules.model_worker import IMAGE_WORKERS, LLM_WORKERS, RENDER_WORKERS
+from modules.pipeline import GenerationPipeline, PipelineStage
+from modules.scheduler import FairScheduler
+from modules.job_broker import BROKER
+from modules.job_journal import JOURNAL
+from modules.output_cache import ART_CACHE, TEXT_CACHE
+from modules.lookahead import TextLookahead
+from modules.render_node import start_local_nodes
+from modules.streaming_reply import StreamingReply
+from modules.metrics import METRICS, start_metrics_endpoint
+from modules.queue_eta import ACTION_NAMES, QUEUE_ESTIMATOR, format_duration
+from modules.worker_supervisor import IMAGE_SUPERVISOR, CircuitOpenError, ModelWorkerError
+
+
+JOURNAL_CHECKPOINTS = {
+    'text': 'text_done',
+    'image': 'image_done'
+}
 
 warnings.filterwarnings("ignore")
 logger.remove()  # Remove the default configuration
@@ -48,19 +64,46 @@ class LightyMTGClient(discord.Client):
     def __init__(self, *, intents: discord.Intents):
         super().__init__(intents=intents)
         self.slash_command_tree = app_commands.CommandTree(self)
-        self.generation_queue = asyncio.Queue()
+        self.generation_queue = FairScheduler(dict(item.split(':') for item in
+                                                   SETTINGS.get('scheduler_weights', ['twitch:6,card:3,chat:1'])[0].split(',')))
         self.generation_queue_concurrency_list = {}
-        self.currently_processing = False
+        self.pipeline = self.build_pipeline()
+        self.admission_stage = self.pipeline.stages[self.pipeline.stage_index('render' if self.uses_broker() else 'image')]
+        self.admission_limit = self.admission_stage.workers + int(SETTINGS.get('admission_slack', [1])[0])
+        self.admitted = set()
+        self.local_render_nodes = []
+        self.journal_replayed = False
+        self.lookahead = None
 
     async def setup_hook(self):
         """This loads the various shit before logging in to discord"""
+        await asyncio.to_thread(load_card_data)
+        await asyncio.to_thread(CARD_ARCHIVE.open)
+        await asyncio.to_thread(JOURNAL.open)
+        self.pipeline.start()
+        METRICS.add_collector(self.collect_metrics)
+        await start_metrics_endpoint()
         self.loop.create_task(discord_client.process_queue())  # start queue
+        if self.uses_broker():
+            await BROKER.start()
+            self.local_render_nodes = start_local_nodes(BROKER, int(SETTINGS.get('broker_local_nodes', [0])[0]))
+            return
+        if int(SETTINGS.get('lookahead_depth', [2])[0]) > 0:
+            self.lookahead = TextLookahead(self.generation_queue, int(SETTINGS.get('lookahead_depth', [2])[0]))
+            self.loop.create_task(self.lookahead.run())
+        self.loop.create_task(asyncio.to_thread(IMAGE_WORKERS.start))  # load the models while we log in
+        self.loop.create_task(asyncio.to_thread(LLM_WORKERS.start))
+        self.loop.create_task(asyncio.to_thread(RENDER_WORKERS.start))
+        self.loop.create_task(self.report_worker_stats())
 
     async def on_ready(self):
         """Just prints the bots name to discord"""
         await self.slash_command_tree.sync()  # sync commands to discord
         ready_logger = logger.bind(user=discord_client.user.name, userid=discord_client.user.id)
         ready_logger.info("Discord Login Successful")
+        if not self.journal_replayed:  # on_ready fires again after reconnects
+            self.journal_replayed = True
+            self.loop.create_task(self.replay_journal())
 
     @logger.catch()
     async def on_message(self, message):
@@ -70,111 +113,327 @@ class LightyMTGClient(discord.Client):
                 return
             prompt = re.sub(r'<[^>]+>', '', message.content).lstrip()  # this removes the user tag
             if await self.is_room_in_queue(message.author.id):
-                self.generation_queue_concurrency_list[message.author.id] += 1
                 chat_request = ChatGenerator(prompt, message.channel, message.author)
-                await self.generation_queue.put(chat_request)
-                chat_logger = logger.bind(user=message.author, prompt=prompt)
+                queue_position = await self.enqueue(chat_request, 'chat')
+                chat_logger = logger.bind(user=message.author, prompt=prompt, position=queue_position)
                 chat_logger.info("Chat Queued")
             else:
                 await message.channel.send("Queue limit has been reached, please wait for your previous gens to finish")
 
+    def build_pipeline(self):
+        """Builds the generation pipeline, worker counts per stage come from pipeline_stage_workers. The image stage
+        defaults to one worker per image device. In broker mode the text, image and composite stages are replaced by
+        one render stage that waits on the render nodes."""
+        card_actions = {'lightycard', 'lightycard_three_pack'}
+        stage_workers = dict(item.split(':') for item in
+                             SETTINGS.get('pipeline_stage_workers', ['text:4,composite:2,persist:2,deliver:2'])[0].split(','))
+        queue_size = int(SETTINGS.get('pipeline_queue_size', [2])[0])
+        if self.uses_broker():
+            stages = [
+                PipelineStage('render', self.render_stage, card_actions | {'discord_chat'}, int(stage_workers.get('render', 8)), queue_size)
+            ]
+        else:
+            stages = [
+                PipelineStage('text', self.text_stage, card_actions | {'discord_chat'}, int(stage_workers.get('text', 4)), queue_size),
+                PipelineStage('image', self.image_stage, card_actions, int(stage_workers.get('image', len(IMAGE_WORKERS.workers))), queue_size),
+                PipelineStage('composite', self.composite_stage, card_actions, int(stage_workers.get('composite', 2)), queue_size)
+            ]
+        stages += [
+            PipelineStage('persist', self.persist_stage, card_actions, int(stage_workers.get('persist', 2)), queue_size),
+            PipelineStage('deliver', self.deliver_stage, card_actions | {'discord_chat'}, int(stage_workers.get('deliver', 2)), queue_size)
+        ]
+        return GenerationPipeline(stages, self.finish_request, self.stage_done)
+
+    @staticmethod
+    def uses_broker():
+        """Returns true if generation runs on render nodes behind the job broker instead of in this process"""
+        return SETTINGS.get('render_mode', ['local'])[0] == 'broker'
+
     @logger.catch()
     async def process_queue(self):
-        """This is the primary queue for the bot. Anything that requires state be maintained goes through here"""
+        """This is the primary queue for the bot. It feeds requests into the pipeline as fast as the first stage
+        takes them, requests that need the bottleneck stage only while it has room"""
+        while True:
+            queue_request = await self.generation_queue.get(self.can_admit)
+            if queue_request.action in self.admission_stage.actions:
+                self.admitted.add(id(queue_request))
+            if queue_request.queued_at is not None:
+                METRICS.record_span('queue_wait', time.monotonic() - queue_request.queued_at, queue_request)
+            QUEUE_ESTIMATOR.start(queue_request)
+            await self.pipeline.put(queue_request)
+
+    @staticmethod
+    async def report_worker_stats():
+        """Health checks every model worker and logs its stats, and the output cache hit rates, every
+        worker_stats_interval seconds. Workers that are not running are restarted in the background."""
+        interval = int(SETTINGS.get('worker_stats_interval', [300])[0])
+        wedge_timeout = float(SETTINGS.get('worker_wedge_timeout', [900])[0])
+        revive_tasks = {}
         while True:
-            queue_request = await self.generation_queue.get()
+            await asyncio.sleep(interval)
+            for pool in (IMAGE_WORKERS, LLM_WORKERS, RENDER_WORKERS):
+                healthy = await asyncio.to_thread(pool.health_check, wedge_timeout=wedge_timeout)
+                for worker_name, worker_state in pool.state().items():
+                    logger.bind(worker=worker_name, healthy=healthy[worker_name], **worker_state).info("Worker Stats")
+                if not all(healthy.values()) and (pool.name not in revive_tasks or revive_tasks[pool.name].done()):
+                    revive_tasks[pool.name] = asyncio.create_task(asyncio.to_thread(pool.revive))
+            for output_cache in (TEXT_CACHE, ART_CACHE):
+                if output_cache.enabled:
+                    output_cache.log_state()
+
+    def collect_metrics(self):
+        """Returns the queue, per user and model worker gauges for the metrics endpoint"""
+        samples = []
+        for priority_class, class_state in self.generation_queue.state().items():
+            samples.append(('lighty_queue_depth', {'priority_class': priority_class}, class_state['jobs']))
+        for stage_name, stage_state in self.pipeline.state().items():
+            samples.append(('lighty_pipeline_jobs', {'stage': stage_name, 'state': 'queued'}, stage_state['queued']))
+            samples.append(('lighty_pipeline_jobs', {'stage': stage_name, 'state': 'busy'}, stage_state['busy']))
+        for user_id, in_flight in self.generation_queue_concurrency_list.items():
+            if in_flight:
+                samples.append(('lighty_user_in_flight', {'user_id': user_id}, in_flight))
+        samples.append(('lighty_circuit_breaker_state', {'pool': IMAGE_WORKERS.name}, IMAGE_SUPERVISOR.state()))
+        for action, action_state in QUEUE_ESTIMATOR.state().items():
+            samples.append(('lighty_job_seconds_average', {'action': action}, action_state['average_seconds']))
+        for pool in (IMAGE_WORKERS, LLM_WORKERS, RENDER_WORKERS):
+            for worker in pool.workers:
+                labels = {'worker': worker.name, 'device': worker.device}
+                samples.append(('lighty_worker_busy_seconds_total', labels, round(worker.busy_time(), 3)))
+                samples.append(('lighty_worker_requests_total', labels, worker.requests))
+                samples.append(('lighty_worker_failures_total', labels, worker.failures))
+                samples.append(('lighty_worker_restarts_total', labels, worker.restarts))
+        return samples
+
+    def estimate_queue(self):
+        """Returns (job, seconds until it starts, seconds until it is done) for every running and queued job"""
+        return QUEUE_ESTIMATOR.estimate(self.generation_queue.peek(self.generation_queue.qsize()), self.pipeline.stages)
+
+    def describe_wait(self, queue_request, queue_position):
+        """Returns the queue position and estimated wait of a newly queued request for its ack"""
+        for job, starts_in, done_in in self.estimate_queue():
+            if job is queue_request:
+                return (f'queue position {queue_position}, starts in {format_duration(starts_in)}, '
+                        f'ready in {format_duration(done_in)}')
+        return f'queue position {queue_position}'
+
+    async def enqueue(self, queue_request, priority_class):
+        """Takes up a slot in the user's queue, journals the request and hands it to the scheduler, returns its queue
+        position"""
+        self.generation_queue_concurrency_list[queue_request.user.id] += 1
+        await asyncio.to_thread(JOURNAL.record, queue_request, priority_class)
+        queue_request.queued_at = time.monotonic()
+        return await self.generation_queue.put(queue_request, priority_class)
+
+    def can_admit(self, queue_request):
+        """Returns true if a request can go into the pipeline now. Requests that go through the bottleneck stage, the
+        image stage or the render stage in broker mode, are let in only while fewer than admission_limit of them are
+        on their way to or in it. The rest wait in the scheduler, where their priority still counts."""
+        return queue_request.action not in self.admission_stage.actions or len(self.admitted) < self.admission_limit
+
+    async def release_admission(self, queue_request):
+        """Frees a request's place once it is through the bottleneck stage or has left the pipeline"""
+        if id(queue_request) in self.admitted:
+            self.admitted.discard(id(queue_request))
+            await self.generation_queue.wake()
+
+    async def stage_done(self, queue_request, stage_name, stage_seconds):
+        """Called after every stage a request finishes. Frees its admission once it is through the bottleneck stage,
+        counts the stage time towards the queue estimates and journals the request once it is through a stage that
+        would be expensive to redo"""
+        if stage_name == self.admission_stage.name:
+            await self.release_admission(queue_request)
+        QUEUE_ESTIMATOR.add_stage_time(queue_request, stage_name, stage_seconds)
+        journal_state = JOURNAL_CHECKPOINTS.get(stage_name)
+        if journal_state is not None:
+            await asyncio.to_thread(JOURNAL.checkpoint, queue_request, journal_state)
+
+    async def finish_request(self, queue_request, error):
+        """Called once a request leaves the pipeline, finished or failed, to free its slot in the user's queue"""
+        self.generation_queue_concurrency_list[queue_request.user.id] -= 1
+        await self.release_admission(queue_request)
+        METRICS.increment('lighty_jobs_total', action=queue_request.action,
+                          outcome='failed' if error is not None else 'delivered')
+        QUEUE_ESTIMATOR.finish(queue_request, error)
+        await asyncio.to_thread(JOURNAL.finish, queue_request, error)
+        if error is not None:
+            await self.notify_failure(queue_request, error)
+
+    @staticmethod
+    async def notify_failure(queue_request, error):
+        """Tells the user their request failed instead of leaving them waiting on it"""
+        if isinstance(error, CircuitOpenError):
+            reason = "image generation is down right now, try again in a few minutes"
+        elif isinstance(error, ModelWorkerError) and error.kind == 'bad_input':
+            reason = "that prompt could not be drawn"
+        else:
+            reason = "something went wrong while making it"
+        action_name = ACTION_NAMES.get(queue_request.action, queue_request.action)
+        notice = f"Your {action_name} for `{queue_request.prompt}` failed, {reason}"
+        try:
+            if queue_request.channel is not None:
+                await queue_request.channel.send(f"`{queue_request.user}`: {notice}")
+            if queue_request.user.id == 666:
+                twitch_channel = twitch_client.get_channel("lighty")
+                await twitch_channel.send(f"@{queue_request.user}: {notice}")
+        except Exception as e:
+            logger.bind(user=f'{queue_request.user}', prompt=queue_request.prompt).error(f'EXCEPTION: {e}')
+
+    @logger.catch()
+    async def replay_journal(self):
+        """Puts every request left unfinished by the last run back in line, requests that had passed a checkpoint go
+        straight to the stage after it"""
+        for journal_entry in await asyncio.to_thread(JOURNAL.unfinished):
+            queue_request = await self.restore_request(journal_entry)
+            if queue_request is None:
+                continue
+            user_id = queue_request.user.id
+            self.generation_queue_concurrency_list[user_id] = self.generation_queue_concurrency_list.get(user_id, 0) + 1
+            stage_index = None
+            if journal_entry['state'] == 'text_done':
+                stage_index = self.pipeline.stage_index('deliver' if queue_request.action == 'discord_chat' else 'image')
+            elif journal_entry['state'] == 'image_done':
+                stage_index = self.pipeline.stage_index('composite')
+            replay_logger = logger.bind(user=f'{queue_request.user}', prompt=queue_request.prompt,
+                                        state=journal_entry['state'])
+            replay_logger.info("Job Replayed")
+            if stage_index is None:
+                queue_request.queued_at = time.monotonic()
+                await self.generation_queue.put(queue_request, journal_entry['priority_class'])
+            else:
+                await self.pipeline.put(queue_request, stage_index)
+
+    async def restore_request(self, journal_entry):
+        """Rebuilds a journaled request, with the discord channel and user looked up again. Returns None and marks
+        it failed if either is gone"""
+        try:
+            if journal_entry['user_id'] == 666:
+                user = CustomDiscordUser(journal_entry['user_name'])
+            else:
+                user = self.get_user(journal_entry['user_id']) or await self.fetch_user(journal_entry['user_id'])
+            channel = self.get_channel(journal_entry['channel_id']) or await self.fetch_channel(journal_entry['channel_id'])
+        except discord.DiscordException:
+            user, channel = None, None
+        if journal_entry['action'] == 'discord_chat':
+            queue_request = ChatGenerator(journal_entry['prompt'], channel, user)
+            if journal_entry['checkpoint'] is not None:
+                queue_request.response = journal_entry['checkpoint']['response']
+                queue_request.streamed = journal_entry['checkpoint'].get('streamed', False)
+        else:
+            queue_request = MTGCardGenerator(journal_entry['action'], journal_entry['prompt'], channel, user,
+                                             seed=journal_entry['seed'],
+                                             deterministic=bool(journal_entry['deterministic']))
+            if journal_entry['checkpoint'] is not None:
+                queue_request.load_checkpoint(journal_entry['checkpoint'], journal_entry['images'])
+        queue_request.journal_id = journal_entry['id']
+        if channel is None:
+            await asyncio.to_thread(JOURNAL.finish, queue_request, 'channel or user no longer exists')
+            return None
+        return queue_request
 
+    @staticmethod
+    async def render_stage(queue_request):
+        """Has a render node generate the cards or the chat response"""
+        await BROKER.run(queue_request)
+
+    @staticmethod
+    async def text_stage(queue_request):
+        """Generates the card titles and flavor text, or the chat response"""
+        if queue_request.action == "discord_chat":
+            if queue_request.channel is None:
+                await queue_request.generate_chat()
+                return
+            reply = StreamingReply(queue_request.channel, float(SETTINGS.get('chat_edit_interval', [1.0])[0]))
+            await reply.start()
             try:
-                self.currently_processing = True
-                if queue_request.action == "lightycard":
-
-                    await queue_request.generate_card()
-
-                    with io.BytesIO() as file_object:
-                        queue_request.card.save(file_object, format="PNG")
-                        file_object.seek(0)
-                        filename = f'lighty_mtg_{queue_request.prompt[:20]}.png'
-                        message = await queue_request.channel.send(
-                            content=f"Twitch Card for `{queue_request.user}`: Prompt: `{queue_request.prompt}`",
-                            file=discord.File(file_object, filename=filename, spoiler=True)
-                        )
-
-                    sanitized_prompt = re.sub(r'[<>:"/\\|?*\x00-\x1F]', '', queue_request.prompt)
-                    dir_path = f'users/{queue_request.user}/{queue_request.card_type}.{sanitized_prompt[:20]}.{random.randint(1, 99999999)}.webp'
-                    os.makedirs(os.path.dirname(dir_path), exist_ok=True)
-                    queue_request.card.save(dir_path, format="WEBP")
-
-                    message_link = f"https://discord.com/channels/{message.guild.id}/{message.channel.id}/{message.id}"
-                    if queue_request.user.id == 666:
-                        twitch_channel = twitch_client.get_channel("lighty")
-                        await twitch_channel.send(f"@{queue_request.user}: Your card is ready at: {message_link}")
-
-                    lightycard_logger = logger.bind(user=f'{queue_request.user}', prompt=queue_request.prompt, link=message_link)
-                    lightycard_logger.info("Card Posted")
-
-                if queue_request.action == "lightycard_three_pack":
-                    now = datetime.now()
-                    now_string = now.strftime("%Y%m%d%H%M%S")
-                    sanitized_prompt = re.sub(r'[<>:"/\\|?*\x00-\x1F]', '', queue_request.prompt)
-
-                    await queue_request.generate_card()
-                    dir_path_1 = f'users/{queue_request.user}/{queue_request.card_type}.{sanitized_prompt[:20]}.{random.randint(1, 99999999)}.webp'
-                    card_path_1 = f'users/{queue_request.user}/{now_string}/card1.webp'
-                    os.makedirs(os.path.dirname(dir_path_1), exist_ok=True)
-                    os.makedirs(os.path.dirname(card_path_1), exist_ok=True)
-                    queue_request.card.save(dir_path_1, format="WEBP")
-                    queue_request.card.save(card_path_1, format="WEBP")
-
-                    await queue_request.generate_card()
-                    dir_path_2 = f'users/{queue_request.user}/{queue_request.card_type}.{sanitized_prompt[:20]}.{random.randint(1, 99999999)}.webp'
-                    card_path_2 = f'users/{queue_request.user}/{now_string}/card2.webp'
-                    os.makedirs(os.path.dirname(dir_path_2), exist_ok=True)
-                    os.makedirs(os.path.dirname(card_path_2), exist_ok=True)
-                    queue_request.card.save(dir_path_2, format="WEBP")
-                    queue_request.card.save(card_path_2, format="WEBP")
-
-                    await queue_request.generate_card()
-                    dir_path_3 = f'users/{queue_request.user}/{queue_request.card_type}.{sanitized_prompt[:20]}.{random.randint(1, 99999999)}.webp'
-                    card_path_3 = f'users/{queue_request.user}/{now_string}/card3.webp'
-                    os.makedirs(os.path.dirname(dir_path_1), exist_ok=True)
-                    os.makedirs(os.path.dirname(card_path_3), exist_ok=True)
-                    queue_request.card.save(dir_path_3, format="WEBP")
-                    queue_request.card.save(card_path_3, format="WEBP")
-
-                    message = await queue_request.channel.send(f"# `{queue_request.user}` [OPEN PACK](http://theblackgoat.net/cardflip-dynamic.html?username={queue_request.user}&datetimestring={now_string})")
-                    await queue_request.channel.send(
-                        content=f"Card Pack for `{queue_request.user}`: Prompt: `{queue_request.prompt}`",
-                        files=[discord.File(dir_path_1, filename=f'lighty_mtg_{queue_request.prompt[:20]}.png', spoiler=True),
-                              discord.File(dir_path_2, filename=f'lighty_mtg_{queue_request.prompt[:20]}.png', spoiler=True),
-                              discord.File(dir_path_3, filename=f'lighty_mtg_{queue_request.prompt[:20]}.png', spoiler=True)]
-                    )
-
-                    if queue_request.user.id == 666:
-                        message_link = f"https://discord.com/channels/{message.guild.id}/{message.channel.id}/{message.id}"
-                        twitch_channel = twitch_client.get_channel("lighty")
-                        await twitch_channel.send(f"@{queue_request.user}: Your pack is ready at: {message_link}")
-
-                    logger.info("Pack created")
-
-
-                if queue_request.action == "discord_chat":
-                    await queue_request.generate_chat()
-                    for i in range(0, len(queue_request.response), 2000):
-                        chunk = queue_request.response[i:i + 2000]
-                        await queue_request.channel.send(content=chunk, mention_author=True)
-                    generate_chat_logger = logger.bind(user=queue_request.user, prompt=queue_request.prompt)
-                    generate_chat_logger.info("Chat responded")
-
-
-            except Exception as e:
-                self.generation_queue_concurrency_list[queue_request.user.id] -= 1
-                logger.error(f'EXCEPTION: {e}')
-            finally:
-                self.generation_queue_concurrency_list[queue_request.user.id] -= 1
-                self.generation_queue.task_done()
-                gc.collect()
-                torch.cuda.empty_cache()
-                self.currently_processing = False
+                await queue_request.stream_chat(reply.append)
+            except Exception:
+                try:
+                    await reply.abort()
+                except discord.DiscordException:
+                    pass  # the generation error is the one worth reporting
+                raise
+            await reply.finish()
+        else:
+            await queue_request.generate_card_texts()
+
+    @staticmethod
+    async def image_stage(queue_request):
+        """Generates the card art"""
+        await queue_request.generate_card_images()
+
+    @staticmethod
+    async def composite_stage(queue_request):
+        """Composites the cards"""
+        await queue_request.composite_cards()
+
+    @staticmethod
+    async def persist_stage(queue_request):
+        """Encodes the cards once, stores and indexes them in the card archive and keeps the bytes to upload to
+        discord. Pack cards are also linked at users/{user}/{pack}/ where the pack viewer looks for them."""
+        if queue_request.action == "lightycard":
+            png_data, _ = await asyncio.gather(
+                CARD_ARCHIVE.encode_card(queue_request.card, "PNG"),
+                CARD_ARCHIVE.save(queue_request, "WEBP")
+            )
+            queue_request.upload_files = [(png_data, f'lighty_mtg_{queue_request.prompt[:20]}.png')]
+
+        if queue_request.action == "lightycard_three_pack":
+            now = datetime.now()
+            queue_request.pack_string = now.strftime("%Y%m%d%H%M%S")
+            pack_id = f'{queue_request.user}/{queue_request.pack_string}'
+            card_data = await asyncio.gather(*(
+                CARD_ARCHIVE.save(pack_card, "WEBP", pack_id, card_number,
+                                  [f'users/{queue_request.user}/{queue_request.pack_string}/card{card_number}.webp'])
+                for card_number, pack_card in enumerate(queue_request.pack, start=1)))
+            queue_request.upload_files = [(data, f'lighty_mtg_{queue_request.prompt[:20]}.png') for data in card_data]
+
+    async def deliver_stage(self, queue_request):
+        """Posts the result to discord and lets twitch redeemers know where to find it"""
+        if queue_request.action == "lightycard":
+            file_data, filename = queue_request.upload_files[0]
+            with METRICS.span('discord_upload', queue_request):
+                message = await queue_request.channel.send(
+                    content=f"Twitch Card for `{queue_request.user}`: Prompt: `{queue_request.prompt}`",
+                    file=discord.File(io.BytesIO(file_data), filename=filename, spoiler=True)
+                )
+
+            message_link = f"https://discord.com/channels/{message.guild.id}/{message.channel.id}/{message.id}"
+            if queue_request.user.id == 666:
+                twitch_channel = twitch_client.get_channel("lighty")
+                with METRICS.span('twitch_notify', queue_request):
+                    await twitch_channel.send(f"@{queue_request.user}: Your card is ready at: {message_link}")
+
+            lightycard_logger = logger.bind(user=f'{queue_request.user}', prompt=queue_request.prompt, link=message_link)
+            lightycard_logger.info("Card Posted")
+
+        if queue_request.action == "lightycard_three_pack":
+            message = await queue_request.channel.send(f"# `{queue_request.user}` [OPEN PACK](http://theblackgoat.net/cardflip-dynamic.html?username={queue_request.user}&datetimestring={queue_request.pack_string})")
+            with METRICS.span('discord_upload', queue_request):
+                await queue_request.channel.send(
+                    content=f"Card Pack for `{queue_request.user}`: Prompt: `{queue_request.prompt}`",
+                    files=[discord.File(io.BytesIO(file_data), filename=filename, spoiler=True)
+                           for file_data, filename in queue_request.upload_files]
+                )
+
+            if queue_request.user.id == 666:
+                message_link = f"https://discord.com/channels/{message.guild.id}/{message.channel.id}/{message.id}"
+                twitch_channel = twitch_client.get_channel("lighty")
+                with METRICS.span('twitch_notify', queue_request):
+                    await twitch_channel.send(f"@{queue_request.user}: Your pack is ready at: {message_link}")
+
+            logger.info("Pack created")
+
+        if queue_request.action == "discord_chat":
+            if not queue_request.streamed:  # replayed from the journal or run on a render node
+                for i in range(0, len(queue_request.response), 2000):
+                    chunk = queue_request.response[i:i + 2000]
+                    await queue_request.channel.send(content=chunk, mention_author=True)
+            ttft_ms = None
+            if queue_request.time_to_first_token is not None:
+                ttft_ms = round(queue_request.time_to_first_token * 1000)
+                METRICS.observe('lighty_chat_ttft_seconds', queue_request.time_to_first_token)
+            generate_chat_logger = logger.bind(user=queue_request.user, prompt=queue_request.prompt, ttft_ms=ttft_ms)
+            generate_chat_logger.info("Chat responded")
 
     async def is_room_in_queue(self, user_id):
         """This checks the users current number of pending gens against the max,
@@ -283,8 +542,11 @@ async def event_pubsub_channel_points(event: pubsub.PubSubChannelPointsMessage):
         pubsub_logger = logger.bind(user=event.user.name, prompt=event.input)
         pubsub_logger.info(f'Twitch card reward redeemed')
         if await discord_client.is_room_in_queue(666):
-            discord_client.generation_queue_concurrency_list[666] += 1
-            await discord_client.generation_queue.put(mtg_card_request)
+            queue_position = await discord_client.enqueue(mtg_card_request, 'twitch')
+            pubsub_logger.bind(position=queue_position).info(f'Card Queued')
+            twitch_channel = twitch_client.get_channel("lighty")
+            await twitch_channel.send(f"@{event.user.name}: Your pack is in line, "
+                                      f"{discord_client.describe_wait(mtg_card_request, queue_position)}")
 
 
 @twitch_client.event()
@@ -297,41 +559,60 @@ async def event_ready():
 
 
 @discord_client.slash_command_tree.command(description="This generates lighty mtg cards")
-async def lighty_mtg(interaction: discord.Interaction, prompt: str):
+async def lighty_mtg(interaction: discord.Interaction, prompt: str, fresh: bool = False):
     """This is the slash command to generate a card."""
     if not await discord_client.is_enabled_not_banned("enable_bot_actions", interaction.user):
         await interaction.response.send_message("Disabled or user banned", ephemeral=True, delete_after=5)
         return
 
-    mtg_card_request = MTGCardGenerator('lightycard', prompt, interaction.channel, interaction.user)
+    mtg_card_request = MTGCardGenerator('lightycard', prompt, interaction.channel, interaction.user, fresh)
 
     if await discord_client.is_room_in_queue(interaction.user.id):
-        card_queue_logger = logger.bind(user=interaction.user.name, prompt=prompt)
+        queue_position = await discord_client.enqueue(mtg_card_request, 'card')
+        card_queue_logger = logger.bind(user=interaction.user.name, prompt=prompt, position=queue_position)
         card_queue_logger.info(f'Card Queued')
-        discord_client.generation_queue_concurrency_list[interaction.user.id] += 1
-        await discord_client.generation_queue.put(mtg_card_request)
-        await interaction.response.send_message('Card Being Created:', ephemeral=True, delete_after=5)
+        await interaction.response.send_message(f'Card Being Created: {discord_client.describe_wait(mtg_card_request, queue_position)}', ephemeral=True, delete_after=5)
     else:
         await interaction.response.send_message("Queue limit reached, please wait until your current gen or gens finish")
 
 @discord_client.slash_command_tree.command(description="This generates lighty mtg cards")
-async def lighty_mtg_three_pack(interaction: discord.Interaction, prompt: str):
+async def lighty_mtg_three_pack(interaction: discord.Interaction, prompt: str, fresh: bool = False):
     """This is the slash command to generate a card."""
     if not await discord_client.is_enabled_not_banned("enable_bot_actions", interaction.user):
         await interaction.response.send_message("Disabled or user banned", ephemeral=True, delete_after=5)
         return
 
-    mtg_card_request = MTGCardGenerator('lightycard_three_pack', prompt, interaction.channel, interaction.user)
+    mtg_card_request = MTGCardGenerator('lightycard_three_pack', prompt, interaction.channel, interaction.user, fresh)
 
     if await discord_client.is_room_in_queue(interaction.user.id):
-        card_queue_logger = logger.bind(user=interaction.user.name, prompt=prompt)
+        queue_position = await discord_client.enqueue(mtg_card_request, 'card')
+        card_queue_logger = logger.bind(user=interaction.user.name, prompt=prompt, position=queue_position)
         card_queue_logger.info(f'Card Queued')
-        discord_client.generation_queue_concurrency_list[interaction.user.id] += 1
-        await discord_client.generation_queue.put(mtg_card_request)
-        await interaction.response.send_message('Card Being Created:', ephemeral=True, delete_after=5)
+        await interaction.response.send_message(f'Card Being Created: {discord_client.describe_wait(mtg_card_request, queue_position)}', ephemeral=True, delete_after=5)
     else:
         await interaction.response.send_message("Queue limit reached, please wait until your current gen or gens finish")
 
+
+@discord_client.slash_command_tree.command(description="Shows how long the queue is and when your gens will be ready")
+async def queue(interaction: discord.Interaction):
+    """This is the slash command to check the queue."""
+    estimates = discord_client.estimate_queue()
+    running = len(estimates) - discord_client.generation_queue.qsize()
+    lines = [f'{len(estimates) - running} waiting, {running} being made']
+    for position, (job, starts_in, done_in) in enumerate(estimates, start=1 - running):
+        if job.user.id != interaction.user.id:
+            continue
+        action_name = ACTION_NAMES.get(job.action, job.action)
+        if position < 1:
+            lines.append(f'Your {action_name} `{job.prompt[:40]}` is being made, ready in {format_duration(done_in)}')
+        else:
+            lines.append(f'Your {action_name} `{job.prompt[:40]}` is #{position} in line, starts in '
+                         f'{format_duration(starts_in)}, ready in {format_duration(done_in)}')
+    if len(lines) == 1:
+        lines.append('You have nothing in the queue')
+    await interaction.response.send_message('\n'.join(lines), ephemeral=True)
+
+
 async def start_clients():
     """Spin off clients to threads and start them"""
     twitch_client.pubsub = MyPubSubPool(twitch_client)
@@ -358,6 +639,11 @@ def run_program():
         loop.run_until_complete(twitch_exit_notice())
 
     finally:
+        IMAGE_WORKERS.stop()
+        LLM_WORKERS.stop()
+        RENDER_WORKERS.stop()
+        CARD_ARCHIVE.close()
+        JOURNAL.close()
         loop.close()
 
 
@@ -0,0 +1,132 @@
+"""Decodes the card templates, icons, foils and fonts once and shares them between every card that gets built"""
+import os
+import threading
+from loguru import logger
+from PIL import Image, ImageChops, ImageFont
+
+FONT_FILES = {
+    'garamond': 'assets/fonts/garamond.ttf',
+    'garamondbullet': 'assets/fonts/garamondbullet.ttf',
+    'garamonditalic': 'assets/fonts/garamonditalic.ttf',
+    'planewalker': 'assets/fonts/planewalker.otf'
+}
+PRELOADED_FONTS = [
+    ('garamond', 20),
+    ('garamond', 32),
+    ('garamond', 36),
+    ('garamondbullet', 36),
+    ('garamonditalic', 36),
+    ('planewalker', 36),
+    ('planewalker', 44)
+]
+
+
+class AssetCache:
+    """Process wide registry of decoded card assets. Templates are handed out as copies since cards are drawn onto
+    them, icons and foils are shared and must only ever be pasted from."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.templates = {}
+        self.icons = {}
+        self.foils = {}
+        self.fonts = {}
+        self.foil_overlays = {}
+        self.foil_overlay_crops = {}
+        self.foiled_templates = {}
+
+    def load(self):
+        """Decodes every asset, does nothing if they are already loaded"""
+        with self.lock:
+            if self.loaded:
+                return
+            self.templates = self.load_image_dir('assets/templates')
+            self.icons = self.load_image_dir('assets/icons')
+            self.foils = self.load_image_dir('assets/foils')
+            self.fonts = {}
+            for font_name, font_size in PRELOADED_FONTS:
+                self.fonts[(font_name, font_size)] = ImageFont.truetype(FONT_FILES[font_name], font_size)
+            self.foil_overlays = {}
+            self.foil_overlay_crops = {}
+            self.foiled_templates = {}
+            for size in {template.size for template in self.templates.values()}:
+                for foil_name in self.foils:
+                    if foil_name.startswith('foil'):
+                        self.foil_overlays[(foil_name, size)] = self.foils[foil_name].convert("RGBA").resize(size)
+            self.loaded = True
+        asset_logger = logger.bind(templates=len(self.templates), icons=len(self.icons), foils=len(self.foils),
+                                   fonts=len(self.fonts), megabytes=round(self.memory_usage() / 1048576, 1))
+        asset_logger.info("Assets Loaded")
+
+    def reload(self):
+        """Throws away everything decoded so far and loads the assets from disk again"""
+        with self.lock:
+            self.loaded = False
+        self.load()
+
+    @staticmethod
+    def load_image_dir(directory):
+        """Returns every png in a directory decoded into memory, keyed by file name without the extension"""
+        images = {}
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.endswith('.png'):
+                with Image.open(os.path.join(directory, file_name)) as image:
+                    image.load()
+                    images[file_name[:-4]] = image.copy()
+        return images
+
+    def template(self, name):
+        """Returns a copy of a card template that is safe to draw on"""
+        self.load()
+        return self.templates[name].copy()
+
+    def icon(self, name):
+        """Returns a shared icon image"""
+        self.load()
+        return self.icons[name]
+
+    def foil(self, name):
+        """Returns a shared foil or signature texture"""
+        self.load()
+        return self.foils[name]
+
+    def foil_overlay(self, name, size):
+        """Returns a shared foil texture already converted to RGBA and resized to the card size"""
+        self.load()
+        if (name, size) not in self.foil_overlays:
+            self.foil_overlays[(name, size)] = self.foils[name].convert("RGBA").resize(size)
+        return self.foil_overlays[(name, size)]
+
+    def foil_overlay_crop(self, name, size, box):
+        """Returns the part of a foil overlay under box, cropped once and shared"""
+        if (name, size, box) not in self.foil_overlay_crops:
+            self.foil_overlay_crops[(name, size, box)] = self.foil_overlay(name, size).crop(box)
+        return self.foil_overlay_crops[(name, size, box)]
+
+    def foiled_template(self, template_name, foil_name):
+        """Returns a copy of a template with the foil already soft light blended over it"""
+        self.load()
+        if (template_name, foil_name) not in self.foiled_templates:
+            template = self.templates[template_name]
+            self.foiled_templates[(template_name, foil_name)] = ImageChops.soft_light(
+                template, self.foil_overlay(foil_name, template.size))
+        return self.foiled_templates[(template_name, foil_name)].copy()
+
+    def font(self, name, size):
+        """Returns a font at the given size, loading and caching sizes that were not preloaded"""
+        self.load()
+        if (name, size) not in self.fonts:
+            self.fonts[(name, size)] = ImageFont.truetype(FONT_FILES[name], size)
+        return self.fonts[(name, size)]
+
+    def memory_usage(self):
+        """Returns roughly how many bytes the decoded images and font files take up"""
+        image_bytes = sum(image.width * image.height * len(image.getbands())
+                          for images in (self.templates, self.icons, self.foils, self.foil_overlays,
+                                         self.foil_overlay_crops, self.foiled_templates)
+                          for image in images.values())
+        font_bytes = sum(os.path.getsize(FONT_FILES[font_name]) for font_name, _ in self.fonts)
+        return image_bytes + font_bytes
+
+
+ASSETS = AssetCache()
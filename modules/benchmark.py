@@ -0,0 +1,231 @@
+"""Offline benchmark of the card pipeline. The model workers run the fake image and stub text backends, so no gpu is
+needed and the numbers only cover this project's own code: the rolls, template copies, every paste step, the encodes
+and whole cards end to end per card type and per three pack.
+
+Run `python -m modules.benchmark [--output results.json] [--baseline old.json]` from the project root. The results
+are written as json, with a baseline every stage is compared against the same stage in it and the run exits non zero
+if any got slower than the threshold allows."""
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+from datetime import datetime
+from modules.settings import SETTINGS
+
+# the worker pools, batcher and caches read these when they are imported, so they are set before anything else loads
+SETTINGS.update(image_backend=['fake'], llm_backend=['stub'], image_devices=['cpu'], llm_devices=['cpu'],
+                output_cache=['False'])
+
+from loguru import logger  # noqa: E402
+from PIL import Image  # noqa: E402
+from modules.assets import ASSETS  # noqa: E402
+from modules.card_archive import CardArchive  # noqa: E402
+from modules.card_data import load_card_data  # noqa: E402
+from modules.card_renderer import (paste_ability, paste_artist_copyright, paste_creature_card_atk_def,  # noqa: E402
+                                   paste_foil, paste_land_abilities, paste_mana, paste_title_text, paste_type,
+                                   render_card)
+from modules.generate_card_art import FakeImageBackend  # noqa: E402
+from modules.model_worker import IMAGE_WORKERS, LLM_WORKERS, RENDER_WORKERS  # noqa: E402
+from modules.mtg_generator import MTGCardGenerator  # noqa: E402
+
+PROMPT = 'a goat wearing a crown in a thunderstorm'
+TITLE = 'Stormcrown Goat'
+FLAVOR_TEXT = 'The herd never asked who crowned him. The lightning never asked permission.'
+NOISE_FLOOR_MS = 0.05  # slowdowns smaller than this are timer noise on the cheapest stages
+
+
+def summarize(durations):
+    """Returns the timing stats of a list of durations in seconds"""
+    durations = sorted(durations)
+    return {
+        'iterations': len(durations),
+        'mean_ms': round(sum(durations) / len(durations) * 1000, 4),
+        'p50_ms': round(durations[len(durations) // 2] * 1000, 4),
+        'p95_ms': round(durations[min(len(durations) - 1, int(len(durations) * 0.95))] * 1000, 4),
+        'min_ms': round(durations[0] * 1000, 4)
+    }
+
+
+def time_calls(function, arguments):
+    """Calls function once per entry in arguments, built outside the timed section, and returns the durations"""
+    durations = []
+    for argument in arguments:
+        start = time.perf_counter()
+        function(*argument)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def find_seeds(cards_per_type):
+    """Returns seeds grouped by the card type they roll, cards_per_type of each. Every card type has a template."""
+    seeds = {}
+    seed = 0
+    card_types = len(ASSETS.templates)
+    while len(seeds) < card_types or min(len(type_seeds) for type_seeds in seeds.values()) < cards_per_type:
+        card = MTGCardGenerator('lightycard', PROMPT, None, 'benchmark', seed=seed)
+        card.roll_card()
+        type_seeds = seeds.setdefault(card.card_type, [])
+        if len(type_seeds) < cards_per_type:
+            type_seeds.append(seed)
+        seed += 1
+    return dict(sorted(seeds.items()))
+
+
+def build_specs(seeds):
+    """Returns a finished card spec for every seed, with fixed text and fake art"""
+    image_backend = FakeImageBackend()
+    image_backend.inference_seconds = 0
+    specs = []
+    for seed in seeds:
+        card = MTGCardGenerator('lightycard', PROMPT, None, 'benchmark', seed=seed)
+        card.roll_card()
+        card.card_title, card.card_flavor_text = TITLE, FLAVOR_TEXT
+        art = image_backend.generate(card.get_image_prompt(), seed)
+        specs.append(card.build_card_spec(art))
+    return specs
+
+
+def benchmark_stages(seeds_by_type, iterations):
+    """Times each step of building a card in this process, cycling through every card type"""
+    seeds = [seed for type_seeds in seeds_by_type.values() for seed in type_seeds]
+    seeds = (seeds * (iterations // len(seeds) + 1))[:iterations]
+    specs = build_specs(seeds)
+    cards = [MTGCardGenerator('lightycard', PROMPT, None, 'benchmark', seed=seed) for seed in seeds]
+    land_specs = [spec for spec in specs if spec['land_mana_icon'] is not None]
+    spell_specs = [spec for spec in specs if spec['land_mana_icon'] is None]
+    creature_specs = [spec for spec in spell_specs if spec['atk_def'] is not None]
+
+    def templates(card_specs):
+        return [ASSETS.template(spec['card_type']) for spec in card_specs]
+
+    def art_box(spec):
+        return 88, 102, 88 + spec['art'].width, 102 + spec['art'].height
+
+    stages = {
+        'roll_card': time_calls(MTGCardGenerator.roll_card, [(card,) for card in cards]),
+        'roll_foil': time_calls(MTGCardGenerator.roll_foil, [(card,) for card in cards]),
+        'build_card_spec': time_calls(MTGCardGenerator.build_card_spec,
+                                      [(card, spec['art']) for card, spec in zip(cards, specs)]),
+        'load_card_template': time_calls(ASSETS.template, [(spec['card_type'],) for spec in specs]),
+        'paste_foil': time_calls(paste_foil, [(template, spec['card_type'], 'foil1', art_box(spec))
+                                              for template, spec in zip(templates(specs), specs)]),
+        'paste_set_icon': time_calls(paste_foil, [(template, spec['card_type'], None, art_box(spec))
+                                                  for template, spec in zip(templates(specs), specs)]),
+        'paste_title_text': time_calls(paste_title_text, [(template, spec['title'])
+                                                          for template, spec in zip(templates(specs), specs)]),
+        'paste_artist_copyright': time_calls(paste_artist_copyright,
+                                             [(template, spec['artist'], spec['user'])
+                                              for template, spec in zip(templates(specs), specs)]),
+        'paste_type': time_calls(paste_type, [(template, spec['type_line'])
+                                              for template, spec in zip(templates(specs), specs)]),
+        'paste_mana': time_calls(paste_mana, [(template, spec['mana_slot_icon'], spec['mana_slots'])
+                                              for template, spec in zip(templates(spell_specs), spell_specs)]),
+        'paste_ability': time_calls(paste_ability, [(template, spec['ability_tokens'], spec['flavor_text'])
+                                                    for template, spec in zip(templates(spell_specs), spell_specs)]),
+        'render_card': time_calls(render_card, [(spec,) for spec in specs])
+    }
+    if land_specs:
+        stages['paste_land_abilities'] = time_calls(
+            paste_land_abilities,
+            [(template, spec['land_mana_icon'], spec['flavor_text'])
+             for template, spec in zip(templates(land_specs), land_specs)])
+    if creature_specs:
+        stages['paste_creature_card_atk_def'] = time_calls(
+            paste_creature_card_atk_def,
+            [(template, spec['atk_def']) for template, spec in zip(templates(creature_specs), creature_specs)])
+    rendered_cards = [Image.frombytes(*render_card(spec)) for spec in specs[:max(1, iterations // 5)]]
+    for image_format in ('PNG', 'WEBP'):
+        stages[f'encode_{image_format.lower()}'] = [CardArchive.encode(card, image_format)[1]
+                                                    for card in rendered_cards]
+    return {name: summarize(durations) for name, durations in stages.items()}
+
+
+async def benchmark_cards(seeds_by_type, packs):
+    """Times whole cards through the model and render workers, one card at a time per card type and then three
+    packs, and returns the per card stats"""
+    throughput = {}
+    for card_type, seeds in seeds_by_type.items():
+        durations = []
+        for seed in seeds:
+            card_request = MTGCardGenerator('lightycard', PROMPT, None, 'benchmark', seed=seed)
+            start = time.perf_counter()
+            await card_request.generate_card()
+            durations.append(time.perf_counter() - start)
+            if card_request.card is None:
+                raise RuntimeError(f'card with seed {seed} failed to generate')
+        throughput[f'card:{card_type}'] = summarize(durations)
+    durations = []
+    for seed in range(packs):
+        pack_request = MTGCardGenerator('lightycard_three_pack', PROMPT, None, 'benchmark', seed=seed)
+        start = time.perf_counter()
+        await pack_request.generate_card()
+        durations.append((time.perf_counter() - start) / len(pack_request.pack))
+        if any(card.card is None for card in pack_request.pack):
+            raise RuntimeError(f'pack with seed {seed} failed to generate')
+    throughput['three_pack_per_card'] = summarize(durations)
+    for stats in throughput.values():
+        stats['cards_per_second'] = round(1000 / stats['mean_ms'], 2)
+    return throughput
+
+
+def find_regressions(results, baseline, threshold):
+    """Returns a line for every stage whose median got slower than the baseline's by more than threshold"""
+    regressions = []
+    for section in ('stages', 'throughput'):
+        for name, stats in results[section].items():
+            baseline_stats = baseline.get(section, {}).get(name)
+            if baseline_stats is None:
+                continue
+            allowed_ms = max(baseline_stats['p50_ms'] * (1 + threshold), baseline_stats['p50_ms'] + NOISE_FLOOR_MS)
+            if stats['p50_ms'] > allowed_ms:
+                regressions.append(f"{section}.{name}: {stats['p50_ms']}ms against {baseline_stats['p50_ms']}ms")
+    return regressions
+
+
+async def main(arguments):
+    """Runs the benchmark, writes the results and checks them against the baseline"""
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+    load_card_data()
+    ASSETS.load()
+    seeds_by_type = find_seeds(arguments.cards_per_type)
+    results = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.platform(),
+        'iterations': arguments.iterations,
+        'stages': benchmark_stages(seeds_by_type, arguments.iterations)
+    }
+    for pool in (IMAGE_WORKERS, LLM_WORKERS, RENDER_WORKERS):
+        pool.start()
+    try:
+        results['throughput'] = await benchmark_cards(seeds_by_type, arguments.packs)
+    finally:
+        for pool in (IMAGE_WORKERS, LLM_WORKERS, RENDER_WORKERS):
+            pool.stop()
+    output = json.dumps(results, indent=2)
+    if arguments.output:
+        with open(arguments.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+    if arguments.baseline:
+        with open(arguments.baseline, 'r', encoding='utf-8') as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), arguments.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the card pipeline with fake model backends')
+    parser.add_argument('--output', help='write the json results here instead of stdout')
+    parser.add_argument('--baseline', help='json results of an earlier run to check for regressions against')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown, 0.25 is 25%%')
+    parser.add_argument('--iterations', type=int, default=100, help='runs of each in process stage')
+    parser.add_argument('--cards-per-type', type=int, default=3, help='whole cards built per card type')
+    parser.add_argument('--packs', type=int, default=5, help='three packs built')
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,261 @@
+"""Saves finished cards to the card archive. Images are stored once under a path made from the sha256 of their bytes,
+sharded by the first two byte pairs of the hash, and every card's metadata goes into a SQLite index so a user's cards,
+a pack or a date range is an indexed query instead of a directory scan.
+
+Each card is encoded once per format and the same bytes are written to, or hardlinked at, every path the card belongs
+at and handed to the discord upload.
+
+Run `python -m modules.card_archive import [users_dir]` once to index the cards saved in the old flat users/ tree."""
+import asyncio
+import hashlib
+import io
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+from loguru import logger
+from modules.metrics import METRICS
+from modules.settings import SETTINGS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cards (
+    id INTEGER PRIMARY KEY,
+    sha256 TEXT NOT NULL UNIQUE,
+    path TEXT NOT NULL,
+    user TEXT NOT NULL,
+    user_id INTEGER,
+    prompt TEXT,
+    card_type TEXT,
+    title TEXT,
+    flavor_text TEXT,
+    artist TEXT,
+    foil TEXT,
+    signed INTEGER NOT NULL DEFAULT 0,
+    pack_id TEXT,
+    pack_card INTEGER,
+    seed INTEGER,
+    deterministic INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    archived_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cards_user ON cards (user, created_at);
+CREATE INDEX IF NOT EXISTS cards_pack ON cards (pack_id, pack_card);
+CREATE INDEX IF NOT EXISTS cards_created ON cards (created_at);
+"""
+CARD_COLUMNS = ('sha256', 'path', 'user', 'user_id', 'prompt', 'card_type', 'title', 'flavor_text', 'artist', 'foil',
+                'signed', 'pack_id', 'pack_card', 'seed', 'deterministic', 'created_at', 'archived_at')
+ADDED_COLUMNS = {'seed': 'INTEGER', 'deterministic': 'INTEGER NOT NULL DEFAULT 0'}
+PACK_DIR_PATTERN = re.compile(r'^\d{14}$')
+PACK_CARD_PATTERN = re.compile(r'^card(\d+)\.webp$')
+FLAT_CARD_PATTERN = re.compile(r'^([a-z_]+)\.(.*)\.\d+\.webp$', re.DOTALL)
+
+
+class CardArchive:
+    """Encodes and writes cards off the event loop, a pack's cards encode in parallel threads since PIL releases the
+    GIL while encoding. The index connection is shared between threads behind a lock."""
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def open(self):
+        """Opens the index, creating it if needed, does nothing if it is already open"""
+        with self.lock:
+            if self.connection is not None:
+                return
+            os.makedirs(self.root, exist_ok=True)
+            self.connection = sqlite3.connect(os.path.join(self.root, 'cards.db'), check_same_thread=False)
+            self.connection.row_factory = sqlite3.Row
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.executescript(SCHEMA)
+            existing_columns = {row['name'] for row in self.connection.execute('PRAGMA table_info(cards)')}
+            for column, column_type in ADDED_COLUMNS.items():
+                if column not in existing_columns:  # archives from before the column existed
+                    self.connection.execute(f'ALTER TABLE cards ADD COLUMN {column} {column_type}')
+        logger.bind(root=self.root, cards=self.count()).info("Card Archive Opened")
+
+    def close(self):
+        """Closes the index"""
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def card_path(self, digest, extension):
+        """Returns where the image with this hash is stored, sharded so no directory gets huge"""
+        return os.path.join(self.root, 'cards', digest[:2], digest[2:4], f'{digest}.{extension}')
+
+    @staticmethod
+    def encode(card, image_format):
+        """Returns the card encoded in the given format and how long that took in seconds"""
+        start = time.perf_counter()
+        with io.BytesIO() as file_object:
+            card.save(file_object, format=image_format)
+            return file_object.getvalue(), time.perf_counter() - start
+
+    @staticmethod
+    def write(data, paths):
+        """Writes the bytes to the first path and hardlinks the rest to it, copying instead where links are not
+        supported. The first path is content addressed, so if it already exists it already holds these bytes.
+        Returns how long that took in seconds"""
+        start = time.perf_counter()
+        first_path = paths[0]
+        for path in paths:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.exists(first_path):
+            temp_path = f'{first_path}.{threading.get_ident()}.tmp'
+            with open(temp_path, 'wb') as card_file:
+                card_file.write(data)
+            os.replace(temp_path, first_path)  # a half written card is never visible under its real name
+        for path in paths[1:]:
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+                os.link(first_path, path)
+            except OSError:
+                with open(path, 'wb') as card_file:
+                    card_file.write(data)
+        return time.perf_counter() - start
+
+    async def encode_card(self, card, image_format):
+        """Encodes a card without archiving it and returns the bytes, for uploads in a format that is not kept"""
+        data, encode_time = await asyncio.to_thread(self.encode, card, image_format)
+        METRICS.record_span('encode', encode_time)
+        logger.bind(format=image_format, kilobytes=round(len(data) / 1024, 1),
+                    encode_ms=round(encode_time * 1000, 1)).info("Card Encoded")
+        return data
+
+    async def save(self, card_generator, image_format, pack_id=None, pack_card=None, links=()):
+        """Encodes a card once, stores it under its hash, links it at any extra paths, indexes its metadata and
+        returns the encoded bytes"""
+        data, encode_time = await asyncio.to_thread(self.encode, card_generator.card, image_format)
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.card_path(digest, image_format.lower())
+        write_time = await asyncio.to_thread(self.write, data, [path, *links])
+        METRICS.record_span('encode', encode_time, card_generator)
+        METRICS.record_span('disk_write', write_time, card_generator)
+        user = card_generator.user
+        now = datetime.now().isoformat(timespec='seconds')
+        await asyncio.to_thread(self.add_card, {
+            'sha256': digest,
+            'path': path,
+            'user': str(user),
+            'user_id': getattr(user, 'id', None),
+            'prompt': card_generator.prompt,
+            'card_type': card_generator.card_type,
+            'title': card_generator.card_title,
+            'flavor_text': card_generator.card_flavor_text,
+            'artist': card_generator.card_artist,
+            'foil': card_generator.card_foil,
+            'signed': int(card_generator.card_signed),
+            'pack_id': pack_id,
+            'pack_card': pack_card,
+            'seed': card_generator.seed,
+            'deterministic': int(card_generator.deterministic),
+            'created_at': now,
+            'archived_at': now
+        })
+        archive_logger = logger.bind(format=image_format, kilobytes=round(len(data) / 1024, 1), sha256=digest[:12],
+                                     links=len(links), encode_ms=round(encode_time * 1000, 1),
+                                     write_ms=round(write_time * 1000, 1))
+        archive_logger.info("Card Archived")
+        return data
+
+    def add_card(self, record):
+        """Indexes a card. If the image is already indexed the blanks in its row are filled in from the record and the
+        earlier creation time is kept, which is how the importer merges a pack copy with the flat copy of a card"""
+        self.open()
+        columns = ', '.join(CARD_COLUMNS)
+        placeholders = ', '.join(f':{column}' for column in CARD_COLUMNS)
+        updates = ', '.join([f'{column} = COALESCE({column}, excluded.{column})'
+                             for column in CARD_COLUMNS if column not in ('sha256', 'path', 'user', 'created_at',
+                                                                          'archived_at', 'signed', 'deterministic')]
+                            + ['created_at = MIN(created_at, excluded.created_at)'])
+        with self.lock:
+            with self.connection:
+                self.connection.execute(f'INSERT INTO cards ({columns}) VALUES ({placeholders}) '
+                                        f'ON CONFLICT (sha256) DO UPDATE SET {updates}',
+                                        {column: record.get(column) for column in CARD_COLUMNS})
+
+    def query(self, sql, parameters=()):
+        """Runs a read query against the index and returns the rows as dicts"""
+        self.open()
+        with self.lock:
+            return [dict(row) for row in self.connection.execute(sql, parameters)]
+
+    def count(self):
+        """Returns how many cards are indexed"""
+        return self.query('SELECT COUNT(*) AS cards FROM cards')[0]['cards']
+
+    def cards_by_user(self, user, limit=100):
+        """Returns a user's newest cards"""
+        return self.query('SELECT * FROM cards WHERE user = ? ORDER BY created_at DESC LIMIT ?', (str(user), limit))
+
+    def cards_in_pack(self, pack_id):
+        """Returns the cards of a pack in pack order"""
+        return self.query('SELECT * FROM cards WHERE pack_id = ? ORDER BY pack_card', (pack_id,))
+
+    def cards_between(self, start, end, limit=1000):
+        """Returns the cards created from start up to but not including end, both datetimes"""
+        return self.query('SELECT * FROM cards WHERE created_at >= ? AND created_at < ? ORDER BY created_at LIMIT ?',
+                          (start.isoformat(timespec='seconds'), end.isoformat(timespec='seconds'), limit))
+
+    def import_tree(self, users_dir='users'):
+        """Indexes every card in the old users/{user}/ tree and copies it into the archive, the old files are left
+        where they are. Flat cards carry the card type and the start of the prompt in their name, pack cards carry
+        the pack and their place in it, a card saved both ways ends up as one row with both."""
+        self.open()
+        imported = 0
+        for user in sorted(os.listdir(users_dir)):
+            user_dir = os.path.join(users_dir, user)
+            if not os.path.isdir(user_dir):
+                continue
+            for dir_path, _, file_names in os.walk(user_dir):
+                pack_string = os.path.basename(dir_path) if dir_path != user_dir else None
+                for file_name in sorted(file_names):
+                    record = self.import_record(user, pack_string, dir_path, file_name)
+                    if record is not None:
+                        self.add_card(record)
+                        imported += 1
+        logger.bind(users_dir=users_dir, files=imported, cards=self.count()).info("Card Archive Imported")
+        return imported
+
+    def import_record(self, user, pack_string, dir_path, file_name):
+        """Copies one old card into the archive and returns its index record, None if it is not a card"""
+        record = {'user': user, 'signed': 0, 'deterministic': 0}
+        if pack_string is None:
+            match = FLAT_CARD_PATTERN.match(file_name)
+            if match is None:
+                return None
+            record['card_type'], record['prompt'] = match.groups()
+        elif PACK_DIR_PATTERN.match(pack_string) and PACK_CARD_PATTERN.match(file_name):
+            record['pack_id'] = f'{user}/{pack_string}'
+            record['pack_card'] = int(PACK_CARD_PATTERN.match(file_name).group(1))
+        else:
+            return None
+        source_path = os.path.join(dir_path, file_name)
+        with open(source_path, 'rb') as card_file:
+            data = card_file.read()
+        record['sha256'] = hashlib.sha256(data).hexdigest()
+        record['path'] = self.card_path(record['sha256'], 'webp')
+        self.write(data, [record['path']])
+        if pack_string is not None:
+            created_at = datetime.strptime(pack_string, '%Y%m%d%H%M%S')
+        else:
+            created_at = datetime.fromtimestamp(os.stat(source_path).st_mtime)
+        record['created_at'] = created_at.isoformat(timespec='seconds')
+        record['archived_at'] = datetime.now().isoformat(timespec='seconds')
+        return record
+
+
+CARD_ARCHIVE = CardArchive(SETTINGS.get('archive_path', ['archive'])[0])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'import':
+        sys.exit('usage: python -m modules.card_archive import [users_dir]')
+    CARD_ARCHIVE.import_tree(sys.argv[2] if len(sys.argv) > 2 else 'users')
+    CARD_ARCHIVE.close()
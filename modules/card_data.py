@@ -0,0 +1,52 @@
+"""Loads the ability, creature type and artist pools once into immutable tuples, with every entry already tokenized
+for the text layout, and reloads a pool when its file changes on disk"""
+import json
+import os
+import random
+import threading
+from loguru import logger
+from modules.text_layout import tokenize
+
+
+class CardDataPool:
+    """One json list from assets/json. If field is set each entry is a dict and only that field is kept."""
+    def __init__(self, path, field=None):
+        self.path = path
+        self.field = field
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.snapshot = ((), ())
+
+    def refresh(self):
+        """Reloads the pool if its file changed since it was last read, returns the current (entries, tokens)"""
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime != self.mtime:
+            with self.lock:
+                if mtime != self.mtime:
+                    with open(self.path, 'r', encoding="utf-8") as pool_file:
+                        data = json.load(pool_file)
+                    entries = tuple(entry[self.field] if self.field else entry for entry in data)
+                    self.snapshot = (entries, tuple(tuple(tokenize(entry)) for entry in entries))
+                    self.mtime = mtime
+                    logger.bind(pool=self.path, entries=len(entries)).info("Card Data Loaded")
+        return self.snapshot
+
+    def choice(self, rng=random):
+        """Returns a random entry and its layout tokens, drawn from rng"""
+        entries, tokens = self.refresh()
+        index = rng.randrange(len(entries))
+        return entries[index], tokens[index]
+
+    def __len__(self):
+        return len(self.refresh()[0])
+
+
+ABILITY_POOLS = {name: CardDataPool(f'assets/json/{name}.json')
+                 for name in ('artifact', 'creature', 'enchant', 'instant', 'sorcery', 'type_creature')}
+ARTIST_POOL = CardDataPool('assets/json/artist.json', field='prompt')
+
+
+def load_card_data():
+    """Loads every pool up front so the first card does not pay for it"""
+    for pool in (*ABILITY_POOLS.values(), ARTIST_POOL):
+        pool.refresh()
@@ -0,0 +1,175 @@
+"""Composites a card from a card spec. render_card is a pure function of the spec so it can run in render worker
+processes, which keeps the PIL work off the bot's event loop and lets a pack's cards composite on separate cores.
+
+A card spec is a dict made by MTGCardGenerator.build_card_spec, every random roll has already been made:
+    card_type, title, flavor_text, artist, user      strings
+    art                                              PIL image pasted at the top of the card
+    foil                                             foil texture name or None
+    signed                                           True if the signature goes on the card
+    type_line                                        text on the type line
+    mana_slot_icon, mana_slots                       icon that sets the mana slot size, icon name or None per slot
+    ability_tokens                                   layout tokens of the rules text, None for lands
+    atk_def                                          'atk/def' for creatures, otherwise None
+    land_mana_icon                                   icon in the land's tap ability, None for everything else
+"""
+from PIL import Image, ImageDraw, ImageChops
+from modules.assets import ASSETS
+from modules.text_layout import TEXT_LAYOUT, tokenize
+
+MANA_SYMBOLS = {
+    '{W}': 'white_mana_small',
+    '{U}': 'blue_mana_small',
+    '{B}': 'black_mana_small',
+    '{R}': 'red_mana_small',
+    '{G}': 'green_mana_small',
+    '{T}': 'tap',
+    '{0}': '0_mana_small',
+    '{1}': '1_mana_small',
+    '{2}': '2_mana_small',
+    '{3}': '3_mana_small',
+    '{4}': '4_mana_small',
+    '{5}': '5_mana_small',
+    '{6}': '6_mana_small',
+    '{7}': '7_mana_small',
+    '{8}': '8_mana_small',
+    '{9}': '9_mana_small',
+    '{X}': 'x_mana_small',
+}
+
+
+class CardRenderBackend:
+    """Model worker backend that renders card specs, the assets are decoded once when the worker starts"""
+    @staticmethod
+    def load():
+        """Decodes the card assets"""
+        ASSETS.load()
+
+    @staticmethod
+    def render(card_spec):
+        """Renders a card spec, see render_card"""
+        return render_card(card_spec)
+
+
+def render_card(card_spec):
+    """Builds the card described by the spec and returns it as (mode, size, raw pixel bytes)"""
+    card = ASSETS.template(card_spec['card_type'])
+    art = card_spec['art']
+    art_box = (88, 102, 88 + art.width, 102 + art.height)
+    card.paste(art, art_box[:2])
+    card = paste_foil(card, card_spec['card_type'], card_spec['foil'], art_box)
+    paste_title_text(card, card_spec['title'])
+    paste_artist_copyright(card, card_spec['artist'], card_spec['user'])
+    if card_spec['land_mana_icon'] is not None:
+        paste_land_abilities(card, card_spec['land_mana_icon'], card_spec['flavor_text'])
+        paste_type(card, card_spec['type_line'])
+    else:
+        if card_spec['atk_def'] is not None:
+            paste_creature_card_atk_def(card, card_spec['atk_def'])
+        paste_mana(card, card_spec['mana_slot_icon'], card_spec['mana_slots'])
+        paste_type(card, card_spec['type_line'])
+        paste_ability(card, card_spec['ability_tokens'], card_spec['flavor_text'])
+    if card_spec['signed']:
+        signature_texture = ASSETS.foil('signature')
+        card.paste(signature_texture, (100, 590), signature_texture)
+    return card.mode, card.size, card.tobytes()
+
+
+def paste_foil(card, card_type, foil_name, art_box):
+    """Adds the foil texture and foil set icon, or the plain set icon. Only the art is blended per card, the foiled
+    template comes from the asset cache. Returns the card since a foil card is a new image."""
+    if foil_name is not None:
+        foil_texture = ASSETS.foil_overlay_crop(foil_name, card.size, art_box)
+        foiled_art = ImageChops.soft_light(card.crop(art_box), foil_texture)
+        card = ASSETS.foiled_template(card_type, foil_name)
+        card.paste(foiled_art, art_box[:2])
+        icon_image = ASSETS.icon('foilicon')
+        card.paste(icon_image, (600, 585), icon_image)
+        return card
+    icon_image = ASSETS.icon('set_icon')
+    card.paste(icon_image, (619, 579), icon_image)
+    return card
+
+
+def paste_title_text(card, card_title):
+    """Adds card title to a card"""
+    font = ASSETS.font('planewalker', 36)
+    draw = ImageDraw.Draw(card)
+    draw.text((58, 52), card_title, font=font, fill="black")
+    draw.text((56, 50), card_title, font=font, fill="white")
+
+
+def paste_artist_copyright(card, card_artist, user):
+    """Adds artist and copyright text to a card"""
+    font = ASSETS.font('garamond', 32)
+    draw = ImageDraw.Draw(card)
+    draw.text((72, 942), f"Illus. {card_artist}", font=font, fill="black")
+    draw.text((70, 940), f"Illus. {card_artist}", font=font, fill="white")
+    font = ASSETS.font('garamond', 20)
+    draw.text((72, 975), f"© 1994 {user} - Lightys Homeless Shelter.", font=font, fill="black")
+    draw.text((70, 973), f"© 1994 {user} - Lightys Homeless Shelter.", font=font, fill="white")
+
+
+def paste_land_abilities(card, land_mana_icon, flavor_text):
+    """Adds land text, the mana icon and the flavor text to a card"""
+    font = ASSETS.font('garamond', 36)
+    draw = ImageDraw.Draw(card)
+    draw.text((235, 668), "Tap to add", font=font, fill="black")
+    draw.text((235, 713), "to your mana pool.", font=font, fill="black")
+
+    mana_image = ASSETS.icon(land_mana_icon)
+    combined_mana_image = Image.new('RGBA', mana_image.size)
+    combined_mana_image.paste(mana_image, (0, 0))
+    card.paste(combined_mana_image, (392, 665), combined_mana_image)
+
+    flavor_font = ASSETS.font('garamonditalic', 36)
+    flavor_runs, _ = TEXT_LAYOUT.layout(tokenize(flavor_text), flavor_font, (94, 800), 659, 32)
+    TEXT_LAYOUT.draw_runs(card, flavor_runs)
+
+
+def paste_type(card, type_line):
+    """Adds the type line to a card"""
+    font = ASSETS.font('garamond', 36)
+    draw = ImageDraw.Draw(card)
+    draw.text((88, 582), type_line, font=font, fill="black")
+    draw.text((86, 580), type_line, font=font, fill="white")
+
+
+def paste_creature_card_atk_def(card, atk_def):
+    """Adds the creature atk/def to a card"""
+    font = ASSETS.font('planewalker', 44)
+    draw = ImageDraw.Draw(card)
+    draw.text((622, 936), atk_def, font=font, fill="black")
+    draw.text((620, 934), atk_def, font=font, fill="white")
+
+
+def paste_mana(card, mana_slot_icon, mana_slots):
+    """Lines the mana icons up in equal slots and adds them to the top right of a card"""
+    slot_width, slot_height = ASSETS.icon(mana_slot_icon).size
+    combined_mana_image = Image.new('RGBA', (slot_width * len(mana_slots), slot_height))
+    for slot, icon_name in enumerate(mana_slots):
+        if icon_name is not None:
+            combined_mana_image.paste(ASSETS.icon(icon_name), (slot * slot_width, 0))
+    card.paste(combined_mana_image, (676 - combined_mana_image.width, 49), combined_mana_image)
+
+
+def paste_ability(card, ability_tokens, flavor_text):
+    """Draws the card ability, with inline mana symbols, and the flavor text below it. If the flavor text would start
+    past the cutoff the font is shrunk until it fits, failing that the flavor text is left off."""
+    symbols = {symbol: ASSETS.icon(icon_name) for symbol, icon_name in MANA_SYMBOLS.items()}
+    flavor_tokens = tokenize(flavor_text)
+    fallback_runs = None
+
+    for font_size in (36, 34, 32, 30, 28):
+        line_height = font_size * 32 // 36
+        ability_font = ASSETS.font('garamondbullet', font_size)
+        ability_runs, (_, current_y) = TEXT_LAYOUT.layout(ability_tokens, ability_font, (94, 640), 659,
+                                                          line_height, symbols)
+        if fallback_runs is None:
+            fallback_runs = ability_runs
+        current_y += line_height
+        if current_y <= 805:
+            flavor_font = ASSETS.font('garamonditalic', font_size)
+            flavor_runs, _ = TEXT_LAYOUT.layout(flavor_tokens, flavor_font, (94, current_y), 659, line_height)
+            TEXT_LAYOUT.draw_runs(card, ability_runs + flavor_runs)
+            return
+    TEXT_LAYOUT.draw_runs(card, fallback_runs)
@@ -0,0 +1,66 @@
+"""Rebuilds a card from its seed, prompt and user, for checking a card can be reproduced and for running the exact same
+workload twice when comparing performance. A card that was built in deterministic mode comes out the same, any other
+card gets the same rolls and art seed but its LLM text is sampled again.
+
+Run `python -m modules.card_replay seed <seed> <user> <prompt>` to build a card from scratch or
+`python -m modules.card_replay card <sha256 prefix>` to replay a card from the archive. The card is saved as
+replay_<seed>.png in the working directory."""
+import asyncio
+import sys
+from loguru import logger
+from modules.card_archive import CARD_ARCHIVE
+from modules.card_data import load_card_data
+from modules.model_worker import IMAGE_WORKERS, LLM_WORKERS, RENDER_WORKERS
+from modules.mtg_generator import MTGCardGenerator
+
+USAGE = 'usage: python -m modules.card_replay seed <seed> <user> <prompt> | card <sha256 prefix>'
+
+
+async def replay_card(seed, prompt, user):
+    """Builds a card deterministically and returns its generator, the output caches are not read so the models
+    really run"""
+    card_request = MTGCardGenerator('lightycard', prompt, None, user, fresh=True, seed=seed, deterministic=True)
+    await card_request.generate_card_texts()
+    await card_request.generate_card_images()
+    await card_request.composite_cards()
+    return card_request
+
+
+def find_archived_card(sha256_prefix):
+    """Returns the archived card whose hash starts with the prefix"""
+    rows = CARD_ARCHIVE.query('SELECT * FROM cards WHERE sha256 LIKE ? LIMIT 2', (f'{sha256_prefix}%',))
+    if len(rows) != 1:
+        sys.exit(f'{len(rows) or "no"} archived cards match {sha256_prefix}')
+    if rows[0]['seed'] is None:
+        sys.exit(f'card {rows[0]["sha256"]} was archived without a seed')
+    if not rows[0]['deterministic']:
+        logger.bind(sha256=rows[0]['sha256'][:12]).warning("Card Was Not Deterministic")
+    return rows[0]
+
+
+async def main(arguments):
+    """Replays the card named on the command line and saves it"""
+    if len(arguments) == 2 and arguments[0] == 'card':
+        record = find_archived_card(arguments[1])
+        seed, user, prompt = record['seed'], record['user'], record['prompt']
+    elif len(arguments) == 4 and arguments[0] == 'seed':
+        seed, user, prompt = int(arguments[1]), arguments[2], arguments[3]
+    else:
+        sys.exit(USAGE)
+    load_card_data()
+    for pool in (IMAGE_WORKERS, LLM_WORKERS, RENDER_WORKERS):
+        pool.start()
+    try:
+        card_request = await replay_card(seed, prompt, user)
+    finally:
+        for pool in (IMAGE_WORKERS, LLM_WORKERS, RENDER_WORKERS):
+            pool.stop()
+        CARD_ARCHIVE.close()
+    path = f'replay_{seed}.png'
+    card_request.card.save(path)
+    logger.bind(seed=seed, card_type=card_request.card_type, title=card_request.card_title,
+                path=path).info("Card Replayed")
+
+
+if __name__ == '__main__':
+    asyncio.run(main(sys.argv[1:]))
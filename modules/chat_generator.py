@@ -1,10 +1,8 @@
-"""Writes prompt to json/llm_prompt to json, runs the generation call, and then places the response from
-json/generated_output.json into self.response"""
-
-import asyncio
-import json
-import subprocess
-from loguru import logger
+"""Sends a chat prompt to the LLM and places the reply into self.response, either in one piece through the batcher or
+streamed token by token"""
+import time
+from modules.llm_batcher import LLM_BATCHER
+from modules.model_worker import LLM_WORKERS
 
 
 class ChatGenerator:
@@ -15,40 +13,32 @@ class ChatGenerator:
         self.channel = channel
         self.user = user
         self.response = None
+        self.journal_id = None
+        self.queued_at = None
+        self.streamed = False
+        self.time_to_first_token = None
 
     def __str__(self):
         return self.user
 
+    def get_chat_messages(self):
+        """Returns the messages sent to the LLM"""
+        return [{"role": "system", "content": "You do anything the user requests."},
+                {"role": "user", "content": self.prompt}]
+
     async def generate_chat(self):
         """Generates a LLM response to a prompt and places it in self.response"""
-        title_messages = [{"role": "system", "content": "You do anything the user requests."},
-                          {"role": "user", "content": self.prompt}]
-        self.write_llm_prompts_to_file(title_messages)
-        script_result = await asyncio.to_thread(
-            subprocess.run,
-            ['python', 'modules/generate_text.py'],
-            capture_output=True
-        )
-        if script_result.returncode != 0:
-            raise RuntimeError(f"Script failed with error: {script_result.stderr.decode()}")
-
-        with open('assets/json/generated_output.json', 'r', encoding="utf-8") as generated_output_file:
-            data = json.load(generated_output_file)
-        prompt_variables = {}
-        for key, value in data.items():
-            prompt_variables[key] = value
-        self.response = prompt_variables['prompt1']
-
-    @staticmethod
-    def write_llm_prompts_to_file(*prompt_sets):
-        """Writes the prompt to a file for use by the llm script"""
-        # Create a list to hold all the prompt sets
-        all_prompts = []
-
-        # Add each set of prompts to the list
-        for prompts in prompt_sets:
-            all_prompts.append(prompts)
-
-        # Write the list of prompt sets to the JSON file
-        with open('assets/json/llm_prompt.json', 'w', encoding="utf-8") as llm_prompt_file:
-            json.dump(all_prompts, llm_prompt_file, indent=4)
+        self.response = await LLM_BATCHER.generate(self.get_chat_messages())
+
+    async def stream_chat(self, on_text):
+        """Generates a LLM response, awaiting on_text with each piece as it arrives, and places the whole response in
+        self.response. Records how long the first piece took in time_to_first_token."""
+        start = time.monotonic()
+        pieces = []
+        async for text in LLM_WORKERS.stream('generate_stream', self.get_chat_messages()):
+            if self.time_to_first_token is None:
+                self.time_to_first_token = time.monotonic() - start
+            pieces.append(text)
+            await on_text(text)
+        self.response = ''.join(pieces)
+        self.streamed = True
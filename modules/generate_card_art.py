@@ -1,51 +1,100 @@
-"""This takes a prompt via command line and saves the generated image to generated_image.png"""
-import argparse
-from diffusers import StableDiffusionXLPipeline, DPMSolverMultistepScheduler
-import torch
+"""Image backends served by the model worker. SDXLBackend loads the pipeline once and reuses it for every prompt.
+
+Each backend names its model in MODEL_ID and the settings it samples with in SAMPLING, the art cache keys on both so
+changing either never serves art made the old way."""
 import gc
-from settings import SETTINGS
-from loguru import logger
-
-torch.cuda.empty_cache()
-gc.collect()
-
-parser = argparse.ArgumentParser(
-    description="Generate an image using Stable Diffusion XL and a prompt from the command line."
-)
-parser.add_argument('generate_prompt', type=str, help='The prompt to generate the image.')
-args = parser.parse_args()
-scheduler = DPMSolverMultistepScheduler.from_pretrained(
-    "stabilityai/stable-diffusion-xl-base-1.0",
-    subfolder="scheduler"
-)
-scheduler.config.algorithm_type = 'sde-dpmsolver++'
-sd_pipeline = StableDiffusionXLPipeline.from_single_file(
-    "https://huggingface.co/ykurilov/ZavyChromaXL_v6/blob/main/zavychromaxl_v60.safetensors",
-    scheduler=scheduler,
-    use_safetensors=True,
-    device_map="auto",
-    safety_checker=None,
-    torch_dtype=torch.float32
-)
-if SETTINGS['sdxl_lora'][0]:
-   sd_pipeline.load_lora_weights(f"assets/{SETTINGS['sdxl_lora'][0]}", weight_name=SETTINGS['sdxl_lora'][0])
-sd_pipeline.to("cuda")
-
-
-generated_image = sd_pipeline(
-    prompt=args.generate_prompt,
-    negative_prompt="flash photography, suit, film grain",
-    guidance_scale=7,
-    num_inference_steps=30
-)
-image = generated_image.images[0]
-resized_image = image.resize((568, 465))
-resized_image.save('assets/generated_image.png')
-scheduler = None
-sd_pipeline = None
-generated_image = None
-image = None
-resized_image = None
-del scheduler, sd_pipeline, generated_image, image, resized_image
-torch.cuda.empty_cache()
-gc.collect()
\ No newline at end of file
+import random
+import time
+from PIL import Image
+from modules.settings import SETTINGS
+
+
+class SDXLBackend:
+    """Generates card art with Stable Diffusion XL"""
+    MODEL_ID = "https://huggingface.co/ykurilov/ZavyChromaXL_v6/blob/main/zavychromaxl_v60.safetensors"
+    SAMPLING = {
+        'scheduler': 'sde-dpmsolver++',
+        'negative_prompt': 'flash photography, suit, film grain',
+        'guidance_scale': 7,
+        'num_inference_steps': 30
+    }
+
+    def __init__(self):
+        self.sd_pipeline = None
+
+    def load(self):
+        """Builds the scheduler and pipeline and applies the lora"""
+        import torch
+        from diffusers import StableDiffusionXLPipeline, DPMSolverMultistepScheduler
+        scheduler = DPMSolverMultistepScheduler.from_pretrained(
+            "stabilityai/stable-diffusion-xl-base-1.0",
+            subfolder="scheduler"
+        )
+        scheduler.config.algorithm_type = self.SAMPLING['scheduler']
+        self.sd_pipeline = StableDiffusionXLPipeline.from_single_file(
+            self.MODEL_ID,
+            scheduler=scheduler,
+            use_safetensors=True,
+            device_map="auto",
+            safety_checker=None,
+            torch_dtype=torch.float32
+        )
+        if SETTINGS['sdxl_lora'][0]:
+            self.sd_pipeline.load_lora_weights(f"assets/{SETTINGS['sdxl_lora'][0]}", weight_name=SETTINGS['sdxl_lora'][0])
+        self.sd_pipeline.to("cuda")
+
+    def generate(self, prompt, seed=None):
+        """Generates an image for the prompt and returns it as a PIL image, which pickles as raw pixels"""
+        import torch
+        generated_image = self.sd_pipeline(
+            prompt=prompt,
+            negative_prompt=self.SAMPLING['negative_prompt'],
+            guidance_scale=self.SAMPLING['guidance_scale'],
+            num_inference_steps=self.SAMPLING['num_inference_steps'],
+            generator=torch.Generator('cuda').manual_seed(seed) if seed is not None else None
+        )
+        resized_image = generated_image.images[0].resize((568, 465))
+        generated_image = None
+        torch.cuda.empty_cache()
+        gc.collect()
+        return resized_image
+
+    def generate_batch(self, prompts, seeds=None):
+        """Generates one image per prompt in a single pipeline call. Each seed gets its own generator, so an image
+        comes out the same whatever else is in its batch"""
+        import torch
+        generated_images = self.sd_pipeline(
+            prompt=prompts,
+            negative_prompt=[self.SAMPLING['negative_prompt']] * len(prompts),
+            guidance_scale=self.SAMPLING['guidance_scale'],
+            num_inference_steps=self.SAMPLING['num_inference_steps'],
+            generator=[torch.Generator('cuda').manual_seed(seed) for seed in seeds] if seeds is not None else None
+        )
+        resized_images = [image.resize((568, 465)) for image in generated_images.images]
+        generated_images = None
+        torch.cuda.empty_cache()
+        gc.collect()
+        return resized_images
+
+
+class FakeImageBackend:
+    """Returns random noise instead of running a model, for testing the workers on machines without a GPU. Each image
+    takes fake_inference_ms so scheduling across several workers behaves like it would with real models."""
+    MODEL_ID = 'fake'
+    SAMPLING = {}
+
+    def __init__(self):
+        self.inference_seconds = int(SETTINGS.get('fake_inference_ms', [0])[0]) / 1000
+
+    def load(self):
+        """Nothing to load"""
+
+    def generate(self, prompt, seed=None):
+        """Returns a noise image the same size as real card art"""
+        time.sleep(self.inference_seconds)
+        rng = random.Random(prompt if seed is None else f'{seed}:{prompt}')
+        return Image.frombytes('RGB', (568, 465), rng.randbytes(568 * 465 * 3))
+
+    def generate_batch(self, prompts, seeds=None):
+        """Returns a noise image for each prompt"""
+        return [self.generate(prompt, seed) for prompt, seed in zip(prompts, seeds or [None] * len(prompts))]
@@ -1,45 +1,129 @@
-"""This loads prompts from llm_prompts.json, then stores the results in generated_output.json"""
-import json
-import torch
-import transformers
+"""Text backends served by the model worker. LlamaBackend loads the LLM once and reuses it for every request."""
 import gc
-torch.cuda.empty_cache()
-gc.collect()
-
-# Load the multiple prompts
-with open('assets/json/llm_prompt.json', 'r', encoding="utf-8") as file:
-    llm_prompts_list = json.load(file)
-
-llm_pipeline = transformers.pipeline(
-    "text-generation",
-    model="cognitivecomputations/Llama-3-8B-Instruct-abliterated-v2",
-    model_kwargs={"torch_dtype": torch.float32, "quantization_config": {"load_in_8bit": True}},
-    device_map="auto"
-)
-
-terminators = [
-    llm_pipeline.tokenizer.eos_token_id,
-    llm_pipeline.tokenizer.convert_tokens_to_ids("<|eot_id|>")
-]
-output_data = {}
-
-# Iterate through each prompt set in the list
-for idx, llm_prompts in enumerate(llm_prompts_list):
-    title_output = llm_pipeline(
-        llm_prompts,
-        max_new_tokens=2000,
-        eos_token_id=terminators,
-        do_sample=True,
-        temperature=1.4,
-        top_p=0.9,
-        pad_token_id=llm_pipeline.tokenizer.eos_token_id
-    )
-    title = title_output[0]["generated_text"][-1]["content"]
-    output_data[f"prompt{idx + 1}"] = title
-
-with open('assets/json/generated_output.json', 'w', encoding="utf-8") as outfile:
-    json.dump(output_data, outfile, indent=4)
-
-llm_pipeline = None
-torch.cuda.empty_cache()
-gc.collect()
\ No newline at end of file
+import threading
+import time
+from modules.settings import SETTINGS
+
+DEFAULT_SAMPLING = {
+    "max_new_tokens": 2000,
+    "do_sample": True,
+    "temperature": 1.4,
+    "top_p": 0.9
+}
+
+
+class LlamaBackend:
+    """Generates text with Llama 3 8B"""
+    MODEL_ID = "cognitivecomputations/Llama-3-8B-Instruct-abliterated-v2"
+    SAMPLING = DEFAULT_SAMPLING
+
+    def __init__(self):
+        self.llm_pipeline = None
+        self.terminators = None
+
+    def load(self):
+        """Builds the text generation pipeline"""
+        import torch
+        import transformers
+        self.llm_pipeline = transformers.pipeline(
+            "text-generation",
+            model=self.MODEL_ID,
+            model_kwargs={"torch_dtype": torch.float32, "quantization_config": {"load_in_8bit": True}},
+            device_map="auto"
+        )
+        self.terminators = [
+            self.llm_pipeline.tokenizer.eos_token_id,
+            self.llm_pipeline.tokenizer.convert_tokens_to_ids("<|eot_id|>")
+        ]
+        self.llm_pipeline.tokenizer.pad_token = self.llm_pipeline.tokenizer.eos_token
+        self.llm_pipeline.tokenizer.padding_side = "left"  # batched generation needs the prompts right aligned
+
+    @staticmethod
+    def apply_seed(sampling):
+        """Takes the seed out of the sampling params and seeds torch with it, so a seeded request samples the same
+        tokens every time"""
+        seed = sampling.pop('seed', None)
+        if seed is not None:
+            import transformers
+            transformers.set_seed(seed)
+        return sampling
+
+    def generate(self, messages, **sampling):
+        """Returns the completion for a list of chat messages, sampling params override the defaults"""
+        import torch
+        sampling = self.apply_seed(sampling)
+        output = self.llm_pipeline(
+            messages,
+            eos_token_id=self.terminators,
+            pad_token_id=self.llm_pipeline.tokenizer.eos_token_id,
+            **{**DEFAULT_SAMPLING, **sampling}
+        )
+        torch.cuda.empty_cache()
+        gc.collect()
+        return output[0]["generated_text"][-1]["content"]
+
+    def generate_batch(self, message_sets, **sampling):
+        """Returns the completions for several lists of chat messages, run as one padded batch. A seeded batch is
+        only repeatable with the same messages in it, the batcher keeps each seed in a batch of its own."""
+        import torch
+        sampling = self.apply_seed(sampling)
+        outputs = self.llm_pipeline(
+            message_sets,
+            batch_size=len(message_sets),
+            eos_token_id=self.terminators,
+            pad_token_id=self.llm_pipeline.tokenizer.eos_token_id,
+            **{**DEFAULT_SAMPLING, **sampling}
+        )
+        torch.cuda.empty_cache()
+        gc.collect()
+        return [output[0]["generated_text"][-1]["content"] for output in outputs]
+
+    def generate_stream(self, messages, **sampling):
+        """Yields the completion for a list of chat messages piece by piece as the tokens are sampled"""
+        import torch
+        from transformers import TextIteratorStreamer
+        sampling = self.apply_seed(sampling)
+        streamer = TextIteratorStreamer(self.llm_pipeline.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        generation_thread = threading.Thread(target=self.llm_pipeline, args=(messages,), kwargs={
+            'streamer': streamer,
+            'eos_token_id': self.terminators,
+            'pad_token_id': self.llm_pipeline.tokenizer.eos_token_id,
+            **{**DEFAULT_SAMPLING, **sampling}
+        })
+        generation_thread.start()
+        for text in streamer:
+            if text:
+                yield text
+        generation_thread.join()
+        torch.cuda.empty_cache()
+        gc.collect()
+
+
+class StubTextBackend:
+    """Echoes the prompt instead of running a model, for testing the workers on machines without a GPU. Each call
+    takes fake_inference_ms, batched or not, like a padded batch on a real model."""
+    MODEL_ID = 'stub'
+    SAMPLING = {}
+
+    def __init__(self):
+        self.inference_seconds = int(SETTINGS.get('fake_inference_ms', [0])[0]) / 1000
+
+    def load(self):
+        """Nothing to load"""
+
+    def generate(self, messages, **sampling):
+        """Returns a canned completion built from the last message"""
+        time.sleep(self.inference_seconds)
+        return f"Stub reply to {messages[-1]['content']}"
+
+    def generate_batch(self, message_sets, **sampling):
+        """Returns a canned completion for each list of messages"""
+        time.sleep(self.inference_seconds)
+        return [f"Stub reply to {messages[-1]['content']}" for messages in message_sets]
+
+    def generate_stream(self, messages, **sampling):
+        """Yields the canned completion a word at a time, spreading fake_inference_ms over the words"""
+        words = f"Stub reply to {messages[-1]['content']}".split(' ')
+        for index, word in enumerate(words):
+            time.sleep(self.inference_seconds / len(words))
+            yield word if index == 0 else f' {word}'
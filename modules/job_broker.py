@@ -0,0 +1,213 @@
+"""Hands generation jobs from the bot frontend to render nodes and their results back, so gpu boxes can be added
+without touching the bot. The frontend keeps everything that talks to discord and twitch, the queue, saving and
+delivery, a render node only runs the text, image and composite work.
+
+Render nodes connect over tcp or a unix socket, broker_address is 'tcp:host:port' or 'unix:/path'. Every message is a
+frame of two lengths, a json header and an optional binary blob that carries card pixels. A node says hello with the
+shared broker_authkey, then sends one pull per job it has room for and gets a job back for each pull as jobs arrive.
+Jobs on a node that disconnects go back to the front of the queue."""
+import asyncio
+import hmac
+import itertools
+import json
+import os
+import struct
+from collections import deque
+from loguru import logger
+from PIL import Image
+from modules.settings import SETTINGS
+
+FRAME_HEADER = struct.Struct('!II')
+MAX_FRAME_BYTES = 64 * 1024 * 1024
+CARD_RESULT_FIELDS = ('card_type', 'card_title', 'card_flavor_text', 'card_artist', 'card_foil', 'card_signed')
+
+
+async def read_message(reader):
+    """Reads one frame and returns its header and blob"""
+    header_length, blob_length = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if header_length + blob_length > MAX_FRAME_BYTES:
+        raise ValueError(f"frame of {header_length + blob_length} bytes is over the limit")
+    header = json.loads(await reader.readexactly(header_length))
+    blob = await reader.readexactly(blob_length) if blob_length else b''
+    return header, blob
+
+
+async def write_message(writer, header, blob=b''):
+    """Writes one frame and waits until it is flushed"""
+    header_bytes = json.dumps(header).encode('utf-8')
+    writer.write(FRAME_HEADER.pack(len(header_bytes), len(blob)) + header_bytes + blob)
+    await writer.drain()
+
+
+def parse_address(address):
+    """Splits 'tcp:host:port' or 'unix:/path' into the kind and its arguments"""
+    kind, _, rest = address.partition(':')
+    if kind == 'unix':
+        return kind, (rest,)
+    if kind == 'tcp':
+        host, _, port = rest.rpartition(':')
+        return kind, (host, int(port))
+    raise ValueError(f"broker address {address} is not tcp:host:port or unix:/path")
+
+
+def apply_result(job, result, blob):
+    """Copies a render node's result onto the frontend's job object"""
+    if job.action == 'discord_chat':
+        job.response = result['response']
+        return
+    for card, card_result in zip(job.get_cards(), result['cards']):
+        for field in CARD_RESULT_FIELDS:
+            setattr(card, field, card_result[field])
+        pixels = blob[card_result['offset']:card_result['offset'] + card_result['length']]
+        card.card = Image.frombytes(card_result['mode'], tuple(card_result['size']), pixels)
+
+
+class RenderNodeConnection:
+    """The broker's side of one connected render node"""
+    def __init__(self, name, writer):
+        self.name = name
+        self.writer = writer
+        self.pulls = 0
+        self.jobs = {}
+        self.completed = 0
+
+
+class JobBroker:
+    """Queues jobs for render nodes and resolves each job's future when its result comes back"""
+    def __init__(self, address, authkey, max_attempts=2):
+        self.address = address
+        self.authkey = authkey
+        self.max_attempts = max_attempts
+        self.server = None
+        self.job_ids = itertools.count()
+        self.queue = deque()
+        self.jobs = {}
+        self.nodes = set()
+
+    async def start(self):
+        """Starts listening for render nodes"""
+        kind, arguments = parse_address(self.address)
+        if kind == 'unix':
+            self.server = await asyncio.start_unix_server(self.handle_node, *arguments)
+        else:
+            self.server = await asyncio.start_server(self.handle_node, *arguments)
+        logger.bind(address=self.address).info("Job Broker Listening")
+
+    async def stop(self):
+        """Stops listening and disconnects every render node"""
+        if self.server is not None:
+            self.server.close()
+            for node in list(self.nodes):
+                node.writer.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def run(self, job):
+        """Sends a job to the next render node with room for it and waits until its result is applied"""
+        job_id = next(self.job_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.jobs[job_id] = {'job': job, 'future': future, 'attempts': 0}
+        self.queue.append(job_id)
+        await self.dispatch()
+        try:
+            return await future
+        finally:
+            self.jobs.pop(job_id, None)
+
+    async def dispatch(self):
+        """Hands queued jobs to nodes that have pulls outstanding, least busy node first"""
+        while self.queue:
+            ready_nodes = [node for node in self.nodes if node.pulls > 0]
+            if not ready_nodes:
+                return
+            node = min(ready_nodes, key=lambda ready_node: len(ready_node.jobs))
+            job_id = self.queue.popleft()
+            entry = self.jobs.get(job_id)
+            if entry is None:
+                continue
+            node.pulls -= 1
+            node.jobs[job_id] = entry
+            entry['attempts'] += 1
+            job = entry['job']
+            try:
+                await write_message(node.writer, {
+                    'type': 'job',
+                    'job_id': job_id,
+                    'action': job.action,
+                    'prompt': job.prompt,
+                    'user': str(job.user),
+                    'fresh': getattr(job, 'fresh', False),
+                    'seed': getattr(job, 'seed', None),
+                    'deterministic': getattr(job, 'deterministic', False)
+                })
+            except (ConnectionError, OSError):
+                node.writer.close()  # the node's reader sees the close and requeues its jobs
+
+    async def handle_node(self, reader, writer):
+        """Serves one render node connection until it closes"""
+        node = None
+        try:
+            hello, _ = await read_message(reader)
+            if hello.get('type') != 'hello' or not hmac.compare_digest(str(hello.get('authkey', '')), self.authkey):
+                logger.bind(peer=writer.get_extra_info('peername')).warning("Render Node Rejected")
+                return
+            node = RenderNodeConnection(hello.get('node', 'node'), writer)
+            self.nodes.add(node)
+            logger.bind(node=node.name).info("Render Node Connected")
+            while True:
+                message, blob = await read_message(reader)
+                if message['type'] == 'pull':
+                    node.pulls += 1
+                elif message['type'] == 'result':
+                    self.finish_job(node, message, blob)
+                await self.dispatch()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+            if node is not None:
+                self.nodes.discard(node)
+                self.requeue(node)
+                logger.bind(node=node.name, completed=node.completed).warning("Render Node Disconnected")
+                await self.dispatch()
+
+    def finish_job(self, node, message, blob):
+        """Applies a result to its job and wakes up whoever is waiting on it"""
+        entry = node.jobs.pop(message['job_id'], None)
+        if entry is None or entry['future'].done():
+            return
+        node.completed += 1
+        if not message['ok']:
+            entry['future'].set_exception(RuntimeError(f"render node {node.name} failed: {message['error']}"))
+            return
+        try:
+            apply_result(entry['job'], message['result'], blob)
+        except Exception as e:
+            entry['future'].set_exception(e)
+            return
+        entry['future'].set_result(entry['job'])
+
+    def requeue(self, node):
+        """Puts a lost node's jobs back at the front of the queue, failing those out of attempts"""
+        for job_id, entry in node.jobs.items():
+            if entry['future'].done():
+                continue
+            if entry['attempts'] >= self.max_attempts:
+                entry['future'].set_exception(RuntimeError(f"render node {node.name} disconnected"))
+            else:
+                self.queue.appendleft(job_id)
+        node.jobs = {}
+
+    def state(self):
+        """Returns the queue length and what every connected node is doing"""
+        return {
+            'queued': len(self.queue),
+            'nodes': {node.name: {'jobs': len(node.jobs), 'pulls': node.pulls, 'completed': node.completed}
+                      for node in self.nodes}
+        }
+
+
+BROKER = JobBroker(
+    SETTINGS.get('broker_address', ['tcp:127.0.0.1:7777'])[0],
+    SETTINGS.get('broker_authkey', [''])[0] or os.urandom(16).hex()  # without a key only in process nodes get in
+)
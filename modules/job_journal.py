@@ -0,0 +1,145 @@
+"""Records every job in a SQLite journal as it moves through the pipeline so a restart or crash loses nothing. A job is
+written when it is queued and checkpointed after the stages that are expensive to redo, the card texts once the text
+stage is done and the card art once the image stage is done. On startup the unfinished jobs are rebuilt from their
+last checkpoint and picked up from the stage after it. A chat checkpoint also records whether the reply was already
+streamed into the channel, so a replayed chat is not posted twice.
+
+Job states go queued, text_done, image_done and then delivered or failed."""
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from loguru import logger
+from modules.output_cache import decode_image, encode_image
+from modules.settings import SETTINGS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    action TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    priority_class TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    user_name TEXT NOT NULL,
+    channel_id INTEGER,
+    seed INTEGER,
+    deterministic INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL,
+    checkpoint TEXT,
+    error TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+CREATE TABLE IF NOT EXISTS job_images (
+    job_id INTEGER NOT NULL,
+    card_index INTEGER NOT NULL,
+    image BLOB NOT NULL,
+    PRIMARY KEY (job_id, card_index)
+);
+"""
+ADDED_COLUMNS = {'seed': 'INTEGER', 'deterministic': 'INTEGER NOT NULL DEFAULT 0'}
+FINISHED_STATES = ('delivered', 'failed')
+
+
+class JobJournal:
+    """Write ahead record of the jobs in flight. Writes are small and happen off the event loop, the connection is
+    shared between threads behind a lock."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def open(self):
+        """Opens the journal, creating it if needed, does nothing if it is already open"""
+        with self.lock:
+            if self.connection is not None:
+                return
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.row_factory = sqlite3.Row
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')  # WAL stays consistent, a power cut may lose the last write
+            self.connection.executescript(SCHEMA)
+            existing_columns = {row['name'] for row in self.connection.execute('PRAGMA table_info(jobs)')}
+            for column, column_type in ADDED_COLUMNS.items():
+                if column not in existing_columns:  # journals from before the column existed
+                    self.connection.execute(f'ALTER TABLE jobs ADD COLUMN {column} {column_type}')
+
+    def close(self):
+        """Closes the journal"""
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def execute(self, sql, parameters=()):
+        """Runs one write in its own transaction and returns the cursor"""
+        self.open()
+        with self.lock:
+            with self.connection:
+                return self.connection.execute(sql, parameters)
+
+    def record(self, job, priority_class):
+        """Writes a newly queued job and stores its journal id on it"""
+        now = datetime.now().isoformat(timespec='seconds')
+        channel = job.channel
+        cursor = self.execute(
+            'INSERT INTO jobs (action, prompt, priority_class, user_id, user_name, channel_id, seed, deterministic, '
+            'state, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (job.action, job.prompt, priority_class, job.user.id, str(job.user),
+             channel.id if channel is not None else None, getattr(job, 'seed', None),
+             int(getattr(job, 'deterministic', False)), 'queued', now, now))
+        job.journal_id = cursor.lastrowid
+
+    def checkpoint(self, job, state):
+        """Moves a job to a new state, saving what it needs to resume from there"""
+        if job.journal_id is None:
+            return
+        now = datetime.now().isoformat(timespec='seconds')
+        if job.action == 'discord_chat':
+            checkpoint = {'response': job.response, 'streamed': job.streamed}
+        else:
+            checkpoint = job.get_checkpoint()
+        self.open()
+        with self.lock:
+            with self.connection:
+                self.connection.execute('UPDATE jobs SET state = ?, checkpoint = ?, updated_at = ? WHERE id = ?',
+                                        (state, json.dumps(checkpoint), now, job.journal_id))
+                if state == 'image_done':
+                    for card_index, card in enumerate(job.get_cards()):
+                        self.connection.execute(
+                            'INSERT OR REPLACE INTO job_images (job_id, card_index, image) VALUES (?, ?, ?)',
+                            (job.journal_id, card_index, encode_image(card.generated_image)))
+
+    def finish(self, job, error=None):
+        """Marks a job delivered, or failed if there was an error, and drops its saved art"""
+        if job.journal_id is None:
+            return
+        now = datetime.now().isoformat(timespec='seconds')
+        self.open()
+        with self.lock:
+            with self.connection:
+                self.connection.execute('UPDATE jobs SET state = ?, error = ?, updated_at = ? WHERE id = ?',
+                                        ('failed' if error is not None else 'delivered',
+                                         str(error) if error is not None else None, now, job.journal_id))
+                self.connection.execute('DELETE FROM job_images WHERE job_id = ?', (job.journal_id,))
+
+    def unfinished(self):
+        """Returns every job that was not delivered or failed, oldest first, with its saved art decoded"""
+        self.open()
+        with self.lock:
+            rows = [dict(row) for row in self.connection.execute(
+                'SELECT * FROM jobs WHERE state NOT IN (?, ?) ORDER BY id', FINISHED_STATES)]
+            for row in rows:
+                row['checkpoint'] = json.loads(row['checkpoint']) if row['checkpoint'] else None
+                row['images'] = [decode_image(image_row['image']) for image_row in self.connection.execute(
+                    'SELECT image FROM job_images WHERE job_id = ? ORDER BY card_index', (row['id'],))]
+        logger.bind(jobs=len(rows)).info("Job Journal Loaded")
+        return rows
+
+
+JOURNAL = JobJournal(SETTINGS.get('journal_path', ['jobs.db'])[0])
@@ -0,0 +1,66 @@
+"""Collects LLM requests from every job in flight and sends them to the LLM worker as padded batches"""
+import asyncio
+from loguru import logger
+from modules.model_worker import LLM_WORKERS
+from modules.settings import SETTINGS
+
+
+class LLMBatcher:
+    """Holds requests until the batch is full or the oldest one has waited max_wait seconds, then runs them together.
+    Requests are only batched with others using the same sampling params, so a seeded request only shares its batch
+    with requests using the same seed."""
+    def __init__(self, worker, max_batch_size, max_wait):
+        self.worker = worker
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending = []
+        self.flush_handle = None
+        self.running_batches = set()
+
+    async def generate(self, messages, **sampling):
+        """Queues a list of chat messages for the next batch and returns its completion"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((messages, sampling, future))
+        if len(self.pending) >= self.max_batch_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.max_wait, self.flush)
+        return await future
+
+    def flush(self):
+        """Sends everything pending to the worker, grouped by sampling params and split to the max batch size"""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        groups = {}
+        for request in self.pending:
+            groups.setdefault(tuple(sorted(request[1].items())), []).append(request)
+        self.pending = []
+        for requests in groups.values():
+            for i in range(0, len(requests), self.max_batch_size):
+                batch_task = asyncio.create_task(self.run_batch(requests[i:i + self.max_batch_size]))
+                self.running_batches.add(batch_task)
+                batch_task.add_done_callback(self.running_batches.discard)
+
+    async def run_batch(self, requests):
+        """Runs one batch on the worker and hands each caller its completion"""
+        sampling = requests[0][1]
+        try:
+            results = await self.worker.request('generate_batch', [request[0] for request in requests], **sampling)
+        except Exception as e:
+            for request in requests:
+                if not request[2].done():
+                    request[2].set_exception(e)
+            return
+        for request, result in zip(requests, results):
+            if not request[2].done():
+                request[2].set_result(result)
+        logger.bind(batch_size=len(requests)).debug("LLM Batch Finished")
+
+
+LLM_BATCHER = LLMBatcher(
+    LLM_WORKERS,
+    int(SETTINGS.get('llm_max_batch_size', [8])[0]),
+    int(SETTINGS.get('llm_batch_wait_ms', [50])[0]) / 1000
+)
@@ -0,0 +1,24 @@
+"""Starts the text work for the next few card jobs while they are still waiting in the queue. A card's title has to
+exist before its image prompt can be built, but the next job's text doesn't need to wait for the current job's image,
+so by the time a job is taken off the queue its text is usually done and it goes almost straight to the image stage."""
+from loguru import logger
+
+CARD_ACTIONS = ('lightycard', 'lightycard_three_pack')
+
+
+class TextLookahead:
+    """Watches the scheduler and starts card texts for the first depth jobs in line"""
+    def __init__(self, scheduler, depth):
+        self.scheduler = scheduler
+        self.depth = depth
+        self.started = 0
+
+    async def run(self):
+        """Starts text work for upcoming jobs every time the queue changes"""
+        while True:
+            await self.scheduler.wait_for_change()
+            for queue_request in self.scheduler.peek(self.depth):
+                if queue_request.action in CARD_ACTIONS and queue_request.text_task is None:
+                    queue_request.start_card_texts()
+                    self.started += 1
+                    logger.bind(user=f'{queue_request.user}', prompt=queue_request.prompt).debug("Card Text Prefetched")
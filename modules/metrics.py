@@ -0,0 +1,180 @@
+"""Collects timings and counts from every part of the bot and serves them over http in the Prometheus text format.
+
+Spans time one stage of one job, they go into the lighty_stage_seconds histogram labelled by stage and are logged at
+debug level with the job's journal id so one slow job can be followed through. Counters and histograms are kept in
+the registry, gauges such as queue depth are read from their owners by collectors each time the endpoint is scraped.
+
+Set metrics_port to serve the metrics on metrics_host:metrics_port/metrics, 0 turns the endpoint off."""
+import asyncio
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from loguru import logger
+from modules.settings import SETTINGS
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+METRIC_TYPES = {
+    'lighty_stage_seconds': ('histogram', 'Time spent in each stage of a job'),
+    'lighty_model_worker_start_seconds': ('histogram', 'Time to spawn a model worker and load its model'),
+    'lighty_model_worker_request_seconds': ('histogram', 'Time a model worker request was in flight, by op'),
+    'lighty_chat_ttft_seconds': ('histogram', 'Time from starting a streamed chat reply to its first token'),
+    'lighty_jobs_total': ('counter', 'Jobs that left the pipeline, by action and outcome'),
+    'lighty_queue_depth': ('gauge', 'Jobs waiting in the scheduler, by priority class'),
+    'lighty_pipeline_jobs': ('gauge', 'Jobs waiting for or running in each pipeline stage'),
+    'lighty_user_in_flight': ('gauge', 'Jobs queued or running per user'),
+    'lighty_job_seconds_average': ('gauge', 'Moving average of job duration by action, used for queue estimates'),
+    'lighty_worker_busy_seconds_total': ('counter', 'Seconds each model worker had a request in flight'),
+    'lighty_worker_requests_total': ('counter', 'Requests sent to each model worker'),
+    'lighty_worker_failures_total': ('counter', 'Requests each model worker failed'),
+    'lighty_worker_restarts_total': ('counter', 'Times each model worker was restarted'),
+    'lighty_worker_request_failures_total': ('counter', 'Failed model worker requests by pool and failure kind'),
+    'lighty_worker_retries_total': ('counter', 'Model worker requests retried by pool and failure kind'),
+    'lighty_worker_rejected_total': ('counter', 'Requests failed at once because the circuit breaker was open'),
+    'lighty_worker_warm_restarts_total': ('counter', 'Workers restarted after an oom or crash, by outcome'),
+    'lighty_circuit_breaker_trips_total': ('counter', 'Times a pool circuit breaker opened'),
+    'lighty_circuit_breaker_state': ('gauge', 'Circuit breaker state per pool, 0 closed, 1 half open, 2 open')
+}
+
+
+def format_labels(labels):
+    """Returns labels in the exposition format, values escaped"""
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Histogram:
+    """Bucketed counts of observed values"""
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Adds one value"""
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+class MetricsRegistry:
+    """Every metric of this process. Updates come from the event loop and from worker threads, so they go through a
+    lock."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+        self.server = None
+
+    def increment(self, name, amount=1, **labels):
+        """Adds to a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """Adds a value to a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def record_span(self, stage, seconds, job=None):
+        """Records how long a stage took for a job"""
+        self.observe('lighty_stage_seconds', seconds, stage=stage)
+        logger.bind(stage=stage, job_id=getattr(job, 'journal_id', None),
+                    ms=round(seconds * 1000, 1)).debug("Span Finished")
+
+    @contextmanager
+    def span(self, stage, job=None):
+        """Times the body of a with block as one stage of a job, failed or not"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_span(stage, time.perf_counter() - start, job)
+
+    def add_collector(self, collector):
+        """Registers a function returning (name, labels, value) samples, called on every scrape"""
+        self.collectors.append(collector)
+
+    def render(self):
+        """Returns every metric in the Prometheus text format"""
+        samples = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                samples.setdefault(name, []).append(f'{name}{format_labels(labels)} {value}')
+            for (name, labels), histogram in self.histograms.items():
+                lines = samples.setdefault(name, [])
+                cumulative = 0
+                for bucket, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", bucket),))} {cumulative}')
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {histogram.count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    samples.setdefault(name, []).append(f'{name}{format_labels(sorted(labels.items()))} {value}')
+            except Exception as e:
+                logger.bind(collector=getattr(collector, '__name__', str(collector))).error(f'EXCEPTION: {e}')
+        output = []
+        for name in sorted(samples):
+            metric_type, help_text = METRIC_TYPES.get(name, ('untyped', name))
+            output.append(f'# HELP {name} {help_text}')
+            output.append(f'# TYPE {name} {metric_type}')
+            output.extend(samples[name])
+        return '\n'.join(output) + '\n'
+
+    async def start(self, host, port):
+        """Starts serving the metrics endpoint"""
+        self.server = await asyncio.start_server(self.handle_request, host, port)
+        logger.bind(address=f'{host}:{port}').info("Metrics Endpoint Listening")
+
+    async def stop(self):
+        """Stops serving the metrics endpoint"""
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle_request(self, reader, writer):
+        """Answers one http request, GET /metrics gets the metrics and anything else a 404"""
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b'\r\n', b'\n', b''):
+                pass  # the headers are not needed
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+METRICS = MetricsRegistry()
+
+
+async def start_metrics_endpoint():
+    """Serves the metrics if metrics_port is set"""
+    port = int(SETTINGS.get('metrics_port', [0])[0])
+    if port:
+        await METRICS.start(SETTINGS.get('metrics_host', ['127.0.0.1'])[0], port)
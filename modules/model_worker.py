@@ -0,0 +1,493 @@
+"""Keeps a model loaded in a long lived child process and serves requests to it over a local connection.
+Results, including images, come back as python objects over the connection, nothing goes through files on disk.
+
+Run as `python -m modules.model_worker <backend>`, the child binds a listener, prints its port on stdout, loads the
+backend once and then answers requests until the connection closes. A backend method that returns a generator is
+streamed, each item it yields is sent back as it is produced and the final response carries no result. Pings are
+answered by the child's connection thread as they arrive, so a worker in the middle of a long request still answers."""
+import asyncio
+import concurrent.futures
+import importlib
+import inspect
+import itertools
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from loguru import logger
+from modules.metrics import METRICS
+from modules.settings import SETTINGS
+
+IMAGE_BACKENDS = {
+    'sdxl': 'modules.generate_card_art:SDXLBackend',
+    'fake': 'modules.generate_card_art:FakeImageBackend'
+}
+LLM_BACKENDS = {
+    'llama': 'modules.generate_text:LlamaBackend',
+    'stub': 'modules.generate_text:StubTextBackend'
+}
+
+
+class ModelWorker:
+    """Owns a model worker child process and the connection used to talk to it.
+
+    Every request gets an id and its own future, a reader thread hands each response to the future waiting for it,
+    so any number of jobs can have requests in flight without stepping on each other's results.
+
+    device binds the child to a gpu: 'cuda:1' only lets it see the second gpu, 'cpu' hides every gpu and 'cuda' or
+    None leaves them all visible."""
+    def __init__(self, name, backend, device=None):
+        self.name = name
+        self.backend = backend
+        self.device = device
+        self.process = None
+        self.connection = None
+        self.reader_thread = None
+        self.lock = threading.Lock()
+        self.request_ids = itertools.count()
+        self.pending = {}
+        self.pings = {}
+        self.chunk_handlers = {}
+        self.restarts = 0
+        self.generation = 0
+        self.stats_lock = threading.Lock()
+        self.created_at = time.monotonic()
+        self.requests = 0
+        self.failures = 0
+        self.busy_seconds = 0.0
+        self.busy_since = None
+        self.last_progress = time.monotonic()
+
+    def start(self):
+        """Launches the child process and blocks until its model is loaded"""
+        with self.lock:
+            if not self.is_alive():
+                self._start()
+
+    def _start(self):
+        authkey = os.urandom(16)
+        env = dict(os.environ, LIGHTY_WORKER_AUTHKEY=authkey.hex())
+        if self.device == 'cpu':
+            env['CUDA_VISIBLE_DEVICES'] = ''
+        elif self.device and self.device.startswith('cuda:'):
+            env['CUDA_VISIBLE_DEVICES'] = self.device.split(':', 1)[1]
+        spawn_start = time.perf_counter()
+        self.generation += 1
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'modules.model_worker', self.backend],
+            stdout=subprocess.PIPE,
+            env=env
+        )
+        port_line = self.process.stdout.readline()
+        if not port_line:
+            self._stop()
+            raise RuntimeError(f"{self.name} worker exited before it started listening")
+        load_start = time.perf_counter()
+        METRICS.observe('lighty_model_worker_start_seconds', load_start - spawn_start, worker=self.name, phase='spawn')
+        self.connection = Client(('127.0.0.1', int(port_line)), authkey=authkey)
+        try:
+            status = self.connection.recv()
+        except (EOFError, OSError):
+            status = {'ok': False, 'error': 'worker exited while loading its model'}
+        if not status['ok']:
+            self._stop()
+            raise RuntimeError(f"{self.name} worker failed to start: {status['error']}")
+        METRICS.observe('lighty_model_worker_start_seconds', time.perf_counter() - load_start, worker=self.name,
+                        phase='load')
+        self.reader_thread = threading.Thread(target=self._read_responses, args=(self.connection,), daemon=True)
+        self.reader_thread.start()
+        worker_logger = logger.bind(worker=self.name, backend=self.backend, device=self.device, pid=self.process.pid)
+        worker_logger.info("Model Worker Ready")
+
+    def _read_responses(self, connection):
+        """Resolves the future of each response as it arrives, failing everything still pending if the child dies"""
+        while True:
+            try:
+                response = connection.recv()
+            except (EOFError, OSError):
+                break
+            ping = self.pings.pop(response['id'], None)
+            if ping is not None:
+                if not ping.done():  # the health check gives up on pings that take too long
+                    ping.set_result(response['result'])
+                continue
+            self.last_progress = time.monotonic()
+            if 'chunk' in response:
+                chunk_handler = self.chunk_handlers.get(response['id'])
+                if chunk_handler is not None:
+                    chunk_handler(response['chunk'])
+                continue
+            self.chunk_handlers.pop(response['id'], None)
+            future = self.pending.pop(response['id'], None)
+            if future is None:
+                continue
+            if response['ok']:
+                future.set_result(response['result'])
+            else:
+                future.set_exception(RuntimeError(response['error']))
+        self.chunk_handlers.clear()
+        for ping in self.pings.values():
+            if not ping.done():
+                ping.set_exception(RuntimeError(f"{self.name} worker crashed"))
+        self.pings.clear()
+        for request_id in list(self.pending):
+            future = self.pending.pop(request_id, None)
+            if future is not None:
+                future.set_exception(RuntimeError(f"{self.name} worker crashed"))
+
+    def stop(self):
+        """Asks the child process to exit, killing it if it does not"""
+        with self.lock:
+            self._stop()
+
+    def _stop(self):
+        if self.connection is not None:
+            try:
+                self.connection.send({'id': None, 'op': 'stop'})
+            except OSError:
+                pass
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process.stdout.close()
+            self.process = None
+        if self.reader_thread is not None:
+            self.reader_thread.join()
+            self.reader_thread = None
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def stop_if_idle(self):
+        """Stops the child process unless it has requests in flight, returns true if it was stopped"""
+        with self.lock:
+            if self.pending:
+                return False
+            self._stop()
+            return True
+
+    def restart(self, generation=None):
+        """Tears down the child process and loads a fresh one. Given a generation it only restarts the child if it is
+        still the one that generation started, returns false if it was already replaced."""
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return False
+            self._stop()
+            self.restarts += 1
+            self._start()
+            return True
+
+    def is_alive(self):
+        """Returns true if the child process is running"""
+        return self.process is not None and self.process.poll() is None
+
+    def health_check(self, timeout=5, wedge_timeout=900):
+        """Returns true if the child process answers a ping within the timeout. A worker is only stopped as wedged
+        once it has had requests in flight without sending anything back for wedge_timeout seconds, or if it is idle
+        and does not answer. Either way ModelWorkerPool.revive brings it back."""
+        if not self.is_alive():
+            return False
+        stalled_for = self.stalled_for()
+        if stalled_for > wedge_timeout:
+            logger.bind(worker=self.name, stalled_seconds=round(stalled_for),
+                        in_flight=len(self.pending)).error("Model Worker Wedged, Stopping")
+            self.stop()
+            return False
+        try:
+            ping = self.ping()
+            return ping.result(timeout) == 'pong'
+        except concurrent.futures.TimeoutError:
+            ping.cancel()
+            self.stop_if_idle()
+            return False
+        except RuntimeError:
+            return False
+
+    def ping(self):
+        """Sends a ping and returns a future for the answer. Pings skip the request stats and the queue of requests
+        in the child."""
+        with self.lock:
+            if not self.is_alive():
+                raise RuntimeError(f"{self.name} worker is not running")
+            request_id = next(self.request_ids)
+            future = concurrent.futures.Future()
+            self.pings[request_id] = future
+            try:
+                self.connection.send({'id': request_id, 'op': 'ping'})
+            except OSError as e:
+                self.pings.pop(request_id, None)
+                raise RuntimeError(f"{self.name} worker crashed: {e}") from e
+        return future
+
+    def stalled_for(self):
+        """Returns how long the worker has had requests in flight without sending anything back, 0 when idle"""
+        if not self.pending:
+            return 0.0
+        return time.monotonic() - self.last_progress
+
+    def submit(self, op, *args, **kwargs):
+        """Sends a request to the child process, starting or restarting it as needed, and returns a future for the
+        result"""
+        return self.submit_request(op, args, kwargs)
+
+    def submit_request(self, op, args, kwargs, chunk_handler=None):
+        """submit with the args unpacked, chunk_handler is called from the reader thread with each streamed item"""
+        with self.lock:
+            if not self.is_alive():
+                if self.process is not None:
+                    logger.bind(worker=self.name).warning("Model Worker Died, Restarting")
+                    self._stop()
+                    self.restarts += 1
+                self._start()
+            request_id = next(self.request_ids)
+            future = concurrent.futures.Future()
+            future.generation = self.generation  # which child process the request went to
+            started_at = time.perf_counter()
+            self.request_started()
+            future.add_done_callback(self.request_finished)
+            future.add_done_callback(lambda _: METRICS.observe('lighty_model_worker_request_seconds',
+                                                               time.perf_counter() - started_at, worker=self.name,
+                                                               op=op))
+            self.pending[request_id] = future
+            if chunk_handler is not None:
+                self.chunk_handlers[request_id] = chunk_handler
+            try:
+                self.connection.send({'id': request_id, 'op': op, 'args': args, 'kwargs': kwargs})
+            except OSError as e:
+                self.pending.pop(request_id, None)
+                self.chunk_handlers.pop(request_id, None)
+                future.set_exception(RuntimeError(f"{self.name} worker crashed: {e}"))
+                self._stop()
+                raise RuntimeError(f"{self.name} worker crashed: {e}") from e
+        return future
+
+    def request_started(self):
+        """Counts a request and starts the busy clock if the worker was idle"""
+        with self.stats_lock:
+            self.requests += 1
+            if self.busy_since is None:
+                self.busy_since = self.last_progress = time.monotonic()
+
+    def request_finished(self, future):
+        """Counts a failure if the request failed and stops the busy clock once nothing is in flight"""
+        with self.stats_lock:
+            if future.exception() is not None:
+                self.failures += 1
+            if not self.pending and self.busy_since is not None:
+                self.busy_seconds += time.monotonic() - self.busy_since
+                self.busy_since = None
+
+    def busy_time(self):
+        """Returns how many seconds the worker has had a request in flight"""
+        with self.stats_lock:
+            busy_seconds = self.busy_seconds
+            if self.busy_since is not None:
+                busy_seconds += time.monotonic() - self.busy_since
+        return busy_seconds
+
+    def utilization(self):
+        """Returns the fraction of time since the worker was created that it had a request in flight"""
+        return self.busy_time() / max(time.monotonic() - self.created_at, 1e-9)
+
+    def state(self):
+        """Returns the worker's health and utilization stats"""
+        return {
+            'device': self.device,
+            'alive': self.is_alive(),
+            'in_flight': len(self.pending),
+            'requests': self.requests,
+            'failures': self.failures,
+            'restarts': self.restarts,
+            'utilization': round(self.utilization(), 3)
+        }
+
+    def call(self, op, *args, **kwargs):
+        """Sends a request to the child process and blocks until its result is back"""
+        return self.submit(op, *args, **kwargs).result()
+
+    async def request(self, op, *args, **kwargs):
+        """Async version of call, starting the child happens off the event loop since it can take minutes"""
+        future = await asyncio.to_thread(self.submit, op, *args, **kwargs)
+        return await asyncio.wrap_future(future)
+
+    async def stream(self, op, *args, **kwargs):
+        """Async generator over the items a streaming backend method yields, raising if the request fails"""
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        future = await asyncio.to_thread(self.submit_request, op, args, kwargs,
+                                         lambda chunk: loop.call_soon_threadsafe(chunks.put_nowait, chunk))
+        finished = asyncio.wrap_future(future)
+        while not finished.done():
+            next_chunk = asyncio.ensure_future(chunks.get())
+            await asyncio.wait({next_chunk, finished}, return_when=asyncio.FIRST_COMPLETED)
+            if next_chunk.done():
+                yield next_chunk.result()
+            else:
+                next_chunk.cancel()
+        while not chunks.empty():  # chunks are queued before the final response resolves the future
+            yield chunks.get_nowait()
+        finished.result()
+
+
+class ModelWorkerPool:
+    """Several model workers running the same backend, one per entry in devices, so a box with spare vram or more
+    gpus can run requests side by side. Each request goes to the live worker with the fewest requests in flight,
+    ties go to the one that has been least busy."""
+    def __init__(self, name, backend, devices):
+        self.name = name
+        self.backend = backend
+        self.workers = [ModelWorker(f'{name}{index}', backend, device) for index, device in enumerate(devices)]
+
+    def backend_constant(self, name):
+        """Returns a constant of the backend class, such as its MODEL_ID, without loading the model"""
+        return getattr(resolve_backend(self.backend), name)
+
+    def start(self):
+        """Launches every worker in the pool side by side, fails only if none of them start"""
+        with concurrent.futures.ThreadPoolExecutor(len(self.workers)) as executor:
+            started = list(executor.map(self.start_worker, self.workers))
+        if not any(started):
+            raise RuntimeError(f"no {self.name} worker could start")
+
+    @staticmethod
+    def start_worker(worker):
+        """Starts one worker, returns false instead of raising if it fails"""
+        try:
+            worker.start()
+        except RuntimeError as e:
+            logger.bind(worker=worker.name, device=worker.device).error(f"Model Worker Failed To Start: {e}")
+            return False
+        return True
+
+    def restart(self):
+        """Restarts every worker in the pool side by side with a freshly loaded model, fails only if none of them
+        come back"""
+        with concurrent.futures.ThreadPoolExecutor(len(self.workers)) as executor:
+            restarted = list(executor.map(self.restart_worker, self.workers))
+        if not any(restarted):
+            raise RuntimeError(f"no {self.name} worker could restart")
+
+    @staticmethod
+    def restart_worker(worker):
+        """Restarts one worker, returns false instead of raising if it fails"""
+        try:
+            worker.restart()
+        except RuntimeError as e:
+            logger.bind(worker=worker.name, device=worker.device).error(f"Model Worker Failed To Restart: {e}")
+            return False
+        return True
+
+    def revive(self):
+        """Restarts every worker whose child process is not running side by side, whether it died, was stopped by a
+        health check or never started. least_loaded only picks a dead worker when every worker is dead, so without
+        this one would stay idle until the bot restarts. Returns the names of the workers that came back."""
+        dead_workers = [worker for worker in self.workers if not worker.is_alive()]
+        if not dead_workers:
+            return []
+        with concurrent.futures.ThreadPoolExecutor(len(dead_workers)) as executor:
+            restarted = list(executor.map(self.restart_worker, dead_workers))
+        return [worker.name for worker, worker_restarted in zip(dead_workers, restarted) if worker_restarted]
+
+    def stop(self):
+        """Stops every worker in the pool"""
+        for worker in self.workers:
+            worker.stop()
+
+    def least_loaded(self):
+        """Returns the worker the next request should go to"""
+        return min(self.workers, key=lambda worker: (not worker.is_alive(), len(worker.pending), worker.utilization()))
+
+    async def request(self, op, *args, **kwargs):
+        """Sends a request to the least loaded worker and waits for its result"""
+        return await self.least_loaded().request(op, *args, **kwargs)
+
+    async def stream(self, op, *args, **kwargs):
+        """Streams a request from the least loaded worker"""
+        async for chunk in self.least_loaded().stream(op, *args, **kwargs):
+            yield chunk
+
+    def health_check(self, timeout=5, wedge_timeout=900):
+        """Pings every live worker, returns whether each answered keyed by worker name"""
+        return {worker.name: worker.health_check(timeout, wedge_timeout) for worker in self.workers}
+
+    def state(self):
+        """Returns every worker's stats keyed by worker name"""
+        return {worker.name: worker.state() for worker in self.workers}
+
+
+def resolve_backend(backend_path):
+    """Imports and returns the backend class named by a 'module:Class' path"""
+    module_name, class_name = backend_path.split(':')
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def receive_requests(connection, send, requests):
+    """Child process connection thread, answers pings straight away and queues every other request for the main
+    thread, a None on the queue tells it to stop"""
+    while True:
+        try:
+            request = connection.recv()
+        except (EOFError, OSError):
+            break
+        if request['op'] == 'stop':
+            break
+        if request['op'] == 'ping':
+            send({'id': request['id'], 'ok': True, 'result': 'pong'})
+            continue
+        requests.put(request)
+    requests.put(None)
+
+
+def serve(backend_path):
+    """Child process main loop, loads the backend once then answers requests until told to stop"""
+    authkey = bytes.fromhex(os.environ['LIGHTY_WORKER_AUTHKEY'])
+    with Listener(('127.0.0.1', 0), authkey=authkey) as listener:
+        print(listener.address[1], flush=True)
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())  # nobody reads our stdout past the port line
+        with listener.accept() as connection:
+            try:
+                backend = resolve_backend(backend_path)()
+                backend.load()
+            except Exception as e:
+                connection.send({'ok': False, 'error': f'{type(e).__name__}: {e}'})
+                return
+            connection.send({'ok': True})
+            send_lock = threading.Lock()
+
+            def send(response):
+                with send_lock:
+                    connection.send(response)
+
+            requests = queue.Queue()
+            threading.Thread(target=receive_requests, args=(connection, send, requests), daemon=True).start()
+            while True:
+                request = requests.get()
+                if request is None:
+                    return
+                try:
+                    result = getattr(backend, request['op'])(*request['args'], **request['kwargs'])
+                    if inspect.isgenerator(result):
+                        for chunk in result:
+                            send({'id': request['id'], 'ok': True, 'chunk': chunk})
+                        result = None
+                    send({'id': request['id'], 'ok': True, 'result': result})
+                except Exception as e:
+                    send({'id': request['id'], 'ok': False, 'error': f'{type(e).__name__}: {e}'})
+
+
+IMAGE_WORKERS = ModelWorkerPool('image', IMAGE_BACKENDS[SETTINGS.get('image_backend', ['sdxl'])[0]],
+                                SETTINGS.get('image_devices', ['cuda'])[0].split(','))
+LLM_WORKERS = ModelWorkerPool('llm', LLM_BACKENDS[SETTINGS.get('llm_backend', ['llama'])[0]],
+                              SETTINGS.get('llm_devices', ['cuda'])[0].split(','))
+RENDER_WORKERS = ModelWorkerPool('render', 'modules.card_renderer:CardRenderBackend',
+                                 ['cpu'] * int(SETTINGS.get('render_workers', ['2'])[0]))
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1])
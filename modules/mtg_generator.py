@@ -1,26 +1,36 @@
-"""This builds an MTG card"""
+"""This builds an MTG card. Every card has a seed that drives its own random.Random for the rolls and the seed of its
+art. In deterministic mode, set per request or with deterministic_generation, the seed also goes to the LLM and the
+output caches are keyed on it, so the same seed and prompt always build the same card."""
 import asyncio
-import json
 import random
-import subprocess
-import torch
-import gc
-import re
 from loguru import logger
-from PIL import Image, ImageFont, ImageDraw, ImageChops
+from PIL import Image
+from modules.card_data import ABILITY_POOLS, ARTIST_POOL
+from modules.llm_batcher import LLM_BATCHER
+from modules.model_worker import IMAGE_WORKERS, LLM_WORKERS, RENDER_WORKERS
+from modules.output_cache import ART_CACHE, TEXT_CACHE, cache_key, normalize_prompt
+from modules.settings import SETTINGS
+from modules.worker_supervisor import IMAGE_SUPERVISOR
 
-with open('assets/json/artist.json', 'r', encoding="utf-8") as file:
-    artist_data = json.load(file)
+DETERMINISTIC_GENERATION = SETTINGS.get('deterministic_generation', ['False'])[0] == 'True'
+CHECKPOINT_FIELDS = ('card_type', 'card_color', 'card_primary_mana', 'card_secondary_mana', 'card_creature_type',
+                     'card_title', 'card_flavor_text', 'card_artist')
 
 
 class MTGCardGenerator:
     """This object builds and contains the generated card."""
 
-    def __init__(self, action, prompt, channel, user):
+    def __init__(self, action, prompt, channel, user, fresh=False, seed=None, deterministic=None):
         self.action = action
         self.prompt = prompt
         self.channel = channel
         self.user = user
+        self.fresh = fresh
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        if deterministic is None:
+            deterministic = seed is not None or DETERMINISTIC_GENERATION
+        self.deterministic = deterministic
+        self.rng = random.Random(self.seed)
         self.card = None
         self.card_title = None
         self.card_flavor_text = None
@@ -31,108 +41,164 @@ class MTGCardGenerator:
         self.card_secondary_mana = None
         self.card_creature_type = None
         self.card_is_legendary = False
+        self.card_foil = None
+        self.card_signed = False
+        self.generated_image = None
+        self.upload_files = None
+        self.pack_string = None
+        self.pack = None
+        self.journal_id = None
+        self.queued_at = None
+        self.text_task = None
+        if action == 'lightycard_three_pack':
+            seed_rng = random.Random(self.seed)
+            self.pack = [MTGCardGenerator('lightycard', prompt, channel, user, fresh, seed_rng.getrandbits(32),
+                                          self.deterministic) for _ in range(3)]
 
     def __str__(self):
         return self.user
 
+    def get_cards(self):
+        """Returns the cards this request builds, the pack for a three pack and otherwise just this card"""
+        return self.pack if self.pack is not None else [self]
+
+    def get_checkpoint(self):
+        """Returns the rolls and texts of every card, everything the image stage onwards needs, as plain data"""
+        return {'cards': [{field: getattr(card, field) for field in CHECKPOINT_FIELDS} for card in self.get_cards()]}
+
+    def load_checkpoint(self, checkpoint, images=()):
+        """Restores the cards from get_checkpoint data and any art that was already generated"""
+        for card, card_checkpoint in zip(self.get_cards(), checkpoint['cards']):
+            for field in CHECKPOINT_FIELDS:
+                setattr(card, field, card_checkpoint[field])
+        for card, image in zip(self.get_cards(), images):
+            card.generated_image = image
+
+    def reseed(self, phase):
+        """Restarts the rng for one phase of building the card, so a card resumed from a checkpoint rolls the same as
+        one built in one go"""
+        self.rng = random.Random(f'{self.seed}:{phase}')
+
     @logger.catch()
     async def generate_card(self):
-        """Builds a PIL image containing a card"""
-        self.card_primary_mana = random.choice(range(1, 5))
-        self.card_secondary_mana = random.choice(range(0, 5))
+        """Builds a PIL image for the card, or for every card in the pack"""
+        await self.generate_card_texts()
+        await self.generate_card_images()
+        await self.composite_cards()
+
+    def start_card_texts(self):
+        """Starts rolling the cards and generating their texts in the background if that hasn't started yet, so the
+        queue lookahead can get it going before the job reaches the text stage. Returns the task."""
+        if self.text_task is None:
+            self.text_task = asyncio.create_task(self.run_card_texts())
+        return self.text_task
+
+    async def generate_card_texts(self):
+        """Waits for the card texts, reusing the work if the lookahead already started it"""
+        await self.start_card_texts()
+
+    async def run_card_texts(self):
+        """Rolls every card and generates their titles and flavor text, a pack shares one LLM batch"""
+        for card in self.get_cards():
+            card.roll_card()
+        await asyncio.gather(*(card.generate_card_text(card.get_text_card_type()) for card in self.get_cards()))
+
+    async def generate_card_images(self):
+        """Generates the art for every card in one image batch"""
+        generated_images = await self.generate_images([card.get_image_prompt() for card in self.get_cards()],
+                                                      [card.seed for card in self.get_cards()], self.fresh,
+                                                      self.deterministic)
+        for card, generated_image in zip(self.get_cards(), generated_images):
+            card.generated_image = generated_image
+
+    async def composite_cards(self):
+        """Composites every card on the render workers, a pack's cards render in parallel"""
+        card_specs = [card.build_card_spec(card.generated_image) for card in self.get_cards()]
+        rendered_cards = await asyncio.gather(*(RENDER_WORKERS.request('render', card_spec)
+                                                for card_spec in card_specs))
+        for card, (mode, size, pixels) in zip(self.get_cards(), rendered_cards):
+            card.card = Image.frombytes(mode, size, pixels)
+            card.generated_image = None
+
+    def roll_card(self):
+        """Rolls the mana and card type"""
+        self.reseed('card')
+        self.card_primary_mana = self.rng.choice(range(1, 5))
+        self.card_secondary_mana = self.rng.choice(range(0, 5))
         self.choose_card_type()
-        self.load_card_template()
         if self.is_creature_card():
-            await self.build_creature_card()
+            self.card_creature_type = self.generate_abilities('type_creature')
+
+    def get_text_card_type(self):
+        """Returns the card type named in the LLM prompts"""
+        if self.is_creature_card():
+            return 'creature'
         if self.is_land_card():
-            await self.build_land_card()
+            return 'land'
         if self.is_instant_card():
-            await self.build_instant_card()
+            return 'instant'
         if self.is_sorcery_card():
-            await self.build_sorcery_card()
+            return 'spell'
+        if self.is_artifact_card():
+            return 'artifact'
+        return 'enchant'
+
+    def get_image_prompt(self):
+        """Picks an artist and returns the image generation prompt for the card type"""
+        self.reseed('art')
+        if self.is_creature_card():
+            return self.get_creature_image_prompt()
+        if self.is_land_card():
+            return self.get_land_image_prompt()
         if self.is_artifact_card():
-            await self.build_artifact_card()
-        if self.is_enchant_card():
-            await self.build_enchant_card()
-
-    async def build_enchant_card(self):
-        """Builds an enchantment card"""
-        await self.generate_card_text('enchant')
-        await self.generate_spell_image()
-        self.roll_foil()
-        self.paste_title_text()
-        self.paste_artist_copyright()
-        self.paste_mana()
-        self.paste_type('Enchantment')
-        self.paste_ability('enchant')
-        self.roll_signature()
-
-    async def build_artifact_card(self):
-        """Builds an artifact card"""
-        await self.generate_card_text('artifact')
-        await self.generate_artifact_image()
-        self.roll_foil()
-        self.paste_title_text()
-        self.paste_artist_copyright()
-        self.paste_mana()
-        self.paste_type("Artifact")
-        self.paste_ability("artifact")
-        self.roll_signature()
-
-    async def build_instant_card(self):
-        """Builds an instant card"""
-        await self.generate_card_text('instant')
-        await self.generate_spell_image()
-        self.roll_foil()
-        self.paste_title_text()
-        self.paste_artist_copyright()
-        self.paste_mana()
-        self.paste_type("Instant")
-        self.paste_ability("instant")
-        self.roll_signature()
-
-    async def build_sorcery_card(self):
-        """Builds a sorcery card"""
-        await self.generate_card_text('spell')
-        await self.generate_spell_image()
-        self.roll_foil()
-        self.paste_title_text()
-        self.paste_artist_copyright()
-        self.paste_mana()
-        self.paste_type("Sorcery")
-        self.paste_ability("sorcery")
-        self.roll_signature()
-
-    async def build_creature_card(self):
-        """Builds a creature card"""
-        self.card_creature_type = self.generate_abilities('type_creature')
-        await self.generate_card_text('creature')
-        await self.generate_creature_image()
-        self.roll_foil()
-        self.paste_title_text()
-        self.paste_artist_copyright()
-        self.paste_creature_card_atk_def()
-        self.paste_mana()
-        self.paste_type(self.card_creature_type)
-        self.paste_ability("creature")
-        self.roll_signature()
-
-    async def build_land_card(self):
-        """Builds a land card"""
-        await self.generate_card_text('land')
-        await self.generate_land_image()
-        self.roll_foil()
-        self.paste_title_text()
-        self.paste_artist_copyright()
-        self.paste_land_abilities()
-        if self.card_is_legendary is True:
-            self.paste_type("Legendary Land")
+            return self.get_artifact_image_prompt()
+        return self.get_spell_image_prompt()
+
+    def build_card_spec(self, generated_image):
+        """Makes every random roll the compositing needs, in the order the card is drawn, and returns the picklable
+        card spec that card_renderer.render_card builds the card from"""
+        card_spec = {
+            'card_type': self.card_type,
+            'title': self.card_title,
+            'flavor_text': self.card_flavor_text,
+            'artist': self.card_artist,
+            'user': str(self.user),
+            'art': generated_image,
+            'foil': None,
+            'mana_slot_icon': None,
+            'mana_slots': None,
+            'ability_tokens': None,
+            'atk_def': None,
+            'land_mana_icon': None
+        }
+        self.reseed('render')
+        self.card_foil = card_spec['foil'] = self.roll_foil()
+        if self.is_land_card():
+            card_spec['land_mana_icon'] = self.roll_land_mana()
+            card_spec['type_line'] = "Legendary Land" if self.card_is_legendary else "Land"
         else:
-            self.paste_type("Land")
-        self.roll_signature()
+            if self.is_creature_card():
+                card_spec['atk_def'] = self.roll_creature_atk_def()
+            card_spec['mana_slot_icon'], card_spec['mana_slots'] = self.roll_mana()
+            card_spec['type_line'], ability_file = self.get_type_line_and_ability_file()
+            card_spec['ability_tokens'] = ABILITY_POOLS[ability_file].choice(self.rng)[1]
+        self.card_signed = card_spec['signed'] = self.roll_signature()
+        return card_spec
+
+    def get_type_line_and_ability_file(self):
+        """Returns the type line text and the ability pool for a non land card"""
+        if self.is_creature_card():
+            return self.card_creature_type, 'creature'
+        if self.is_instant_card():
+            return "Instant", 'instant'
+        if self.is_sorcery_card():
+            return "Sorcery", 'sorcery'
+        if self.is_artifact_card():
+            return "Artifact", 'artifact'
+        return 'Enchantment', 'enchant'
 
-    async def generate_land_image(self):
-        """Prepares the prompt and generates a land card image."""
+    def get_land_image_prompt(self):
+        """Returns the image prompt for a land card."""
         self.card_artist = self.get_random_artist_prompt()
         land_color_mapping = {
             'artifact_land': f'{self.prompt} bald man in front of structure. {self.card_artist}. beard',
@@ -142,47 +208,46 @@ class MTGCardGenerator:
             'green_land': f'{self.prompt} bald man in a forest. {self.card_artist}. beard',
             'red_land': f'{self.prompt} bald man in the mountains. {self.card_artist}. beard'
         }
-        generation_prompt = land_color_mapping.get(self.card_type, 'error')
-        await self.generate_image(generation_prompt)
+        return land_color_mapping.get(self.card_type, 'error')
 
-    async def generate_creature_image(self):
-        """Prepares the prompt and generates a creature card image."""
+    def get_creature_image_prompt(self):
+        """Returns the image prompt for a creature card."""
         self.card_artist = self.get_random_artist_prompt()
-        generation_prompt = f"{self.prompt} bald man. {self.card_artist}. {self.card_title}. beard."
-        await self.generate_image(generation_prompt)
+        return f"{self.prompt} bald man. {self.card_artist}. {self.card_title}. beard."
 
-    async def generate_spell_image(self):
-        """Prepares the prompt and generates a spell card image."""
+    def get_spell_image_prompt(self):
+        """Returns the image prompt for a spell card."""
         self.card_artist = self.get_random_artist_prompt()
-        generation_prompt = f"bald man casting {self.prompt}. {self.card_artist}. {self.card_title}. beard"
-        await self.generate_image(generation_prompt)
+        return f"bald man casting {self.prompt}. {self.card_artist}. {self.card_title}. beard"
 
-    async def generate_artifact_image(self):
-        """Prepares the prompt and generates an artifact card image."""
+    def get_artifact_image_prompt(self):
+        """Returns the image prompt for an artifact card."""
         self.card_artist = self.get_random_artist_prompt()
-        generation_prompt = f"bald man holding {self.prompt} artifact. {self.card_artist}. {self.card_title}. beard"
-        await self.generate_image(generation_prompt)
-
-    async def generate_image(self, generation_prompt):
-        """Generates a card image based on the prompt, then paste it onto the card"""
-        torch.cuda.empty_cache()
-        gc.collect()
-        success = False
-        while not success:
-            script_result = await asyncio.to_thread(
-                subprocess.run,
-                ['python', 'modules/generate_card_art.py', generation_prompt],
-                capture_output=True
-            )
-            if script_result.returncode == 0:
-                success = True
-            else:
-                print(f"Script failed with error: {script_result.stderr.decode()}. Retrying...")
-        torch.cuda.empty_cache()
-        gc.collect()
-        image_path = 'assets/generated_image.png'
-        generated_image = Image.open(image_path)
-        self.card.paste(generated_image, (88, 102))
+        return f"bald man holding {self.prompt} artifact. {self.card_artist}. {self.card_title}. beard"
+
+    @staticmethod
+    async def generate_images(generation_prompts, seeds, fresh=False, deterministic=False):
+        """Generates one card image per prompt and seed in a single batch on the image worker. With the output cache
+        on, art already made for a prompt is reused unless fresh is set, and only the rest are generated.
+        Deterministic art is only reused for the same seed."""
+        model, sampling = IMAGE_WORKERS.backend_constant('MODEL_ID'), IMAGE_WORKERS.backend_constant('SAMPLING')
+        cache_keys = [cache_key(kind='card_art', prompt=normalize_prompt(prompt), model=model, sampling=sampling,
+                                lora=SETTINGS.get('sdxl_lora', [''])[0], seed=seed if deterministic else None)
+                      for prompt, seed in zip(generation_prompts, seeds)]
+        generated_images = [None] * len(generation_prompts)
+        if ART_CACHE.enabled and not fresh:
+            generated_images = await asyncio.gather(*(asyncio.to_thread(ART_CACHE.get, key) for key in cache_keys))
+        missing = [index for index, image in enumerate(generated_images) if image is None]
+        if not missing:
+            return generated_images
+
+        new_images = await IMAGE_SUPERVISOR.request('generate_batch', [generation_prompts[index] for index in missing],
+                                                    [seeds[index] for index in missing])
+        for index, image in zip(missing, new_images):
+            generated_images[index] = image
+            if ART_CACHE.enabled:
+                await asyncio.to_thread(ART_CACHE.put, cache_keys[index], image)
+        return generated_images
 
     async def generate_card_text(self, card_type):
         """Generates and returns a card title and card flavor text"""
@@ -192,298 +257,131 @@ class MTGCardGenerator:
         flavor_messages = [{"role": "system",
                            "content": f"You create a new random Magic The Gathering {card_type} card flavor text based on the prompt. You respond with ONLY the flavor text."},
                            {"role": "user", "content": self.prompt}]
+        text_key = cache_key(kind='card_text', card_type=card_type, prompt=normalize_prompt(self.prompt),
+                             model=LLM_WORKERS.backend_constant('MODEL_ID'),
+                             sampling=LLM_WORKERS.backend_constant('SAMPLING'),
+                             seed=self.seed if self.deterministic else None)
+        if TEXT_CACHE.enabled and not self.fresh:
+            cached_text = await asyncio.to_thread(TEXT_CACHE.get, text_key)
+            if cached_text is not None:
+                self.card_title, self.card_flavor_text = cached_text
+                return
         await self.generate_text(title_messages, flavor_messages)
+        if TEXT_CACHE.enabled:
+            await asyncio.to_thread(TEXT_CACHE.put, text_key, [self.card_title, self.card_flavor_text])
 
     async def generate_text(self, title_messages, flavor_messages):
-        """Generates card title and flavortext"""
-        self.write_llm_prompts_to_file(title_messages, flavor_messages)
-        torch.cuda.empty_cache()
-        gc.collect()
-        script_result = await asyncio.to_thread(
-            subprocess.run,
-            ['python', 'modules/generate_text.py'],
-            capture_output=True
+        """Generates card title and flavortext. Deterministic cards pass their seed, which keeps both in a batch of
+        their own"""
+        sampling = {'seed': self.seed} if self.deterministic else {}
+        title, self.card_flavor_text = await asyncio.gather(
+            LLM_BATCHER.generate(title_messages, **sampling),
+            LLM_BATCHER.generate(flavor_messages, **sampling)
         )
-        if script_result.returncode != 0:
-            raise RuntimeError(f"Script failed with error: {script_result.stderr.decode()}")
-        torch.cuda.empty_cache()
-        gc.collect()
-        with open('assets/json/generated_output.json', 'r', encoding="utf-8") as generated_output_file:
-            data = json.load(generated_output_file)
-        prompt_variables = {}
-        for key, value in data.items():
-            prompt_variables[key] = value
-        self.card_title = prompt_variables['prompt1'].replace('\n', ' ').replace('\r', ' ')[:25]
-        self.card_flavor_text = prompt_variables['prompt2']
-
-    def paste_land_abilities(self):
-        """Adds land text and mana icons to a card"""
-        font = ImageFont.truetype("assets/fonts/garamond.ttf", 36)
-        draw = ImageDraw.Draw(self.card)
-        draw.text((235, 668), "Tap to add", font=font, fill="black")
-        draw.text((235, 713), "to your mana pool.", font=font, fill="black")
+        self.card_title = title.replace('\n', ' ').replace('\r', ' ')[:25]
 
+    def roll_land_mana(self):
+        """Rolls the mana a land taps for, a land that taps for more than one is legendary. Returns the icon name"""
         if self.card_color == 'artifact':
-            if random.randint(1, 10) == 1:
-                base_image_path = f"assets/icons/{random.randint(2, 4)}mana.png"
+            if self.rng.randint(1, 10) == 1:
                 self.card_is_legendary = True
-            else:
-                base_image_path = f"assets/icons/1mana.png"
-        else:
-            if random.randint(1, 10) == 1:
-                base_image_path = f'assets/icons/{random.randint(1, 4)}{self.card_color}mana.png'
-                self.card_is_legendary = True
-            else:
-                base_image_path = f'assets/icons/{self.card_color}mana.png'
-        mana_image = Image.open(base_image_path)
-        mana_image_width, mana_image_height = mana_image.size
-        combined_mana_image = Image.new('RGBA', (mana_image_width, mana_image_height))
-        combined_mana_image.paste(mana_image, (0, 0))
-        self.card.paste(combined_mana_image, (392, 665), combined_mana_image)
-
-        x_start, y_start = 94, 800
-        ability_list = self.card_flavor_text
-        pattern = r'(\{[^}]+\}|\S+|\n)'
-        words = re.findall(pattern, ability_list)
-        font = ImageFont.truetype("assets/fonts/garamonditalic.ttf", 36)
-        current_x, current_y = x_start, y_start
-
-        for word in words:
-            if word == "\n":
-                current_x = x_start  # Move to the beginning of the next line
-                current_y += 32
-                continue
-            bbox = draw.textbbox((0, 0), word, font=font)
-            word_width = bbox[2] - bbox[0]
-            if current_x + word_width > 659:
-                current_x = x_start
-                current_y += 32
-            draw.text((current_x, current_y), word, font=font, fill="black")
-            current_x += word_width + draw.textbbox((0, 0), ' ', font=font)[2]
+                return f"{self.rng.randint(2, 4)}mana"
+            return "1mana"
+        if self.rng.randint(1, 10) == 1:
+            self.card_is_legendary = True
+            return f'{self.rng.randint(1, 4)}{self.card_color}mana'
+        return f'{self.card_color}mana'
 
     def roll_signature(self):
-        """Rolls to see if a card is signed, and if so adds the signature texture"""
-        if random.randint(1, 100) == 1:
-            signature_image = 'assets/foils/signature.png'
-            with Image.open(signature_image).convert("RGBA") as signature_texture:
-                self.card.paste(signature_texture, (100, 590), signature_texture)
-
-    def paste_type(self, card_type):
-        """Adds creature type to a card"""
-        font = ImageFont.truetype("assets/fonts/garamond.ttf", 36)
-        draw = ImageDraw.Draw(self.card)
-        draw.text((88, 582), card_type, font=font, fill="black")
-        draw.text((86, 580), card_type, font=font, fill="white")
+        """Rolls to see if a card is signed"""
+        return self.rng.randint(1, 100) == 1
 
-    @staticmethod
-    def generate_abilities(ability_file):
+    def generate_abilities(self, ability_file):
         """Returns a random card ability from the specified json file."""
-        with open(f"assets/json/{ability_file}.json", 'r') as instant_file:
-            data = json.load(instant_file)
-        return random.choice(data)
-
-    def paste_creature_card_atk_def(self):
-        """Rolls the creature atk/def based on mana, then applies it to the card"""
-        font = ImageFont.truetype("assets/fonts/planewalker.otf", 44)
-        draw = ImageDraw.Draw(self.card)
+        return ABILITY_POOLS[ability_file].choice(self.rng)[0]
 
+    def roll_creature_atk_def(self):
+        """Rolls the creature atk/def based on mana and returns it as card text"""
         if self.card_color == 'gold':
-            creature_def = random.choice(range(1, self.card_primary_mana * 2))
-            creature_atk = random.choice(range(0, self.card_primary_mana * 2))
+            creature_def = self.rng.choice(range(1, self.card_primary_mana * 2))
+            creature_atk = self.rng.choice(range(0, self.card_primary_mana * 2))
 
         if self.card_color in ['green', 'red', 'black', 'white', 'blue', 'artifact']:
             minimum_def = max(1, (self.card_primary_mana + self.card_secondary_mana) // 2)
             if minimum_def == self.card_primary_mana + self.card_secondary_mana:
                 creature_def = self.card_primary_mana + self.card_secondary_mana
             else:
-                creature_def = random.choice(range(minimum_def, self.card_primary_mana + self.card_secondary_mana))
-            creature_atk = random.choice(range(0, self.card_primary_mana + self.card_secondary_mana))
+                creature_def = self.rng.choice(range(minimum_def, self.card_primary_mana + self.card_secondary_mana))
+            creature_atk = self.rng.choice(range(0, self.card_primary_mana + self.card_secondary_mana))
 
-        draw.text((622, 936), f'{creature_atk}/{creature_def}', font=font, fill="black")
-        draw.text((620, 934), f'{creature_atk}/{creature_def}', font=font, fill="white")
+        return f'{creature_atk}/{creature_def}'
 
-    def paste_mana(self):
-        """Creates and adds mana icons to a card based on its color"""
+    def roll_mana(self):
+        """Rolls the mana icons for the casting cost. Returns the icon that sets the slot size and the icon for each
+        slot, None for an empty slot"""
         if self.card_color in ['green', 'red', 'black', 'white', 'blue']:
-            primary_mana_image = Image.open(f"assets/icons/{self.card_color}mana.png")
-            secondary_mana_image = Image.open(f"assets/icons/{self.card_secondary_mana}mana.png")
+            primary_mana_icon = f"{self.card_color}mana"
+            secondary_mana_icon = f"{self.card_secondary_mana}mana"
         if self.card_color == 'artifact':
-            primary_mana_image = Image.open(f"assets/icons/{self.card_secondary_mana + self.card_primary_mana}mana.png")
+            primary_mana_icon = f"{self.card_secondary_mana + self.card_primary_mana}mana"
             self.card_secondary_mana = 0
         if self.card_color == 'gold':
-            primary_mana_image = Image.open(f"assets/icons/{self.card_secondary_mana}mana.png")
-            secondary_mana_image = Image.open(f"assets/icons/{self.card_secondary_mana}mana.png")
+            primary_mana_icon = f"{self.card_secondary_mana}mana"
+            secondary_mana_icon = f"{self.card_secondary_mana}mana"
 
-        primary_mana_width, primary_mana_height = primary_mana_image.size
-        if self.card_color in ['green', 'red', 'black', 'white', 'blue']:
-            combined_mana_width = primary_mana_width + (primary_mana_width * self.card_primary_mana)
+        use_secondary_mana = self.rng.randint(0, 2) == 1
         if self.card_color == 'artifact':
-            combined_mana_width = primary_mana_width
+            return primary_mana_icon, [primary_mana_icon]
+        mana_slots = [secondary_mana_icon if use_secondary_mana and self.card_secondary_mana >= 1 else None]
         if self.card_color == 'gold':
-            combined_mana_width = primary_mana_width + (primary_mana_width * self.card_primary_mana)
-        combined_mana_image = Image.new('RGBA', (combined_mana_width, primary_mana_height))
-
-        if random.randint(0, 2) != 1:
-            use_secondary_mana = False
-        else:
-            use_secondary_mana = True
-        if use_secondary_mana:
-            if self.card_secondary_mana >= 1:
-                combined_mana_image.paste(secondary_mana_image, (0, 0))
-
-        if self.card_color in ['green', 'red', 'black', 'white', 'blue']:
-            for i in range(self.card_primary_mana):
-                combined_mana_image.paste(primary_mana_image, (primary_mana_width + i * primary_mana_width, 0))
-        if self.card_color == 'artifact':
-            combined_mana_image.paste(primary_mana_image, (0, 0))
-        if self.card_color == 'gold':
-            image_paths = [
-                'assets/icons/redmana.png',
-                'assets/icons/blackmana.png',
-                'assets/icons/whitemana.png',
-                'assets/icons/greenmana.png',
-                'assets/icons/bluemana.png'
+            icon_names = [
+                'redmana',
+                'blackmana',
+                'whitemana',
+                'greenmana',
+                'bluemana'
             ]
-            for i in range(self.card_primary_mana):
-                primary_mana_image = Image.open(random.choice(image_paths))
-                combined_mana_image.paste(primary_mana_image, (primary_mana_width + i * primary_mana_width, 0))
-        self.card.paste(combined_mana_image, (676 - combined_mana_image.width, 49), combined_mana_image)
-
-    def paste_artist_copyright(self):
-        """Adds artist and copyright text to a card"""
-        font = ImageFont.truetype("assets/fonts/garamond.ttf", 32)
-        draw = ImageDraw.Draw(self.card)
-        draw.text((72, 942), f"Illus. {self.card_artist}", font=font, fill="black")
-        draw.text((70, 940), f"Illus. {self.card_artist}", font=font, fill="white")
-        font = ImageFont.truetype("assets/fonts/garamond.ttf", 20)
-        draw.text((72, 975), f"© 1994 {self.user} - Lightys Homeless Shelter.", font=font, fill="black")
-        draw.text((70, 973), f"© 1994 {self.user} - Lightys Homeless Shelter.", font=font, fill="white")
-
-    def paste_title_text(self):
-        """Adds card title to a card"""
-        font = ImageFont.truetype("assets/fonts/planewalker.otf", 36)
-        draw = ImageDraw.Draw(self.card)
-        draw.text((58, 52), self.card_title, font=font, fill="black")
-        draw.text((56, 50), self.card_title, font=font, fill="white")
+            mana_slots += [self.rng.choice(icon_names) for _ in range(self.card_primary_mana)]
+        else:
+            mana_slots += [primary_mana_icon] * self.card_primary_mana
+        return primary_mana_icon, mana_slots
 
     def roll_foil(self):
-        """Rolls to see if a card is foil, and if so adds the foil texture and foil set icon"""
-        if random.randint(1, 50) == 1:
+        """Rolls to see if a card is foil, returns the foil texture name or None"""
+        if self.rng.randint(1, 50) == 1:
             foil_mapping = {
-                'artifact_creature': 'assets/foils/foil1.png',
-                'black_creature': 'assets/foils/foil1.png',
-                'green_creature': 'assets/foils/foil1.png',
-                'blue_creature': 'assets/foils/foil2.png',
-                'gold_creature': 'assets/foils/foil3.png',
-                'red_creature': 'assets/foils/foil4.png',
-                'white_creature': 'assets/foils/foil5.png',
-                'artifact_land': 'assets/foils/foil1.png',
-                'black_land': 'assets/foils/foil1.png',
-                'green_land': 'assets/foils/foil1.png',
-                'blue_land': 'assets/foils/foil2.png',
-                'red_land': 'assets/foils/foil4.png',
-                'white_land': 'assets/foils/foil5.png',
-                'black_instant': 'assets/foils/foil1.png',
-                'green_instant': 'assets/foils/foil1.png',
-                'blue_instant': 'assets/foils/foil2.png',
-                'red_instant': 'assets/foils/foil4.png',
-                'white_instant': 'assets/foils/foil5.png',
-                'black_sorcery': 'assets/foils/foil1.png',
-                'green_sorcery': 'assets/foils/foil1.png',
-                'blue_sorcery': 'assets/foils/foil2.png',
-                'red_sorcery': 'assets/foils/foil4.png',
-                'white_sorcery': 'assets/foils/foil5.png',
-                'black_enchant': 'assets/foils/foil1.png',
-                'green_enchant': 'assets/foils/foil1.png',
-                'blue_enchant': 'assets/foils/foil2.png',
-                'red_enchant': 'assets/foils/foil4.png',
-                'white_enchant': 'assets/foils/foil5.png'
+                'artifact': 'foil1',
+                'artifact_creature': 'foil1',
+                'black_creature': 'foil1',
+                'green_creature': 'foil1',
+                'blue_creature': 'foil2',
+                'gold_creature': 'foil3',
+                'red_creature': 'foil4',
+                'white_creature': 'foil5',
+                'artifact_land': 'foil1',
+                'black_land': 'foil1',
+                'green_land': 'foil1',
+                'blue_land': 'foil2',
+                'red_land': 'foil4',
+                'white_land': 'foil5',
+                'black_instant': 'foil1',
+                'green_instant': 'foil1',
+                'blue_instant': 'foil2',
+                'red_instant': 'foil4',
+                'white_instant': 'foil5',
+                'black_sorcery': 'foil1',
+                'green_sorcery': 'foil1',
+                'blue_sorcery': 'foil2',
+                'red_sorcery': 'foil4',
+                'white_sorcery': 'foil5',
+                'black_enchant': 'foil1',
+                'green_enchant': 'foil1',
+                'blue_enchant': 'foil2',
+                'red_enchant': 'foil4',
+                'white_enchant': 'foil5'
             }
-            foil_image = foil_mapping.get(self.card_type, 'error')
-            with Image.open(foil_image).convert("RGBA") as foil_texture:
-                resized_foil_texture = foil_texture.resize(self.card.size)
-                self.card = ImageChops.soft_light(self.card, resized_foil_texture)
-                icon_image = Image.open("assets/icons/foilicon.png")
-                self.card.paste(icon_image, (600, 585), icon_image)
-            return
-        icon_image = Image.open("assets/icons/set_icon.png")
-        self.card.paste(icon_image, (619, 579), icon_image)
-
-    def paste_ability(self, ability_file):
-        """Draws a list of words onto an image, parsing mana symbols and wrapping to a new line if the text exceeds
-        max_width."""
-        mana_mapping = {
-            '{W}': 'assets/icons/white_mana_small.png',
-            '{U}': 'assets/icons/blue_mana_small.png',
-            '{B}': 'assets/icons/black_mana_small.png',
-            '{R}': 'assets/icons/red_mana_small.png',
-            '{G}': 'assets/icons/green_mana_small.png',
-            '{T}': 'assets/icons/tap.png',
-            '{0}': 'assets/icons/0_mana_small.png',
-            '{1}': 'assets/icons/1_mana_small.png',
-            '{2}': 'assets/icons/2_mana_small.png',
-            '{3}': 'assets/icons/3_mana_small.png',
-            '{4}': 'assets/icons/4_mana_small.png',
-            '{5}': 'assets/icons/5_mana_small.png',
-            '{6}': 'assets/icons/6_mana_small.png',
-            '{7}': 'assets/icons/7_mana_small.png',
-            '{8}': 'assets/icons/8_mana_small.png',
-            '{9}': 'assets/icons/9_mana_small.png',
-            '{X}': 'assets/icons/x_mana_small.png',
-        }
-
-        x_start, y_start = 94, 640
-        draw = ImageDraw.Draw(self.card)
-        ability_list = self.generate_abilities(ability_file)
-        pattern = r'(\{[^}]+\}|\S+|\n)'
-        words = re.findall(pattern, ability_list)
-        font = ImageFont.truetype("assets/fonts/garamondbullet.ttf", 36)
-        line_height = 32
-        current_x, current_y = x_start, y_start
-
-        for word in words:
-            if word == "\n":
-                current_x = x_start  # Move to the beginning of the next line
-                current_y += line_height
-                continue
-            match = re.match(r'\{[A-Za-z0-9]\}', word)
-            if match:
-                mana_image = mana_mapping.get(match.group(0), 'error')
-                uncolored_image = Image.open(mana_image)
-                uncolored_width, uncolored_height = uncolored_image.size
-                image_bbox = (current_x, current_y, current_x + uncolored_width, current_y + uncolored_height)
-                if image_bbox[2] > 659:
-                    # If image exceeds the width, move to the next line
-                    current_x = x_start
-                    current_y += uncolored_height
-                self.card.paste(uncolored_image, (current_x, current_y), uncolored_image)
-                current_x += uncolored_width
-                continue
-            bbox = draw.textbbox((0, 0), word, font=font)
-            word_width = bbox[2] - bbox[0]
-            if current_x + word_width > 659:
-                current_x = x_start
-                current_y += line_height
-            draw.text((current_x, current_y), word, font=font, fill="black")
-            current_x += word_width + draw.textbbox((0, 0), ' ', font=font)[2]
-
-        current_x = x_start
-        current_y += line_height
-        if current_y <= 805:
-            second_words = re.findall(pattern, self.card_flavor_text)
-            second_font = ImageFont.truetype("assets/fonts/garamonditalic.ttf", 36)
-            for word in second_words:
-                if word == "\n":
-                    current_x = x_start
-                    current_y += line_height
-                    continue
-                bbox = draw.textbbox((0, 0), word, font=second_font)
-                word_width = bbox[2] - bbox[0]
-                if current_x + word_width > 659:
-                    current_x = x_start
-                    current_y += line_height
-                draw.text((current_x, current_y), word, font=second_font, fill="black")
-                current_x += word_width + draw.textbbox((0, 0), ' ', font=second_font)[2]
+            return foil_mapping.get(self.card_type, 'error')
+        return None
 
     def is_artifact_card(self):
         """Checks if the card type is an artifact"""
@@ -550,15 +448,9 @@ class MTGCardGenerator:
         ]
         return self.card_type in enchant_card_types
 
-    def load_card_template(self):
-        """Loads the base card template"""
-        image_path = f"assets/templates/{self.card_type}.png"
-        with Image.open(image_path) as card_image:
-            self.card = card_image.copy()
-
     def choose_card_type(self):
         """Returns a random card type and associated color"""
-        base_card_type = random.sample(['instant', 'sorcery', 'land', 'creature', 'artifact', 'enchant'], 1)[0]
+        base_card_type = self.rng.sample(['instant', 'sorcery', 'land', 'creature', 'artifact', 'enchant'], 1)[0]
         # base_card_type = 'enchant'  # Override for debugging.
         if base_card_type == 'instant':
             card_types = [
@@ -568,7 +460,7 @@ class MTGCardGenerator:
                 'red_instant',
                 'white_instant',
             ]
-            self.card_type = random.choice(card_types)
+            self.card_type = self.rng.choice(card_types)
 
         if base_card_type == 'sorcery':
             card_types = [
@@ -578,7 +470,7 @@ class MTGCardGenerator:
                 'red_sorcery',
                 'white_sorcery',
             ]
-            self.card_type = random.choice(card_types)
+            self.card_type = self.rng.choice(card_types)
 
         if base_card_type == 'land':
             card_types = [
@@ -589,7 +481,7 @@ class MTGCardGenerator:
                 'red_land',
                 'white_land',
             ]
-            self.card_type = random.choice(card_types)
+            self.card_type = self.rng.choice(card_types)
 
         if base_card_type == 'creature':
             card_types = [
@@ -601,13 +493,13 @@ class MTGCardGenerator:
                 'red_creature',
                 'white_creature',
             ]
-            self.card_type = random.choice(card_types)
+            self.card_type = self.rng.choice(card_types)
 
         if base_card_type == 'artifact':
             card_types = [
                 'artifact'
             ]
-            self.card_type = random.choice(card_types)
+            self.card_type = self.rng.choice(card_types)
 
         if base_card_type == 'enchant':
             card_types = [
@@ -617,7 +509,7 @@ class MTGCardGenerator:
                 'red_enchant',
                 'white_enchant',
             ]
-            self.card_type = random.choice(card_types)
+            self.card_type = self.rng.choice(card_types)
 
         card_color_mapping = {
             'artifact_creature': 'artifact',
@@ -652,17 +544,6 @@ class MTGCardGenerator:
         }
         self.card_color = card_color_mapping.get(self.card_type, 'error')
 
-    @staticmethod
-    def write_llm_prompts_to_file(*prompt_sets):
-        """Writes the prompt to a file for use by the llm script"""
-        all_prompts = []
-        for prompts in prompt_sets:
-            all_prompts.append(prompts)
-        with open('assets/json/llm_prompt.json', 'w', encoding="utf-8") as llm_prompt_file:
-            json.dump(all_prompts, llm_prompt_file, indent=4)
-
-    @staticmethod
-    def get_random_artist_prompt():
+    def get_random_artist_prompt(self):
         """Returns a string containing a random artist from a csv file full of artists"""
-        selected_artist = random.choice(artist_data)
-        return selected_artist.get('prompt')
+        return ARTIST_POOL.choice(self.rng)[0]
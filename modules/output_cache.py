@@ -0,0 +1,182 @@
+"""Opt in cache for model outputs, card titles and flavor text from the LLM and raw art from the image model, so the
+same prompt spammed by viewers doesn't rerun the models every time. Entries are keyed on the normalized prompt and
+everything else that changes the output, the model id, the lora and the sampling params.
+
+Each cache is an in memory LRU in front of a disk tier, both bounded in size, and entries older than the ttl are
+treated as missing. Hits and misses are counted so the hit rate can be weighed against the lost variety."""
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from loguru import logger
+from PIL import Image
+from modules.settings import SETTINGS
+
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+def normalize_prompt(prompt):
+    """Returns the prompt lowercased with runs of whitespace collapsed, so trivially different prompts share entries"""
+    return WHITESPACE_PATTERN.sub(' ', prompt).strip().lower()
+
+
+def cache_key(**inputs):
+    """Returns a stable hash of everything that affects a model output"""
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class OutputCache:
+    """One LRU plus disk cache. encode and decode turn a value into bytes for the disk tier and back."""
+    def __init__(self, name, encode, decode, extension, enabled, max_entries, ttl, disk_dir, max_disk_bytes):
+        self.name = name
+        self.encode = encode
+        self.decode = decode
+        self.extension = extension
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = os.path.join(disk_dir, name) if disk_dir else None
+        self.max_disk_bytes = max_disk_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def disk_path(self, key):
+        """Returns where an entry lives on disk"""
+        return os.path.join(self.disk_dir, key[:2], f'{key}.{self.extension}')
+
+    def get(self, key):
+        """Returns the cached value or None if it is missing or expired"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[0] <= self.ttl:
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry[1]
+            self.entries.pop(key, None)
+        if self.disk_dir is not None:
+            path = self.disk_path(key)
+            try:
+                stored_at = os.stat(path).st_mtime
+                if now - stored_at <= self.ttl:
+                    with open(path, 'rb') as cache_file:
+                        value = self.decode(cache_file.read())
+                    with self.lock:
+                        self.disk_hits += 1
+                        self.remember(key, value, stored_at)
+                    return value
+            except (OSError, ValueError):
+                pass
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """Stores a value in memory and on disk"""
+        with self.lock:
+            self.stores += 1
+            self.remember(key, value, time.time())
+        if self.disk_dir is not None:
+            path = self.disk_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(temp_path, 'wb') as cache_file:
+                cache_file.write(self.encode(value))
+            os.replace(temp_path, path)
+            if self.stores % 100 == 0:
+                self.prune_disk()
+
+    def remember(self, key, value, stored_at):
+        """Puts an entry at the front of the LRU, dropping the least recently used past max_entries. Lock held."""
+        self.entries[key] = (stored_at, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def prune_disk(self):
+        """Deletes expired entries and then the oldest ones until the disk tier fits in max_disk_bytes"""
+        now = time.time()
+        files = []
+        for dir_path, _, file_names in os.walk(self.disk_dir):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                try:
+                    file_stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((file_stat.st_mtime, file_stat.st_size, path))
+        files.sort()
+        total_bytes = sum(size for _, size, _ in files)
+        for stored_at, size, path in files:
+            if now - stored_at <= self.ttl and total_bytes <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_bytes -= size
+
+    def state(self):
+        """Returns the hit and miss counts and the hit rate"""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'entries': len(self.entries),
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'hit_rate': round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else 0.0
+        }
+
+    def log_state(self):
+        """Logs the cache stats"""
+        logger.bind(cache=self.name, **self.state()).info("Output Cache Stats")
+
+
+def encode_text(value):
+    """Returns a json serializable value as bytes"""
+    return json.dumps(value).encode('utf-8')
+
+
+def decode_text(data):
+    """Returns the value from encode_text bytes"""
+    return json.loads(data)
+
+
+def encode_image(image):
+    """Returns an image as lossless png bytes"""
+    with io.BytesIO() as file_object:
+        image.save(file_object, format='PNG', compress_level=1)
+        return file_object.getvalue()
+
+
+def decode_image(data):
+    """Returns png bytes decoded into an image"""
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        return image.copy()
+
+
+def build_cache(name, encode, decode, extension):
+    """Builds a cache configured by the output_cache settings"""
+    return OutputCache(
+        name, encode, decode, extension,
+        SETTINGS.get('output_cache', ['False'])[0] == 'True',
+        int(SETTINGS.get('output_cache_entries', [256])[0]),
+        int(SETTINGS.get('output_cache_ttl', [86400])[0]),
+        SETTINGS.get('output_cache_dir', ['cache'])[0],
+        int(SETTINGS.get('output_cache_disk_mb', [2048])[0]) * 1048576
+    )
+
+
+TEXT_CACHE = build_cache('text', encode_text, decode_text, 'json')
+ART_CACHE = build_cache('art', encode_image, decode_image, 'png')
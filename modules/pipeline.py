@@ -0,0 +1,120 @@
+"""Splits job processing into stages joined by bounded queues, so one job's inference overlaps another's upload"""
+import asyncio
+import time
+from loguru import logger
+from modules.metrics import METRICS
+
+
+class PipelineStage:
+    """One step of the pipeline with its own bounded input queue and worker tasks. Jobs whose action is not in
+    actions skip the stage."""
+    def __init__(self, name, handler, actions, workers=1, queue_size=1):
+        self.name = name
+        self.handler = handler
+        self.actions = actions
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.busy = 0
+        self.processed = 0
+        self.failed = 0
+
+    def state(self):
+        """Returns how many jobs are waiting for and being worked on by this stage"""
+        return {
+            'queued': self.queue.qsize(),
+            'busy': self.busy,
+            'workers': self.workers,
+            'processed': self.processed,
+            'failed': self.failed
+        }
+
+
+class GenerationPipeline:
+    """Runs each job through the stages in order and calls on_done with the job and any exception once it leaves.
+    If on_stage_done is set it is called with the job, the stage name and the seconds the stage spent on the job after
+    every stage the job finishes. A
+    callback that raises is logged and the job carries on, so it never takes a stage worker down with it."""
+    def __init__(self, stages, on_done, on_stage_done=None):
+        self.stages = stages
+        self.on_done = on_done
+        self.on_stage_done = on_stage_done
+        self.worker_tasks = []
+
+    def start(self):
+        """Starts the worker tasks for every stage"""
+        for index, stage in enumerate(self.stages):
+            for _ in range(stage.workers):
+                self.start_worker(index)
+
+    def start_worker(self, index):
+        """Starts one worker task for a stage, it is started again if it ever dies"""
+        worker_task = asyncio.create_task(self.run_stage_worker(index))
+        worker_task.add_done_callback(lambda task: self.restart_worker(task, index))
+        self.worker_tasks.append(worker_task)
+
+    def restart_worker(self, worker_task, index):
+        """Done callback of the worker tasks, replaces a worker that died"""
+        self.worker_tasks.remove(worker_task)
+        if worker_task.cancelled():
+            return
+        logger.bind(stage=self.stages[index].name, error=repr(worker_task.exception())).error(
+            "Pipeline Worker Died, Restarting")
+        self.start_worker(index)
+
+    async def put(self, job, stage_index=0):
+        """Hands a job to the first stage at or after stage_index that handles its action, waiting for room"""
+        for index in range(stage_index, len(self.stages)):
+            if job.action in self.stages[index].actions:
+                await self.stages[index].queue.put(job)
+                return
+        await self.finish(job, None)
+
+    async def finish(self, job, error):
+        """Calls on_done for a job leaving the pipeline, logging instead of raising if it fails"""
+        try:
+            await self.on_done(job, error)
+        except Exception as e:
+            logger.bind(user=f'{job.user}', prompt=job.prompt).error(f'EXCEPTION: {e}')
+
+    async def run_stage_worker(self, index):
+        """Pulls jobs off a stage's queue forever, runs the handler and passes them along"""
+        stage = self.stages[index]
+        while True:
+            job = await stage.queue.get()
+            stage.busy += 1
+            started_at = time.perf_counter()
+            try:
+                with METRICS.span(stage.name, job):
+                    await stage.handler(job)
+            except Exception as e:
+                stage.failed += 1
+                logger.bind(stage=stage.name, user=f'{job.user}', prompt=job.prompt).error(f'EXCEPTION: {e}')
+                await self.finish(job, e)
+                continue
+            else:
+                stage.processed += 1
+                stage_seconds = time.perf_counter() - started_at
+            finally:
+                stage.busy -= 1
+                stage.queue.task_done()
+            if self.on_stage_done is not None:
+                try:
+                    await self.on_stage_done(job, stage.name, stage_seconds)
+                except Exception as e:  # a missed checkpoint only costs the job its resume point
+                    logger.bind(stage=stage.name, user=f'{job.user}', prompt=job.prompt).error(f'EXCEPTION: {e}')
+            await self.put(job, index + 1)
+
+    def stage_index(self, name):
+        """Returns the position of the stage with this name, None if the pipeline has no such stage"""
+        for index, stage in enumerate(self.stages):
+            if stage.name == name:
+                return index
+        return None
+
+    def is_busy(self):
+        """Returns true if any stage has a job waiting or in progress"""
+        return any(stage.busy or stage.queue.qsize() for stage in self.stages)
+
+    def state(self):
+        """Returns the state of every stage keyed by stage name"""
+        return {stage.name: stage.state() for stage in self.stages}
@@ -0,0 +1,127 @@
+"""Estimates when queued jobs will start and finish from how long recent jobs of the same action took. Each action
+keeps an exponential moving average per pipeline stage of the time that stage spent working on a job. Time a job spent
+waiting for a stage to free up is left out, the estimate below works that out itself. Until a stage has seen a real
+job the action's eta_defaults total is split evenly over the stages it goes through.
+
+The estimate walks jobs, running ones first and then the queue in the order it will be served, through the stages on
+their own path. Each stage has a slot per worker, a job starts a stage once it is through the one before and a slot
+is free for long enough, so a stage only slows the jobs that go through it and the slowest stage on a path sets its
+pace."""
+from modules.settings import SETTINGS
+
+ACTION_NAMES = {
+    'lightycard': 'card',
+    'lightycard_three_pack': 'three pack',
+    'discord_chat': 'chat'
+}
+
+
+def format_duration(seconds):
+    """Returns a rough human readable duration"""
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f'~{max(seconds, 1)}s'
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return f'~{minutes}m {seconds}s' if seconds else f'~{minutes}m'
+    hours, minutes = divmod(minutes, 60)
+    return f'~{hours}h {minutes}m'
+
+
+class QueueEstimator:
+    """Moving averages of job duration per action and the jobs currently running"""
+    def __init__(self, defaults, smoothing):
+        self.defaults = dict(defaults)
+        self.averages = {action: {} for action in defaults}
+        self.samples = dict.fromkeys(defaults, 0)
+        self.smoothing = smoothing
+        self.running = {}
+
+    def stage_average(self, action, stage_name, path_length):
+        """Returns the expected seconds a stage spends on a job with this action, path_length being how many stages
+        the job goes through"""
+        average = self.averages.get(action, {}).get(stage_name)
+        if average is None:
+            default = self.defaults.get(action, max(self.defaults.values(), default=60.0))
+            return default / max(1, path_length)
+        return average
+
+    def start(self, job):
+        """Marks a job as running, it has been through no stages yet"""
+        self.running[id(job)] = (job, {})
+
+    def add_stage_time(self, job, stage_name, seconds):
+        """Records the time a stage spent working on a running job"""
+        entry = self.running.get(id(job))
+        if entry is not None:
+            entry[1][stage_name] = entry[1].get(stage_name, 0.0) + seconds
+
+    def finish(self, job, error=None):
+        """Stops tracking a job, folding the time each stage spent on it into its action's averages if it was
+        delivered"""
+        entry = self.running.pop(id(job), None)
+        if entry is None or error is not None:
+            return
+        averages = self.averages.setdefault(job.action, {})
+        for stage_name, seconds in entry[1].items():
+            if stage_name not in averages:
+                averages[stage_name] = seconds  # the first real job replaces the default outright
+            else:
+                averages[stage_name] += self.smoothing * (seconds - averages[stage_name])
+        self.samples[job.action] = self.samples.get(job.action, 0) + 1
+
+    def estimate(self, queued_jobs, stages):
+        """Returns (job, seconds until it starts, seconds until it finishes) for every running job and then every
+        queued job, queued_jobs being in the order they will be served. stages are the pipeline stages in order."""
+        slots = {stage.name: [[] for _ in range(max(1, stage.workers))] for stage in stages}
+        jobs = [(job, stage_times, True) for job, stage_times in self.running.values()]
+        jobs += [(job, {}, False) for job in queued_jobs]
+        estimates = []
+        for job, stage_times, running in jobs:
+            path = [stage for stage in stages if job.action in stage.actions]
+            ready = 0.0
+            work = 0.0
+            for stage in path:
+                if stage.name in stage_times:
+                    continue  # already through this stage
+                duration = self.stage_average(job.action, stage.name, len(path))
+                stage_start, busy = min(((self.first_gap(busy, ready, duration), busy) for busy in slots[stage.name]),
+                                        key=lambda entry: entry[0])
+                busy.append((stage_start, stage_start + duration))
+                busy.sort()
+                ready = stage_start + duration
+                work += duration
+            # a job that has to wait for a stage mid path only starts when it needs to, its text is not much use
+            # sitting in front of a busy image stage
+            estimates.append((job, 0.0 if running else max(0.0, ready - work), ready))
+        return estimates
+
+    @staticmethod
+    def first_gap(busy, ready, duration):
+        """Returns the earliest time from ready that a slot with these sorted busy intervals is free for duration"""
+        start = ready
+        for busy_start, busy_end in busy:
+            if start + duration <= busy_start:
+                break
+            start = max(start, busy_end)
+        return start
+
+    def state(self):
+        """Returns the expected duration, the per stage averages once real jobs have been seen, and the sample count
+        of every action"""
+        action_states = {}
+        for action in self.defaults.keys() | self.averages.keys():
+            stage_averages = self.averages.get(action, {})
+            action_states[action] = {
+                'average_seconds': round(sum(stage_averages.values()) or self.defaults.get(action, 0.0), 1),
+                'stages': {stage_name: round(average, 1) for stage_name, average in stage_averages.items()},
+                'samples': self.samples.get(action, 0)
+            }
+        return action_states
+
+
+QUEUE_ESTIMATOR = QueueEstimator(
+    {action: float(seconds) for action, seconds in (item.split(':') for item in SETTINGS.get(
+        'eta_defaults', ['lightycard:40,lightycard_three_pack:90,discord_chat:15'])[0].split(','))},
+    float(SETTINGS.get('eta_smoothing', [0.2])[0])
+)
@@ -0,0 +1,115 @@
+"""A render node pulls jobs from the bot's job broker, runs the text, image and composite work on its own model
+workers and pushes the results back.
+
+Run as `python -m modules.render_node` on a gpu box with broker_address and broker_authkey in its settings.cfg, or let
+the bot start broker_local_nodes of them in process for testing."""
+import asyncio
+import socket
+import sys
+from loguru import logger
+from modules.chat_generator import ChatGenerator
+from modules.job_broker import CARD_RESULT_FIELDS, parse_address, read_message, write_message
+from modules.mtg_generator import MTGCardGenerator
+from modules.settings import SETTINGS
+
+
+async def run_job(job_message):
+    """Runs one job and returns the result header and the blob of card pixels"""
+    if job_message['action'] == 'discord_chat':
+        chat_request = ChatGenerator(job_message['prompt'], None, job_message['user'])
+        await chat_request.generate_chat()
+        return {'response': chat_request.response}, b''
+    card_request = MTGCardGenerator(job_message['action'], job_message['prompt'], None, job_message['user'],
+                                    job_message.get('fresh', False), job_message.get('seed'),
+                                    job_message.get('deterministic'))
+    await card_request.generate_card_texts()
+    await card_request.generate_card_images()
+    await card_request.composite_cards()
+    cards = []
+    blobs = []
+    offset = 0
+    for card in card_request.get_cards():
+        pixels = card.card.tobytes()
+        card_result = {field: getattr(card, field) for field in CARD_RESULT_FIELDS}
+        card_result.update(mode=card.card.mode, size=card.card.size, offset=offset, length=len(pixels))
+        cards.append(card_result)
+        blobs.append(pixels)
+        offset += len(pixels)
+    return {'cards': cards}, b''.join(blobs)
+
+
+class RenderNode:
+    """Keeps up to capacity jobs in flight, asking the broker for another each time one finishes"""
+    def __init__(self, address, authkey, name=None, capacity=2):
+        self.address = address
+        self.authkey = authkey
+        self.name = name or socket.gethostname()
+        self.capacity = capacity
+        self.writer = None
+        self.tasks = set()
+
+    async def connect(self):
+        """Opens the connection to the broker and says hello"""
+        kind, arguments = parse_address(self.address)
+        if kind == 'unix':
+            reader, self.writer = await asyncio.open_unix_connection(*arguments)
+        else:
+            reader, self.writer = await asyncio.open_connection(*arguments)
+        await write_message(self.writer, {'type': 'hello', 'node': self.name, 'authkey': self.authkey})
+        return reader
+
+    async def run(self):
+        """Pulls and runs jobs until the broker goes away"""
+        reader = await self.connect()
+        logger.bind(node=self.name, broker=self.address, capacity=self.capacity).info("Render Node Started")
+        try:
+            for _ in range(self.capacity):
+                await write_message(self.writer, {'type': 'pull'})
+            while True:
+                job_message, _ = await read_message(reader)
+                if job_message['type'] == 'job':
+                    job_task = asyncio.create_task(self.handle_job(job_message))
+                    self.tasks.add(job_task)
+                    job_task.add_done_callback(self.tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.bind(node=self.name).warning("Render Node Lost Broker")
+        finally:
+            for job_task in list(self.tasks):
+                job_task.cancel()
+            self.writer.close()
+
+    async def handle_job(self, job_message):
+        """Runs a job, sends back its result or error and pulls the next one"""
+        try:
+            result, blob = await run_job(job_message)
+            header = {'type': 'result', 'job_id': job_message['job_id'], 'ok': True, 'result': result}
+        except Exception as e:
+            logger.bind(node=self.name, prompt=job_message['prompt']).error(f'EXCEPTION: {e}')
+            header = {'type': 'result', 'job_id': job_message['job_id'], 'ok': False, 'error': f'{type(e).__name__}: {e}'}
+            blob = b''
+        await write_message(self.writer, header, blob)
+        await write_message(self.writer, {'type': 'pull'})
+
+
+def start_local_nodes(broker, count):
+    """Starts render nodes inside this process that connect to the broker like remote ones would"""
+    return [asyncio.create_task(RenderNode(broker.address, broker.authkey, f'local{index}').run())
+            for index in range(count)]
+
+
+async def main():
+    """Runs a render node against the broker in settings.cfg"""
+    node = RenderNode(
+        SETTINGS.get('broker_address', ['tcp:127.0.0.1:7777'])[0],
+        SETTINGS.get('broker_authkey', [''])[0],
+        SETTINGS.get('render_node_name', [None])[0],
+        int(SETTINGS.get('render_node_capacity', [2])[0])
+    )
+    await node.run()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,106 @@
+"""Decides which waiting job goes into the pipeline next. Jobs wait in priority classes, twitch redemptions before
+cards before chat, and within a class every user gets a turn in rotation so one user's backlog can't starve the rest.
+
+A class's weight is how many jobs it may take in a row while lower classes are waiting. Once every waiting class has
+used its turns they all get them back, so chat still moves while the card classes are busy.
+
+get can be told to hold the next job back until the pipeline has room for it. Jobs then keep waiting here, where a
+twitch redemption that comes in later still goes ahead of them, instead of lining up first in first out inside the
+pipeline's stage queues."""
+import asyncio
+from collections import OrderedDict, deque
+
+PRIORITY_CLASSES = ('twitch', 'card', 'chat')
+
+
+class FairScheduler:
+    """Drop in replacement for the generation asyncio.Queue, put takes the job's priority class"""
+    def __init__(self, weights):
+        self.weights = {priority_class: max(1, int(weights.get(priority_class, 1)))
+                        for priority_class in PRIORITY_CLASSES}
+        self.credits = dict(self.weights)
+        self.classes = {priority_class: OrderedDict() for priority_class in PRIORITY_CLASSES}
+        self.condition = asyncio.Condition()
+        self.changed = asyncio.Event()
+        self.size = 0
+
+    @staticmethod
+    def user_key(job):
+        """Returns who a job belongs to for fairness, twitch redeemers all share one user id so the name is kept too"""
+        return job.user.id, str(job.user)
+
+    async def put(self, job, priority_class):
+        """Adds a job to the back of its user's line in its class and returns its place in the queue, 1 is next"""
+        async with self.condition:
+            self.classes[priority_class].setdefault(self.user_key(job), deque()).append(job)
+            self.size += 1
+            self.condition.notify()
+            self.changed.set()
+            return self.position(job)
+
+    async def get(self, can_start=None):
+        """Waits for a job and returns the next one by class turns and user rotation. If can_start is given get also
+        waits until it returns true for the next job, call wake when its answer may have changed."""
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.size > 0 and (can_start is None or can_start(self.peek(1)[0])))
+            priority_class = self.next_class(self.classes, self.credits)
+            self.credits[priority_class] -= 1
+            self.size -= 1
+            self.changed.set()
+            return self.pop_job(self.classes[priority_class])
+
+    async def wake(self):
+        """Has a waiting get check its can_start again"""
+        async with self.condition:
+            self.condition.notify_all()
+
+    def next_class(self, classes, credits):
+        """Returns the highest priority waiting class with turns left, handing out new turns when none has any"""
+        waiting = [priority_class for priority_class in PRIORITY_CLASSES if classes[priority_class]]
+        for priority_class in waiting:
+            if credits[priority_class] > 0:
+                return priority_class
+        credits.update(self.weights)
+        return waiting[0]
+
+    @staticmethod
+    def pop_job(users):
+        """Takes the first job of the user at the front of the rotation and moves that user to the back"""
+        user, jobs = users.popitem(last=False)
+        job = jobs.popleft()
+        if jobs:
+            users[user] = jobs
+        return job
+
+    def peek(self, count):
+        """Returns the next count jobs in the order they will come out, without taking them"""
+        credits = dict(self.credits)
+        classes = {priority_class: OrderedDict((user, deque(jobs)) for user, jobs in users.items())
+                   for priority_class, users in self.classes.items()}
+        jobs = []
+        for _ in range(min(count, self.size)):
+            priority_class = self.next_class(classes, credits)
+            credits[priority_class] -= 1
+            jobs.append(self.pop_job(classes[priority_class]))
+        return jobs
+
+    async def wait_for_change(self):
+        """Waits until a job is added or taken"""
+        await self.changed.wait()
+        self.changed.clear()
+
+    def position(self, job):
+        """Returns where a job is in the queue, 1 being the next job out, or None if it is not waiting"""
+        for place, upcoming_job in enumerate(self.peek(self.size), start=1):
+            if upcoming_job is job:
+                return place
+        return None
+
+    def qsize(self):
+        """Returns how many jobs are waiting"""
+        return self.size
+
+    def state(self):
+        """Returns how many jobs and users are waiting in each class"""
+        return {priority_class: {'jobs': sum(len(jobs) for jobs in users.values()), 'users': len(users)}
+                for priority_class, users in self.classes.items()}
@@ -0,0 +1,76 @@
+"""Posts an LLM reply to discord while it is still being generated. A message goes up straight away and is edited
+as text arrives, no more often than edit_interval so the channel stays inside discord's edit rate limits. Once a
+message would pass discord's 2000 character limit it is cut at the last word break and the rest carries on in a new
+message."""
+import time
+
+MESSAGE_LIMIT = 2000
+PLACEHOLDER = '...'
+
+
+def split_at_word(text, limit=MESSAGE_LIMIT):
+    """Splits text into the part that fits in one message, cut at the last whitespace, and the rest"""
+    if len(text) <= limit:
+        return text, ''
+    cut = text.rfind(' ', 0, limit + 1)
+    cut = max(cut, text.rfind('\n', 0, limit + 1))
+    if cut <= 0:
+        cut = limit  # one unbroken word longer than a message
+    return text[:cut], text[cut:].lstrip(' ')
+
+
+class StreamingReply:
+    """The discord messages making up one streamed reply"""
+    def __init__(self, channel, edit_interval=1.0):
+        self.channel = channel
+        self.edit_interval = edit_interval
+        self.message = None
+        self.sent_text = ''
+        self.text = ''
+        self.last_edit = 0.0
+        self.messages = 0
+
+    async def start(self):
+        """Posts the placeholder message the reply will be edited into"""
+        self.message = await self.channel.send(content=PLACEHOLDER, mention_author=True)
+        self.messages = 1
+        self.last_edit = time.monotonic()
+
+    async def append(self, text):
+        """Adds streamed text, editing the message if the last edit was long enough ago"""
+        self.text += text
+        if len(self.text) > MESSAGE_LIMIT or time.monotonic() - self.last_edit >= self.edit_interval:
+            await self.flush()
+
+    async def flush(self):
+        """Brings the posted messages up to date with the text so far, rolling over into new messages as needed"""
+        while len(self.text) > MESSAGE_LIMIT:
+            head, self.text = split_at_word(self.text)
+            await self.edit(head)
+            self.message = await self.channel.send(content=PLACEHOLDER, mention_author=True)
+            self.messages += 1
+            self.sent_text = ''
+        if self.text.strip():
+            await self.edit(self.text)
+
+    async def edit(self, text):
+        """Edits the current message if its text changed"""
+        if text != self.sent_text:
+            await self.message.edit(content=text)
+            self.sent_text = text
+        self.last_edit = time.monotonic()
+
+    async def abort(self):
+        """Deletes the placeholder if generation failed before any text made it into the current message"""
+        if self.message is not None and not self.sent_text:
+            await self.message.delete()
+            self.message = None
+
+    async def finish(self):
+        """Posts whatever text is left and makes sure no placeholder is left behind"""
+        await self.flush()
+        if not self.sent_text:
+            if self.messages > 1:
+                await self.message.delete()  # the rollover left nothing but whitespace for this one
+            else:
+                await self.edit('(no reply)')
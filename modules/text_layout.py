@@ -0,0 +1,82 @@
+"""Word wraps card text with inline mana symbols, caching how wide each word is in each font"""
+import re
+from PIL import ImageDraw
+
+TOKEN_PATTERN = re.compile(r'(\{[^}]+\}|\S+|\n)')
+SYMBOL_PATTERN = re.compile(r'\{[A-Za-z0-9]\}')
+
+
+def tokenize(text):
+    """Splits text into words, {X} symbols and line breaks"""
+    return TOKEN_PATTERN.findall(text)
+
+
+class TextLayout:
+    """Lays out a paragraph in one pass and returns positioned runs instead of drawing as it goes, so callers can try
+    a layout, check where it ends and only then draw it."""
+    def __init__(self, max_cached_words=50000):
+        self.max_cached_words = max_cached_words
+        self.word_widths = {}
+        self.space_widths = {}
+
+    def word_width(self, font, word):
+        """Returns the drawn width of a word, measured once per font"""
+        key = (font.path, font.size, word)
+        width = self.word_widths.get(key)
+        if width is None:
+            if len(self.word_widths) >= self.max_cached_words:
+                self.word_widths.clear()
+            bbox = font.getbbox(word, mode='L')
+            width = bbox[2] - bbox[0]
+            self.word_widths[key] = width
+        return width
+
+    def space_width(self, font):
+        """Returns how far the cursor moves after a word"""
+        key = (font.path, font.size)
+        width = self.space_widths.get(key)
+        if width is None:
+            width = font.getbbox(' ', mode='L')[2]
+            self.space_widths[key] = width
+        return width
+
+    def layout(self, tokens, font, origin, max_x, line_height, symbols=None):
+        """Returns the runs for a paragraph and the cursor position after its last token. A run is (x, y, text, font)
+        for a word or (x, y, image, None) for a symbol. Symbols are only drawn as images if they are in symbols, a
+        mapping of '{W}' style tokens to icon images."""
+        x_start, current_y = origin
+        current_x = x_start
+        runs = []
+        for token in tokens:
+            if token == "\n":
+                current_x = x_start  # Move to the beginning of the next line
+                current_y += line_height
+                continue
+            if symbols is not None and SYMBOL_PATTERN.match(token) and token in symbols:
+                symbol_image = symbols[token]
+                if current_x + symbol_image.width > max_x:
+                    current_x = x_start
+                    current_y += symbol_image.height
+                runs.append((current_x, current_y, symbol_image, None))
+                current_x += symbol_image.width
+                continue
+            word_width = self.word_width(font, token)
+            if current_x + word_width > max_x:
+                current_x = x_start
+                current_y += line_height
+            runs.append((current_x, current_y, token, font))
+            current_x += word_width + self.space_width(font)
+        return runs, (current_x, current_y)
+
+    @staticmethod
+    def draw_runs(card, runs, fill="black"):
+        """Draws laid out runs onto a card"""
+        draw = ImageDraw.Draw(card)
+        for x, y, value, font in runs:
+            if font is None:
+                card.paste(value, (x, y), value)
+            else:
+                draw.text((x, y), value, font=font, fill=fill)
+
+
+TEXT_LAYOUT = TextLayout()
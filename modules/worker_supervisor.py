@@ -0,0 +1,194 @@
+"""Keeps a failing model worker pool from stalling every job behind it. Requests that fail are retried a capped number
+of times with exponential backoff, after classifying why they failed:
+
+    oom        the model ran out of gpu memory, the worker is restarted to free it before the retry
+    crash      the worker process died, it is restarted before the retry instead of on the next request
+    startup    the model failed to load, a bad lora path or a missing file, retrying only helps if it was transient
+    bad_input  the backend rejected the request itself, the job fails straight away without a retry
+    error      anything else
+
+Consecutive failures trip a circuit breaker. While it is open requests fail at once instead of queueing up behind a
+model that cannot load, and a recovery task restarts the pool in the background, backing off between tries. Once the
+pool is back one trial request is let through, closing the breaker if it works."""
+import asyncio
+import random
+from loguru import logger
+from modules.metrics import METRICS
+from modules.model_worker import IMAGE_WORKERS
+from modules.settings import SETTINGS
+
+MAX_RECOVERY_DELAY = 600
+BREAKER_STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+
+class ModelWorkerError(RuntimeError):
+    """A request that failed for good, kind is the failure classification"""
+    def __init__(self, kind, message):
+        super().__init__(message)
+        self.kind = kind
+
+
+class CircuitOpenError(ModelWorkerError):
+    """Raised instead of sending a request to a pool whose circuit breaker is open"""
+    def __init__(self, pool_name):
+        super().__init__('circuit_open', f'{pool_name} workers are down')
+
+
+def classify_failure(error):
+    """Returns the kind of failure a worker error message describes"""
+    message = str(error)
+    if 'OutOfMemoryError' in message or 'out of memory' in message.lower():
+        return 'oom'
+    if 'failed to start' in message or 'before it started listening' in message or 'could not start' in message:
+        return 'startup'
+    if 'crashed' in message:
+        return 'crash'
+    if message.startswith(('ValueError', 'TypeError', 'KeyError', 'IndexError')):
+        return 'bad_input'
+    return 'error'
+
+
+class CircuitBreaker:
+    """Opens after threshold failures in a row. Only the supervisor's recovery moves it from open to half open, where
+    a single trial request decides whether it closes or opens again."""
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.state = 'closed'
+        self.failures = 0
+        self.trial_running = False
+
+    def allow(self):
+        """Returns true if a request may go to the pool"""
+        if self.state == 'closed':
+            return True
+        if self.state == 'half_open' and not self.trial_running:
+            self.trial_running = True
+            return True
+        return False
+
+    def record_success(self):
+        """Closes the breaker"""
+        self.state = 'closed'
+        self.failures = 0
+        self.trial_running = False
+
+    def record_failure(self):
+        """Counts a failure, returns true if it just opened the breaker"""
+        self.failures += 1
+        self.trial_running = False
+        if self.state == 'open' or (self.state == 'closed' and self.failures < self.threshold):
+            return False
+        self.state = 'open'
+        return True
+
+    def half_open(self):
+        """Lets one trial request through"""
+        self.state = 'half_open'
+        self.trial_running = False
+
+
+class WorkerSupervisor:
+    """Sends requests to a worker pool with retries, backoff, warm restarts and a circuit breaker"""
+    def __init__(self, pool, max_attempts, base_delay, max_delay, breaker_threshold, breaker_reset):
+        self.pool = pool
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = CircuitBreaker(breaker_threshold)
+        self.breaker_reset = breaker_reset
+        self.restart_tasks = {}
+        self.recovery_task = None
+
+    async def request(self, op, *args, **kwargs):
+        """Sends a request to the least loaded worker and returns its result, retrying failures. Raises
+        ModelWorkerError once the attempts run out or the failure is not worth retrying."""
+        for attempt in range(1, self.max_attempts + 1):
+            if not self.breaker.allow():
+                METRICS.increment('lighty_worker_rejected_total', pool=self.pool.name)
+                raise CircuitOpenError(self.pool.name)
+            worker = self.pool.least_loaded()
+            future = None
+            try:
+                future = await asyncio.to_thread(worker.submit, op, *args, **kwargs)
+                result = await asyncio.wrap_future(future)
+            except RuntimeError as e:
+                generation = future.generation if future is not None else worker.generation
+                kind = classify_failure(e)
+                METRICS.increment('lighty_worker_request_failures_total', pool=self.pool.name, kind=kind)
+                logger.bind(worker=worker.name, op=op, kind=kind, attempt=attempt).warning(
+                    f"Model Worker Request Failed: {e}")
+                if kind == 'bad_input':
+                    self.breaker.record_success()  # the worker answered, it is the request that is broken
+                    raise ModelWorkerError(kind, str(e)) from e
+                if self.breaker.record_failure():
+                    self.trip()
+                if attempt == self.max_attempts:
+                    raise ModelWorkerError(kind, f'{op} failed {attempt} times, last error: {e}') from e
+                METRICS.increment('lighty_worker_retries_total', pool=self.pool.name, kind=kind)
+                delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+                if kind in ('oom', 'crash'):
+                    await asyncio.gather(asyncio.sleep(delay), self.warm_restart(worker, generation))
+                else:
+                    await asyncio.sleep(delay)
+                continue
+            self.breaker.record_success()
+            return result
+
+    async def warm_restart(self, worker, generation):
+        """Restarts a worker off the event loop so the retry finds its model loaded. generation is the child process
+        the failed request went to, a failure that arrives after it was replaced does not restart the new one. Jobs
+        that fail on the same worker at once share one restart."""
+        restart_task = self.restart_tasks.get(worker.name)
+        if restart_task is None or restart_task.done():
+            restart_task = self.restart_tasks[worker.name] = asyncio.create_task(
+                self.restart_worker(worker, generation))
+        await asyncio.shield(restart_task)
+
+    @staticmethod
+    async def restart_worker(worker, generation):
+        """Restarts one worker unless it was already replaced, logging instead of raising if it fails to come back"""
+        try:
+            restarted = await asyncio.to_thread(worker.restart, generation)
+        except RuntimeError as e:
+            METRICS.increment('lighty_worker_warm_restarts_total', worker=worker.name, outcome='failed')
+            logger.bind(worker=worker.name).error(f"Model Worker Restart Failed: {e}")
+            return
+        METRICS.increment('lighty_worker_warm_restarts_total', worker=worker.name,
+                          outcome='restarted' if restarted else 'skipped')
+
+    def trip(self):
+        """Starts recovering the pool in the background once the breaker opens"""
+        METRICS.increment('lighty_circuit_breaker_trips_total', pool=self.pool.name)
+        logger.bind(pool=self.pool.name, failures=self.breaker.failures).error("Circuit Breaker Opened")
+        if self.recovery_task is None or self.recovery_task.done():
+            self.recovery_task = asyncio.create_task(self.recover())
+
+    async def recover(self):
+        """Restarts the pool after breaker_reset seconds, doubling the wait after every restart that fails, and lets a
+        trial request through once it is back"""
+        delay = self.breaker_reset
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await asyncio.to_thread(self.pool.restart)
+            except RuntimeError as e:
+                delay = min(delay * 2, MAX_RECOVERY_DELAY)
+                logger.bind(pool=self.pool.name, retry_in=delay).error(f"Model Worker Pool Recovery Failed: {e}")
+                continue
+            self.breaker.half_open()
+            logger.bind(pool=self.pool.name).info("Circuit Breaker Half Open")
+            return
+
+    def state(self):
+        """Returns the breaker state as a number for the metrics, 0 closed, 1 half open and 2 open"""
+        return BREAKER_STATES[self.breaker.state]
+
+
+IMAGE_SUPERVISOR = WorkerSupervisor(
+    IMAGE_WORKERS,
+    int(SETTINGS.get('image_retry_attempts', [4])[0]),
+    float(SETTINGS.get('image_retry_base_delay', [1.0])[0]),
+    float(SETTINGS.get('image_retry_max_delay', [30.0])[0]),
+    int(SETTINGS.get('image_breaker_threshold', [5])[0]),
+    float(SETTINGS.get('image_breaker_reset', [60.0])[0])
+)